@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+class AnnualReadAhead(object):
+    """Class to read an input which changes on the first day
+    of each year. Once the end of the year is within
+    'days_ahead' days, the input for the next year is read in
+    a background thread, so that on 1 January it only has to
+    be swapped in. If days_ahead is zero (the default) inputs
+    are read when they are needed.
+
+    'read_function' takes the year and returns the input. It
+    is called from the background thread, so it must not
+    modify the model state.
+    """
+    def __init__(self, modelTime, read_function, days_ahead = 0):
+        self.modelTime = modelTime
+        self.read_function = read_function
+        self.days_ahead = days_ahead
+        self.requests = dict()
+
+    @classmethod
+    def from_configuration(cls, var, read_function):
+        days_ahead = 0
+        if 'annualReadAheadDays' in var._configuration.globalOptions:
+            days_ahead = int(var._configuration.globalOptions['annualReadAheadDays'])
+        return cls(var._modelTime, read_function, days_ahead)
+
+    def update(self):
+        """Function to start reading the input for the next
+        year if the end of the current year is near"""
+        if self.days_ahead <= 0:
+            return
+        next_year = self.modelTime.year + 1
+        start_of_next_year = datetime.date(next_year, 1, 1)
+        if start_of_next_year > self.modelTime.endTime:
+            return
+        days_to_next_year = (start_of_next_year - self.modelTime.currTime).days
+        if days_to_next_year <= self.days_ahead:
+            self.request(next_year)
+
+    def request(self, year):
+        if year in self.requests:
+            return
+        request = {
+            'done' : threading.Event(),
+            'result' : None,
+            'error' : None}
+        thread = threading.Thread(target=self.run, args=(year, request))
+        thread.daemon = True
+        self.requests[year] = request
+        thread.start()
+
+    def run(self, year, request):
+        try:
+            request['result'] = self.read_function(year)
+        except Exception as e:
+            request['error'] = e
+        finally:
+            request['done'].set()
+
+    def get(self, year):
+        """Function to get the input for a given year, waiting
+        for the background read if one was started, and
+        otherwise reading the input"""
+        request = self.requests.pop(year, None)
+        if request is None:
+            return self.read_function(year)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
@@ -2,9 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import os
-import time
+import datetime
 import numpy as np
 import VirtualOS as vos
+from CouplingFileWatcher import CouplingFileWatcher, CouplingFileReader
 from aquacrop.Messages import *
 
 import logging
@@ -29,6 +30,10 @@ class CanalSupply(object):
             self.canalFileNC = self._configuration.CANAL['canal_input_file']
             self.canalVarName = self._configuration.CANAL['canal_variable_name']
             self.canalTimeLag = self._configuration.CANAL['time_lag']
+            if self.DailyCanalNC:
+                self.coupling_file_reader = CouplingFileReader(
+                    CouplingFileWatcher.from_configuration(self._configuration.CANAL),
+                    self.read_canal_file)
             # # ****TODO****
             # # if the program is configured to read daily canal supply files and
             # # the time lag is positive, we also need to read an initial value
@@ -41,6 +46,17 @@ class CanalSupply(object):
             #                                             LatitudeLongitude = True)
             #     self.var.CanalSupply = CanalSupply[self.var.landmask]
                     
+    def get_canal_filename(self, date):
+        return self.canalFileNC.format(day=date.day, month=date.month, year=date.year)
+
+    def read_canal_file(self, canalFileNC):
+        return vos.netcdf2PCRobjCloneWithoutTime(
+            canalFileNC,
+            self.canalVarName,
+            cloneMapFileName = self.cloneMap,
+            LatitudeLongitude = True,
+            landmask = self.landmask)
+        
     def read(self):
 
         # reading canal supply:
@@ -50,28 +66,15 @@ class CanalSupply(object):
                     # introduce this test so that we do not ask the model to read
                     # a file from a timestep prior to the current simulation. 
                     if not (self._modelTime.isFirstTimestep() & (self.canalTimeLag > 0)):
-                    
-                        day, month, year = self._modelTime.day, self._modelTime.month, self._modelTime.year
-                        canalFileNC = self.canalFileNC.format(day=day, month=month, year=year)
-                        exists = os.path.exists(canalFileNC)
-                        max_wait_time = 60
-                        wait_time = 0.1
-                        total_wait_time = 0
-                        while exists is False and total_wait_time <= max_wait_time:
-                            time.sleep(wait_time)
-                            exists = os.path.exists(canalFileNC)
-                            total_wait_time += wait_time
-
-                        if not exists:
-                            msg = "canal file doesn't exist and maximum wait time exceeded"
-                            raise AQError(msg)
+                        canalFileNC = self.get_canal_filename(self._modelTime.currTime)
+                        self.CanalSupply = self.coupling_file_reader.read(canalFileNC)
 
-                        CanalSupply = vos.netcdf2PCRobjCloneWithoutTime(
-                            canalFileNC,
-                            self.canalVarName,
-                            cloneMapFileName = self.cloneMap,
-                            LatitudeLongitude = True)
-                        self.CanalSupply = CanalSupply[self.landmask]
+                    # start waiting for (and reading) the file for the next
+                    # time step while the rest of this time step is computed
+                    if not self._modelTime.isLastTimeStep():
+                        tomorrow = self._modelTime.currTime + datetime.timedelta(1)
+                        self.coupling_file_reader.request(
+                            self.get_canal_filename(tomorrow))
                         
                 else:
                     CanalSupply = vos.netcdf2PCRobjClone(
@@ -80,16 +83,18 @@ class CanalSupply(object):
                         str(currTimeStep.fulldate),
                         useDoy = method_for_time_index,
                         cloneMapFileName = self.cloneMap,
-                        LatitudeLongitude = True)
-                    self.CanalSupply = CanalSupply[self.landmask]
+                        LatitudeLongitude = True,
+                        landmask = self.landmask)
+                    self.CanalSupply = CanalSupply
                     
             else:
                 CanalSupply = vos.netcdf2PCRobjCloneWithoutTime(
                     self.canalFileNC,
                     self.canalVarName,
                     cloneMapFileName = self.cloneMap,
-                    LatitudeLongitude = True)
-                self.CanalSupply = CanalSupply[self.landmask]
+                    LatitudeLongitude = True,
+                    landmask = self.landmask)
+                self.CanalSupply = CanalSupply
     
     def dynamic(self):
         self.read()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import select
+import threading
+import ctypes
+import ctypes.util
+
+from Messages import *
+
+import logging
+logger = logging.getLogger(__name__)
+
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+def load_inotify():
+    """Function to load the inotify functions from the C
+    library. Returns None if inotify is not available (e.g. on
+    platforms other than Linux), in which case files are polled.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+libc = load_inotify()
+
+class CouplingFileWatcher(object):
+    """Class to wait for files written by an external (coupled)
+    model. If inotify is available the watcher sleeps until the
+    directory containing the file changes, otherwise the file
+    is polled every 'poll_interval' seconds.
+
+    Two rules are available to decide whether a file is
+    complete:
+    - 'rename' : the file is complete as soon as it exists. The
+                 external model should write to a temporary
+                 file and rename it to its final name, which is
+                 atomic.
+    - 'stable' : the file is complete when its size and
+                 modification time have not changed for
+                 'stable_time' seconds.
+    """
+    completion_rules = ('rename', 'stable')
+
+    def __init__(self, timeout = 60., completion = 'rename', stable_time = 1., poll_interval = 0.1):
+        if completion not in self.completion_rules:
+            msg = ("coupling file completion rule must be one of "
+                   + ', '.join(self.completion_rules))
+            raise ModelError(msg)
+        self.timeout = timeout
+        self.completion = completion
+        self.stable_time = stable_time
+        self.poll_interval = poll_interval
+
+    @classmethod
+    def from_configuration(cls, section):
+        """Function to create a watcher from the coupling
+        options in a configuration section"""
+        timeout = 60.
+        completion = 'rename'
+        stable_time = 1.
+        if 'couplingTimeout' in section:
+            timeout = float(section['couplingTimeout'])
+        if 'couplingFileCompletion' in section:
+            completion = str(section['couplingFileCompletion']).strip().lower()
+        if 'couplingStableTime' in section:
+            stable_time = float(section['couplingStableTime'])
+        return cls(timeout, completion, stable_time)
+
+    def get_state(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def wait(self, filename, timeout = None, cancel = None):
+        """Function to wait until a file is complete. Returns
+        True when the file is complete, or False if the timeout
+        is exceeded or the wait is cancelled (by setting the
+        'cancel' event). If timeout is None the watcher waits
+        until the file is complete or the wait is cancelled.
+        """
+        fd = self.add_watch(filename)
+        try:
+            return self.wait_for_file(filename, fd, timeout, cancel)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def add_watch(self, filename):
+        """Function to watch the directory of a file for new
+        or modified files. Returns an inotify file descriptor,
+        or None if the directory cannot be watched."""
+        if libc is None:
+            return None
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd = libc.inotify_init()
+        if fd < 0:
+            return None
+        mask = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_MODIFY
+        if libc.inotify_add_watch(fd, dirname.encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def wait_for_file(self, filename, fd, timeout, cancel):
+        start_time = time.time()
+        state = None
+        state_time = None
+        while True:
+            new_state = self.get_state(filename)
+            now = time.time()
+            if new_state is not None:
+                if self.completion == 'rename':
+                    return True
+                if new_state != state:
+                    state, state_time = new_state, now
+                elif now - state_time >= self.stable_time:
+                    return True
+
+            if cancel is not None and cancel.is_set():
+                return False
+            if timeout is not None and now - start_time > timeout:
+                return False
+
+            # sleep until the directory changes; the interval is
+            # limited so that the size of a file being written is
+            # checked, and the cancel event is noticed
+            interval = self.poll_interval
+            if state is not None:
+                interval = min(self.stable_time, 1.)
+            elif fd is not None:
+                interval = 1.
+            if timeout is not None:
+                interval = max(0., min(interval, start_time + timeout - now))
+            if fd is not None:
+                self.read_events(fd, interval)
+            else:
+                time.sleep(interval)
+
+    def read_events(self, fd, interval):
+        try:
+            ready, _, _ = select.select([fd], [], [], interval)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            # the events themselves are not needed; the file is
+            # checked again after any change to the directory
+            os.read(fd, 4096)
+
+    def check(self, filename):
+        """Function to wait for a file, raising an error if it
+        is not complete within the timeout"""
+        if not self.wait(filename, self.timeout):
+            raise self.timeout_error(filename)
+
+    def timeout_error(self, filename):
+        msg = ("coupling file " + str(filename)
+               + " is not complete and maximum wait time ("
+               + str(self.timeout) + " s) exceeded")
+        return ModelError(msg)
+
+class CouplingFileReader(object):
+    """Class to read files written by an external model. The
+    file for the next time step can be requested in advance,
+    in which case it is waited for and read in a background
+    thread while the model completes the current time step.
+    """
+    def __init__(self, watcher, read_function):
+        self.watcher = watcher
+        self.read_function = read_function
+        self.requests = dict()
+
+    def request(self, filename):
+        """Function to start waiting for and reading a file in
+        the background"""
+        if filename in self.requests:
+            return
+        request = {
+            'cancel' : threading.Event(),
+            'done' : threading.Event(),
+            'result' : None,
+            'error' : None}
+        thread = threading.Thread(target=self.run, args=(filename, request))
+        thread.daemon = True
+        self.requests[filename] = request
+        thread.start()
+
+    def run(self, filename, request):
+        try:
+            if self.watcher.wait(filename, cancel=request['cancel']):
+                request['result'] = self.read_function(filename)
+        except Exception as e:
+            request['error'] = e
+        finally:
+            request['done'].set()
+
+    def read(self, filename):
+        """Function to get the data of a file, waiting at most
+        the timeout of the watcher for it to be complete"""
+        request = self.requests.pop(filename, None)
+        if request is None:
+            self.watcher.check(filename)
+            return self.read_function(filename)
+
+        if not request['done'].wait(self.watcher.timeout):
+            request['cancel'].set()
+            request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        if request['result'] is None:
+            raise self.watcher.timeout_error(filename)
+        return request['result']
+
+    def cancel(self):
+        for request in self.requests.values():
+            request['cancel'].set()
+        self.requests.clear()
@@ -3,11 +3,11 @@
 
 import os
 import numpy as np
-import pcraster as pcr
 import VirtualOS as vos
 import netCDF4 as nc
 import datetime as datetime
 import calendar as calendar
+from AnnualReadAhead import AnnualReadAhead
 
 class CropArea(object):
     
@@ -25,6 +25,9 @@ class CropArea(object):
         
     def initial(self):
         self.var.CurrentCropArea = np.ones((self.var.nCrop, self.var.nCell))
+        self.crop_area_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            lambda year: self.read_crop_area(date = datetime.datetime(year, 1, 1, 0, 0, 0)))
 
     def read_cropland_area(self):
         self.var.CroplandArea = (
@@ -37,7 +40,8 @@ class CropArea(object):
                 self.CropAreaFileNC,
                 self.CropAreaVarName,
                 cloneMapFileName = self.var.cloneMap,
-                LatitudeLongitude = True)
+                LatitudeLongitude = True,
+                landmask = self.var.landmask)
         else:
             crop_area = vos.netcdf2PCRobjClone(
                 self.CropAreaFileNC,
@@ -45,10 +49,8 @@ class CropArea(object):
                 date,
                 useDoy = None,
                 cloneMapFileName = self.var.cloneMap,
-                LatitudeLongitude = True)
-        crop_area = np.reshape(
-            crop_area[self.var.landmask_crop],
-            (self.var.nCrop, self.var.nCell))
+                LatitudeLongitude = True,
+                landmask = self.var.landmask)
         crop_area = np.float64(crop_area)
         return crop_area
 
@@ -79,8 +81,8 @@ class CropArea(object):
                 # mid-season, it is necessary to introduce an intermediate variable
                 # (i.e. CropAreaNew) and only update the area on the first day of
                 # the growing season.
-                date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)
-                self.var.CropAreaNew = self.read_crop_area(date = date)
+                self.var.CropAreaNew = self.crop_area_reader.get(self.var._modelTime.year)
+            self.crop_area_reader.update()
                     
             if np.any(self.var.GrowingSeasonDayOne):
                 self.var.CropArea[self.var.GrowingSeasonDayOne] = self.var.CropAreaNew[self.var.GrowingSeasonDayOne]
@@ -248,6 +250,9 @@ class CropParameters(object):
         self.PotYieldNC = self.configuration['potentialYieldInputFile']
         self.PotYieldVarName = self.configuration['potentialYieldVariableName']
         self.AnnualChangeInPotYield = bool(int(self.configuration['annualChangeInPotentialYield']))
+        self.potential_crop_yield_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            self.read_annual_potential_crop_yield)
 
         # landmask, broadcast to crop dimension
         self.var.landmask_crop = (
@@ -274,8 +279,8 @@ class CropParameters(object):
                 d = vos.netcdf2PCRobjCloneWithoutTime(
                     self.CropParameterNC,
                     param,
-                    cloneMapFileName=self.var.cloneMap)
-                d = d[self.var.landmask_crop].reshape(self.var.nCrop,self.var.nCell)
+                    cloneMapFileName=self.var.cloneMap,
+                    landmask=self.var.landmask)
                 vars(self.var)[param] = np.broadcast_to(
                     d,
                     (self.var.nFarm, self.var.nCrop, self.var.nCell))
@@ -443,28 +448,35 @@ class CropParameters(object):
         # Global Crop Water Model        
         self.var.cropCoefficient[np.logical_not(self.var.GrowingSeasonIndex)] = 0.5
 
+    def read_annual_potential_crop_yield(self, year):
+        date = datetime.datetime(year, 1, 1, 0, 0, 0)
+        Yx = vos.netcdf2PCRobjClone(
+            self.PotYieldNC,
+            self.PotYieldVarName,
+            date,
+            useDoy = None,
+            cloneMapFileName = self.var.cloneMap,
+            LatitudeLongitude = True,
+            landmask = self.var.landmask,
+            cache = True)
+        return Yx
+    
     def read_potential_crop_yield(self):        
         start_of_model_run = (self.var._modelTime.timeStepPCR == 1)
         start_of_year = (self.var._modelTime.doy == 1)
         if self.AnnualChangeInPotYield:
             if start_of_model_run or start_of_year:
-                date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)
-                Yx = vos.netcdf2PCRobjClone(
-                    self.PotYieldNC,
-                    self.PotYieldVarName,
-                    date,
-                    useDoy = None,
-                    cloneMapFileName = self.var.cloneMap,
-                    LatitudeLongitude = True)
-                self.var.Yx = Yx[self.var.landmask_crop].reshape(self.var.nCrop, self.var.nCell)
+                self.var.Yx = self.potential_crop_yield_reader.get(self.var._modelTime.year)
+            self.potential_crop_yield_reader.update()
         else:
             if start_of_model_run:
                 # date = datetime.datetime(self.staticLandCoverYear, 1, 1, 0, 0, 0) # ***TODO***
                 Yx = vos.netcdf2PCRobjCloneWithoutTime(
                     self.PotYieldNC,
                     self.PotYieldVarName,
-                    cloneMapFileName = self.var.cloneMap)
-                self.var.Yx = Yx[self.var.landmask_crop].reshape(self.var.nCrop, self.var.nCell)
+                    cloneMapFileName = self.var.cloneMap,
+                    landmask = self.var.landmask)
+                self.var.Yx = Yx
 
     def dynamic(self):
         self.adjust_planting_and_harvesting_date()
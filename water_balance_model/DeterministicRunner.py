@@ -30,6 +30,9 @@ class DeterministicRunner(DynamicModel):
     def initial(self):
         pass
 
+    def close(self):
+        self.model.close()
+
     def dynamic(self):
         self.modelTime.update(self.currentTimeStep())
         self.model.dynamic()
@@ -3,11 +3,11 @@
 
 import os
 import numpy as np
-import pcraster as pcr
 import netCDF4 as nc
 import datetime as datetime
 import calendar as calendar
 import VirtualOS as vos
+from AnnualReadAhead import AnnualReadAhead
 
 import logging
 logger = logging.getLogger(__name__)
@@ -66,11 +66,8 @@ class Tubewells(object):
             initialTubewellCapacityNC,
             tubewell_capacity_varname,
             cloneMapFileName = self.var.cloneMap,
-            LatitudeLongitude = True)
-        mask = np.broadcast_to(self.var.landmask, tubewell_count.shape)
-        tubewell_count = np.reshape(
-            tubewell_count[mask],
-            (self.var.nFarm, self.var.nCell))
+            LatitudeLongitude = True,
+            landmask = self.var.landmask)
         self.var.TubewellCount = tubewell_count.copy()
         
     def dynamic(self):
@@ -90,14 +87,11 @@ class CanalAccess(object):
                 initialCanalAccessNC,
                 canal_access_varname,
                 cloneMapFileName = self.var.cloneMap,
-                LatitudeLongitude = True)
+                LatitudeLongitude = True,
+                landmask = self.var.landmask)
         except:
-            canal_access = np.ones((self.var.nFarm, self.var.nLat, self.var.nLon))
+            canal_access = np.ones((self.var.nFarm, self.var.nCell))
 
-        mask = np.broadcast_to(self.var.landmask, canal_access.shape)
-        canal_access = np.reshape(
-            canal_access[mask],
-            (self.var.nFarm, self.var.nCell))            
         self.var.CanalAccess = canal_access.copy()
         # print np.max(self.var.CanalAccess)
 
@@ -115,25 +109,33 @@ class DieselPrice(object):
 
     def initial(self):
         self.var.DieselPrice = np.zeros((self.var.nCell))
+        self.diesel_price_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            self.read_diesel_price)
 
     def reset_initial_conditions(self):
         pass
     
+    def read_diesel_price(self, year):
+        date = datetime.datetime(year, 1, 1, 0, 0, 0)
+        diesel_price = vos.netcdf2PCRobjClone(
+            self.DieselPriceFileNC,
+            self.DieselPriceVarName,
+            date,
+            useDoy = None,
+            cloneMapFileName = self.var.cloneMap,
+            LatitudeLongitude = True,
+            landmask = self.var.landmask,
+            cache = True)
+        return diesel_price
+    
     def set_diesel_price(self):
         start_of_model_run = (self.var._modelTime.timeStepPCR == 1)
         start_of_year = (self.var._modelTime.doy == 1)
         if not self.DieselPriceFileNC == "None":
             if start_of_model_run or start_of_year:
-                date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)
-                diesel_price = vos.netcdf2PCRobjClone(
-                    self.DieselPriceFileNC,
-                    self.DieselPriceVarName,
-                    date,
-                    useDoy = None,
-                    cloneMapFileName = self.var.cloneMap,
-                    LatitudeLongitude = True)
-                diesel_price = diesel_price[self.var.landmask]
-                self.var.DieselPrice = diesel_price
+                self.var.DieselPrice = self.diesel_price_reader.get(self.var._modelTime.year)
+            self.diesel_price_reader.update()
 
     def dynamic(self):
         self.set_diesel_price()
@@ -176,6 +178,16 @@ class FarmParameters(object):
         self.canal_access_module = CanalAccess(var, configuration)
         self.diesel_price_module = DieselPrice(var, configuration)
         
+        self.farm_area_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            lambda year: self.read_annual_input(year, self.FarmAreaFileNC, self.FarmAreaVarName))
+        self.farm_category_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            lambda year: self.read_annual_input(year, self.FarmCategoryFileNC, self.FarmCategoryVarName))
+        self.farm_category_area_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            lambda year: self.read_annual_input(year, self.FarmCategoryAreaFileNC, self.FarmCategoryAreaVarName))
+        
     def initial(self):
         self.set_farm_category()
         self.set_farm_category_area()
@@ -203,26 +215,25 @@ class FarmParameters(object):
         elif ((self.var._modelTime.doy + 1) == start_of_agricultural_year):
             self.var.IsLastDayOfYear = True
 
+    def read_annual_input(self, year, ncFile, ncVarName):
+        date = datetime.datetime(year, 1, 1, 0, 0, 0)
+        return vos.netcdf2PCRobjClone(
+            ncFile,
+            ncVarName,
+            date,
+            useDoy = None,
+            cloneMapFileName = self.var.cloneMap,
+            LatitudeLongitude = True,
+            landmask = self.var.landmask)
+    
     def set_farm_area(self):
         if not self.FarmAreaFileNC == "None":
             start_of_model_run = (self.var._modelTime.timeStepPCR == 1)
             start_of_year = (self.var._modelTime.doy == 1)
             if self.AnnualChangeInFarmArea:
                 if start_of_model_run or start_of_year:
-                    date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)
-                    farm_area_new = vos.netcdf2PCRobjClone(
-                        self.FarmAreaFileNC,
-                        self.FarmAreaVarName,
-                        date,
-                        useDoy = None,
-                        cloneMapFileName = self.var.cloneMap,
-                        LatitudeLongitude = True)
-                    mask = np.broadcast_to(
-                        self.var.landmask,
-                        (self.var.nFarm, self.var.nLat, self.var.nLon))
-                    farm_area_new = np.reshape(
-                        farm_area_new[mask],
-                        (self.var.nFarm, self.var.nCell))
+                    farm_area_new = self.farm_area_reader.get(self.var._modelTime.year)
+                self.farm_area_reader.update()
 
                 if np.any(self.var.GrowingSeasonDayOne[0,:,:]):
                     self.var.FarmArea[self.var.GrowingSeasonDayOne[0,:,:]] = (
@@ -232,13 +243,8 @@ class FarmParameters(object):
                     farm_area = vos.netcdf2PCRobjCloneWithoutTime(
                         self.FarmAreaFileNC,
                         self.FarmAreaVarName,
-                        cloneMapFileName = self.var.cloneMap)
-                    mask = np.broadcast_to(
-                        self.var.landmask,
-                        (self.var.nFarm, self.var.nLat, self.var.nLon))
-                    farm_area = np.reshape(
-                        farm_area[mask],
-                        (self.var.nFarm, self.var.nCell))
+                        cloneMapFileName = self.var.cloneMap,
+                        landmask = self.var.landmask)
                     self.var.FarmArea = farm_area.copy()
                 
     def set_farm_category_area(self):
@@ -247,20 +253,8 @@ class FarmParameters(object):
             start_of_year = (self.var._modelTime.doy == 1)
             if self.AnnualChangeInFarmCategoryArea:
                 if start_of_model_run or start_of_year:
-                    date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)
-                    farm_cat_area_new = vos.netcdf2PCRobjClone(
-                        self.FarmCategoryAreaFileNC,
-                        self.FarmCategoryAreaVarName,
-                        date,
-                        useDoy = None,
-                        cloneMapFileName = self.var.cloneMap,
-                        LatitudeLongitude = True)
-                    mask = np.broadcast_to(
-                        self.var.landmask,
-                        (self.var.nFarmSizeCategory, self.var.nLat, self.var.nLon))
-                    farm_cat_area_new = np.reshape(
-                        farm_cat_area_new[mask],
-                        (self.var.nFarmSizeCategory, self.var.nCell))
+                    farm_cat_area_new = self.farm_category_area_reader.get(self.var._modelTime.year)
+                self.farm_category_area_reader.update()
 
                 if np.any(self.var.GrowingSeasonDayOne):
                     self.var.FarmCategoryArea[self.var.GrowingSeasonDayOne] = (
@@ -270,13 +264,8 @@ class FarmParameters(object):
                     farm_cat_area = vos.netcdf2PCRobjCloneWithoutTime(
                         self.FarmCategoryAreaFileNC,
                         self.FarmCategoryAreaVarName,
-                        cloneMapFileName = self.var.cloneMap)
-                    mask = np.broadcast_to(
-                        self.var.landmask,
-                        (self.var.nFarmSizeCategory, self.var.nLat, self.var.nLon))
-                    farm_cat_area = np.reshape(
-                        farm_cat_area[mask],
-                        (self.var.nFarmSizeCategory, self.var.nCell))
+                        cloneMapFileName = self.var.cloneMap,
+                        landmask = self.var.landmask)
                     self.var.FarmCategoryArea = farm_cat_area.copy()
             
     def set_farm_category(self):
@@ -285,20 +274,8 @@ class FarmParameters(object):
             start_of_year = (self.var._modelTime.doy == 1)
             if self.AnnualChangeInFarmCategory:
                 if start_of_model_run or start_of_year:
-                    date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)
-                    farm_category_new = vos.netcdf2PCRobjClone(
-                        self.FarmCategoryFileNC,
-                        self.FarmCategoryVarName,
-                        date,
-                        useDoy = None,
-                        cloneMapFileName = self.var.cloneMap,
-                        LatitudeLongitude = True)
-                    mask = np.broadcast_to(
-                        self.var.landmask,
-                        (self.var.nFarm, self.var.nLat, self.var.nLon))
-                    farm_category_new = np.reshape(
-                        farm_category_new[mask],
-                        (self.var.nFarm, self.var.nCell))
+                    farm_category_new = self.farm_category_reader.get(self.var._modelTime.year)
+                self.farm_category_reader.update()
 
                 if np.any(self.var.GrowingSeasonDayOne):
                     self.var.FarmCategory[self.var.GrowingSeasonDayOne[0,:,:]] = (
@@ -308,13 +285,8 @@ class FarmParameters(object):
                     farm_category = vos.netcdf2PCRobjCloneWithoutTime(
                         self.FarmCategoryFileNC,
                         self.FarmCategoryVarName,
-                        cloneMapFileName = self.var.cloneMap)
-                    mask = np.broadcast_to(
-                        self.var.landmask,
-                        (self.var.nFarm, self.var.nLat, self.var.nLon))
-                    farm_category = np.reshape(
-                        farm_category[mask],
-                        (self.var.nFarm, self.var.nCell))
+                        cloneMapFileName = self.var.cloneMap,
+                        landmask = self.var.landmask)
                     self.var.FarmCategory = farm_category.copy()
 
     def set_farm_irrigation_status(self):
@@ -3,7 +3,6 @@
 
 import os
 import numpy as np
-import pcraster as pcr
 import VirtualOS as vos
 import netCDF4 as nc
 
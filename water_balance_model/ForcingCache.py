@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+import VirtualOS as vos
+from ForcingStore import get_landmask_key
+
+import logging
+logger = logging.getLogger(__name__)
+
+# version of the layout of the cache entries, which is part
+# of their key
+cache_format = 2
+
+class ForcingCache(object):
+    """Class to keep the forcing read from netCDF files, after
+    resampling and compression to the landmask, in a cache
+    directory which is shared between runs. The first run
+    which reads a forcing file writes its values to the cache
+    as a (time, cell) .npy file, with the mask of missing
+    values in a second .npy file; later runs memory map the
+    file instead of decoding the netCDF file again. Runs on
+    the same node therefore share the cached forcing in the
+    page cache.
+
+    Entries are keyed by the input file (path, modification
+    time and size), the variable, the clone map and the
+    landmask. Values are cached before the unit conversions
+    in Meteo, so that runs which only differ in the
+    conversion constants share the cache.
+
+    At most 'capacity' entries are kept mapped: when more are
+    used the least recently used entry is dropped, which 
+    closes its memory mapped files.
+    """
+    def __init__(self, cache_dir, cloneMap, cloneMapAttributes, landmask, block_size = 366, capacity = 32):
+        self.cache_dir = cache_dir
+        self.cloneMap = cloneMap
+        self.cloneMapAttributes = cloneMapAttributes
+        self.landmask = landmask
+        self.block_size = block_size
+        self.clone_key = repr(vos.get_clone_key(cloneMap, cloneMapAttributes))
+        self.landmask_key = get_landmask_key(landmask)
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_configuration(cls, meteo):
+        cache_dir = None
+        if 'forcingCacheDir' in meteo._configuration.METEO:
+            cache_dir = str(meteo._configuration.METEO['forcingCacheDir'])
+            if cache_dir == 'None':
+                cache_dir = None
+        if cache_dir is None:
+            return None
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        logger.info('Caching meteorological forcing in ' + cache_dir)
+        return cls(cache_dir, meteo.cloneMap, meteo.cloneMapAttributes, meteo.landmask)
+
+    def get_key(self, ncFile, varName):
+        st = os.stat(ncFile)
+        key = (
+            cache_format, os.path.realpath(ncFile), st.st_mtime, st.st_size,
+            str(varName), self.clone_key, self.landmask_key)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def read(self, ncFile, varName, date):
+        """Function to read a forcing variable for a given
+        date (a 'YYYY-MM-DD' string) from the cache. Returns
+        None if the date is not in the file, in which case
+        the date should be resolved by reading the file."""
+        index, data, mask = self.get_entry(ncFile, varName)
+        idx = index.get(date)
+        if idx is None:
+            return None
+        # values are copied from the mapped file, so that the
+        # mapping is released when the entry is evicted
+        if mask is None:
+            return np.array(data[idx])
+        return np.ma.MaskedArray(np.array(data[idx]), mask=np.array(mask[idx]))
+
+    def get_entry(self, ncFile, varName):
+        with self.lock:
+            entry = self.entries.pop((ncFile, varName), None)
+            if entry is None:
+                filename = os.path.join(self.cache_dir, self.get_key(ncFile, varName))
+                if not os.path.exists(filename + '.npy'):
+                    self.write_entry(ncFile, varName, filename)
+                with open(filename + '.json') as f:
+                    dates = json.load(f)
+                index = dict()
+                for idx, date in enumerate(dates):
+                    index.setdefault(str(date), idx)
+                data = np.load(filename + '.npy', mmap_mode='r')
+                mask = None
+                if os.path.exists(filename + '.mask.npy'):
+                    mask = np.load(filename + '.mask.npy', mmap_mode='r')
+                entry = (index, data, mask)
+            self.entries[(ncFile, varName)] = entry
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            return entry
+
+    def write_entry(self, ncFile, varName, filename):
+        """Function to read all time steps of a variable and
+        write them to the cache. Files are written under a
+        temporary name and renamed, so that runs which share
+        the cache never see an incomplete entry. The values
+        file is renamed last, as its presence marks the entry
+        as complete."""
+        logger.info('Adding ' + str(varName) + ' from ' + str(ncFile) + ' to the forcing cache')
+        tmp_suffix = '.' + str(os.getpid()) + '.tmp'
+        dates = vos.get_nc_dates(ncFile)
+        with open(filename + '.json' + tmp_suffix, 'w') as f:
+            json.dump(dates, f)
+        data = None
+        mask = None
+        for start in range(0, len(dates), self.block_size):
+            arr = vos.netcdf2NumPyTimeIndexRange(
+                ncFile,
+                varName,
+                start,
+                start + self.block_size,
+                cloneMapFileName = self.cloneMap,
+                cloneMapAttributes = self.cloneMapAttributes,
+                LatitudeLongitude = True,
+                landmask = self.landmask)
+            if data is None:
+                data = np.lib.format.open_memmap(
+                    filename + '.npy' + tmp_suffix,
+                    mode = 'w+',
+                    dtype = arr.dtype,
+                    shape = (len(dates),) + arr.shape[1:])
+                # the mask is kept, so that cached reads return
+                # masked arrays like reads from the netCDF file
+                if isinstance(arr, np.ma.MaskedArray):
+                    mask = np.lib.format.open_memmap(
+                        filename + '.mask.npy' + tmp_suffix,
+                        mode = 'w+',
+                        dtype = np.bool_,
+                        shape = data.shape)
+            data[start:(start + arr.shape[0])] = np.ma.getdata(arr)
+            if mask is not None:
+                mask[start:(start + arr.shape[0])] = np.ma.getmaskarray(arr)
+        if data is None:
+            # the file has no time steps
+            with open(filename + '.npy' + tmp_suffix, 'wb') as f:
+                np.save(f, np.zeros((0,)))
+        else:
+            data.flush()
+            del data
+        if mask is not None:
+            mask.flush()
+            del mask
+            os.rename(filename + '.mask.npy' + tmp_suffix, filename + '.mask.npy')
+        os.rename(filename + '.json' + tmp_suffix, filename + '.json')
+        os.rename(filename + '.npy' + tmp_suffix, filename + '.npy')
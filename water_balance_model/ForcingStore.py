@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import glob
+import datetime
+import hashlib
+import numpy as np
+import netCDF4 as nc
+
+import VirtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+# A forcing store is a netCDF file holding the meteorological
+# forcing of a model domain as (time, cell) arrays, where cell
+# runs over the cells in the landmask. Values are stored after
+# the unit conversions in Meteo, and each variable is chunked
+# along time only, so that a day (or block of days) is read as
+# one contiguous slice. Stores are written by ingest_forcing.py.
+store_format = 'water_balance_model forcing store 1'
+
+# [METEO] options which control how the forcing is read, but
+# not its values
+read_options = ('forcingStore', 'prefetchDepth', 'forcingBlockSize', 'forcingMaxBlockSize', 'forcingReadThreads')
+
+def get_input_files(value):
+    """Function to get the files an option refers to. Date 
+    placeholders (e.g. {year}) match all files for which they
+    are filled in."""
+    value = str(value)
+    pattern = re.sub(r'\{[^}]*\}', '*', value)
+    if pattern == value:
+        return [value] if os.path.isfile(value) else []
+    return sorted(filename for filename in glob.glob(pattern) if os.path.isfile(filename))
+
+def get_meteo_key(meteo_section):
+    """Function to compute a key for the [METEO] options which
+    determine the values of the forcing, and the modification 
+    times and sizes of the input files they refer to"""
+    items = []
+    for key, value in sorted(meteo_section.items()):
+        if key in read_options:
+            continue
+        items.append((str(key), str(value)))
+        for filename in get_input_files(value):
+            st = os.stat(filename)
+            items.append((filename, st.st_mtime, st.st_size))
+    return hashlib.sha1(repr(items).encode()).hexdigest()
+
+def get_landmask_key(landmask):
+    h = hashlib.sha1()
+    h.update(repr(landmask.shape).encode())
+    h.update(np.ascontiguousarray(landmask, dtype=np.bool_).tobytes())
+    return h.hexdigest()
+
+def parse_date(date):
+    return datetime.datetime.strptime(str(date), '%Y-%m-%d').date()
+
+class ForcingStoreWriter(object):
+    """Class to write a forcing store. The store is written to
+    a temporary file, which is renamed when it is closed, so
+    that an incomplete store is never read by the model.
+    """
+    def __init__(self, filename, names, meteo_key, landmask, startTime, nrOfTimeSteps, chunk_size = 32):
+        self.filename = filename
+        self.tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+        nCell = int(np.sum(landmask))
+        chunk_size = max(1, min(chunk_size, nrOfTimeSteps))
+        self.netcdf = nc.Dataset(self.tmp_filename, 'w', format='NETCDF4')
+        self.netcdf.setncattr('store_format', store_format)
+        self.netcdf.setncattr('meteo_key', meteo_key)
+        self.netcdf.setncattr('landmask_key', get_landmask_key(landmask))
+        self.netcdf.setncattr('start_date', '%04i-%02i-%02i' % (startTime.year, startTime.month, startTime.day))
+        self.netcdf.createDimension('time', nrOfTimeSteps)
+        self.netcdf.createDimension('cell', nCell)
+        time = self.netcdf.createVariable('time', 'i4', ('time',))
+        time.units = 'days since %04i-%02i-%02i' % (startTime.year, startTime.month, startTime.day)
+        time.calendar = 'standard'
+        time[:] = np.arange(nrOfTimeSteps)
+        for name in names:
+            self.netcdf.createVariable(
+                name,
+                'f8',
+                ('time', 'cell'),
+                chunksizes=(chunk_size, nCell))
+
+    def write(self, index, data):
+        """Function to write the forcing data (a dictionary of
+        arrays with one value for each cell) of a time step"""
+        for name, arr in data.items():
+            self.netcdf.variables[name][index,:] = arr
+
+    def close(self):
+        self.netcdf.close()
+        os.rename(self.tmp_filename, self.filename)
+        logger.info('Forcing store written to ' + self.filename)
+
+class ForcingStore(object):
+    """Class to read the forcing data of a day from a forcing
+    store. Days are read in blocks of whole chunks, which are
+    contiguous in the file.
+    """
+    def __init__(self, filename, block_size = 1):
+        self.filename = filename
+        self.netcdf = nc.Dataset(filename)
+        self.netcdf.set_auto_mask(False)
+        self.start_date = parse_date(self.netcdf.getncattr('start_date'))
+        self.nrOfTimeSteps = len(self.netcdf.dimensions['time'])
+        self.block_size = block_size
+        self.blocks = dict()
+
+    @classmethod
+    def open(cls, filename, names, meteo_section, landmask, startTime, endTime):
+        """Function to open a forcing store, returning None if
+        the store does not exist or does not match the model
+        configuration (in which case the forcing is read from
+        the input files)"""
+        if not os.path.exists(filename):
+            logger.info('Forcing store ' + filename + ' not found: reading forcing from input files')
+            return None
+        store = cls(filename)
+        msg = store.check(names, meteo_section, landmask, startTime, endTime)
+        if msg is not None:
+            logger.warning('Forcing store ' + filename + ' not used: ' + msg)
+            store.close()
+            return None
+        logger.info('Reading meteorological forcing from ' + filename)
+        return store
+
+    def check(self, names, meteo_section, landmask, startTime, endTime):
+        attrs = self.netcdf.ncattrs()
+        if 'store_format' not in attrs or self.netcdf.getncattr('store_format') != store_format:
+            return 'not a forcing store'
+        if self.netcdf.getncattr('meteo_key') != get_meteo_key(meteo_section):
+            return 'written with different [METEO] options or input files'
+        if self.netcdf.getncattr('landmask_key') != get_landmask_key(landmask):
+            return 'written for a different landmask'
+        if any(name not in self.netcdf.variables for name in names):
+            return 'does not contain all forcing variables'
+        end_date = self.start_date + datetime.timedelta(days=self.nrOfTimeSteps - 1)
+        if startTime < self.start_date or endTime > end_date:
+            return 'does not cover the model period'
+        return None
+
+    def set_block_size(self, block_size):
+        self.block_size = max(1, block_size)
+
+    def read(self, name, date):
+        """Function to read a forcing variable for a given
+        date, returning values for the cells in the landmask"""
+        idx = (date - self.start_date).days
+        block = self.blocks.get(name)
+        if block is None or not (block[0] <= idx < block[0] + block[1].shape[0]):
+            block = self.read_block(name, idx)
+            self.blocks[name] = block
+        return block[1][idx - block[0]]
+
+    def read_block(self, name, idx):
+        var = self.netcdf.variables[name]
+        chunk_size = var.chunking()[0]
+        block_size = int(np.ceil(float(self.block_size) / chunk_size)) * chunk_size
+        start = (idx // chunk_size) * chunk_size
+        with vos.get_netcdf_lock(self.filename):
+            arr = var[start:(start + block_size),:]
+        return (start, np.asarray(arr))
+
+    def close(self):
+        self.netcdf.close()
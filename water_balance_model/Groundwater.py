@@ -4,11 +4,11 @@
 # AquaCrop crop growth model
 
 import os
-import time
 import numpy as np
 import hydro_model_builder.Messages
 import VirtualOS as vos
 import datetime as datetime
+from CouplingFileWatcher import CouplingFileWatcher, CouplingFileReader
 import logging
 logger = logging.getLogger(__name__)
 
@@ -35,6 +35,10 @@ class Groundwater(object):
             self.gwFileNC = self._configuration.GROUNDWATER['groundwaterInputFile']
             self.gwVarName = self._configuration.GROUNDWATER['groundwaterVariableName']
             self.gwTimeLag = int(self._configuration.GROUNDWATER['timeLag'])
+            if self.DailyGroundwaterNC:
+                self.coupling_file_reader = CouplingFileReader(
+                    CouplingFileWatcher.from_configuration(self._configuration.GROUNDWATER),
+                    self.read_groundwater_file)
 
             # if the program is configured to read daily groundwater files and
             # the time lag is positive, we also need to read an initial value
@@ -44,9 +48,23 @@ class Groundwater(object):
                 zGW = vos.netcdf2PCRobjCloneWithoutTime(initialGroundwaterLevelNC,
                                                         self.gwVarName,
                                                         cloneMapFileName = self.cloneMap,
-                                                        LatitudeLongitude = True)
-                self.zGW = zGW[self.landmask]
+                                                        LatitudeLongitude = True,
+                                                        landmask = self.landmask)
+                self.zGW = zGW
 
+    def get_groundwater_filename(self, date):
+        tm = date - datetime.timedelta(self.gwTimeLag)
+        # Fill named placeholders (NB we have already checked that
+        # the specified filename contains these placeholders)
+        return self.gwFileNC.format(day=tm.day, month=tm.month, year=tm.year)
+
+    def read_groundwater_file(self, gwFileNC):
+        return vos.netcdf2PCRobjCloneWithoutTime(gwFileNC,
+                                                 self.gwVarName,
+                                                 cloneMapFileName = self.cloneMap,
+                                                 LatitudeLongitude = True,
+                                                 landmask = self.landmask)
+        
     def read(self):
 
         # method for finding time indexes in the groundwater netdf file:
@@ -69,36 +87,19 @@ class Groundwater(object):
                     # a file from a timestep prior to the current simulation. 
                     if not (self._modelTime.isFirstTimestep() & (self.gwTimeLag > 0)):
                         
-                        tm = self._modelTime.currTime - datetime.timedelta(self.gwTimeLag)
-                        day, month, year = tm.day, tm.month, tm.year
-
-                        # Fill named placeholders (NB we have already checked that
-                        # the specified filename contains these placeholders)
-                        gwFileNC = self.gwFileNC.format(day=day, month=month, year=year)
-
-                        # Check whether the file is present in the filesystem; if
-                        # it doesn't, enter a while loop which periodically checks
-                        # whether the file exists. We specify a maximum wait time
-                        # in order to prevent the model hanging if the file never
+                        # Wait until the external model has written the file;
+                        # we specify a maximum wait time (couplingTimeout) in
+                        # order to prevent the model hanging if the file never
                         # materialises.
-                        exists = os.path.exists(gwFileNC)
-                        max_wait_time = 60
-                        wait_time = 0.1
-                        total_wait_time = 0
-                        while exists is False and total_wait_time <= max_wait_time:
-                            time.sleep(wait_time)
-                            exists = os.path.exists(gwFileNC)
-                            total_wait_time += wait_time
-
-                        if not exists:
-                            msg = "groundwater file doesn't exist and maximum wait time exceeded"
-                            raise AQError(msg)
+                        gwFileNC = self.get_groundwater_filename(self._modelTime.currTime)
+                        self.zGW = self.coupling_file_reader.read(gwFileNC)
 
-                        zGW = vos.netcdf2PCRobjCloneWithoutTime(gwFileNC,
-                                                                self.gwVarName,
-                                                                cloneMapFileName = self.cloneMap,
-                                                                LatitudeLongitude = True)
-                        self.zGW = zGW[self.landmask]
+                    # start waiting for (and reading) the file for the next
+                    # time step while the rest of this time step is computed
+                    if not self._modelTime.isLastTimeStep():
+                        tomorrow = self._modelTime.currTime + datetime.timedelta(1)
+                        self.coupling_file_reader.request(
+                            self.get_groundwater_filename(tomorrow))
                         
                 else:
                     zGW = vos.netcdf2PCRobjClone(self.gwFileNC,
@@ -106,15 +107,17 @@ class Groundwater(object):
                                                  str(currTimeStep.fulldate),
                                                  useDoy = method_for_time_index,
                                                  cloneMapFileName = self.cloneMap,
-                                                 LatitudeLongitude = True)
-                    self.zGW = zGW[self.landmask]
+                                                 LatitudeLongitude = True,
+                                                 landmask = self.landmask)
+                    self.zGW = zGW
                     
             else:
                 zGW = vos.netcdf2PCRobjCloneWithoutTime(self.gwFileNC,
                                                         self.gwVarName,
                                                         cloneMapFileName = self.cloneMap,
-                                                        LatitudeLongitude = True)    
-                self.zGW = zGW[self.landmask]
+                                                        LatitudeLongitude = True,
+                                                        landmask = self.landmask)
+                self.zGW = zGW
                     
     def dynamic(self):
         self.read()
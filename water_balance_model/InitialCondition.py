@@ -5,7 +5,6 @@
 #
 import os
 import numpy as np
-import pcraster as pcr
 import VirtualOS as vos
 import netCDF4 as nc
 import datetime as datetime
@@ -18,9 +17,6 @@ class InitialCondition(object):
         self.var = InitialCondition_variable
 
     def initial_water_content(self):
-        landmask = np.broadcast_to(
-            self.var.landmask,
-            (self.var.nLayer, self.var.nLat, self.var.nLon))
         self.var.initialConditionFileNC = str(
             self.var._configuration.INITIAL_CONDITIONS['initialConditionInputFile'])
         self.var.initialConditionVarName = str(
@@ -28,9 +24,8 @@ class InitialCondition(object):
         th = vos.netcdf2PCRobjCloneWithoutTime(
             self.var.initialConditionFileNC,
             self.var.initialConditionVarName,
-            cloneMapFileName=self.var.cloneMap)
-        
-        th = th[landmask].reshape(self.var.nLayer, self.var.nCell)
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         self.var.th = np.broadcast_to(
             th[None,None,...],
             (self.var.nFarm, self.var.nCrop, self.var.nLayer, self.var.nCell)).copy()
@@ -14,6 +14,8 @@ from FarmParameters import *
 from IrrigationParameters import *
 from FieldManagementParameters import *
 from PriceData import *
+from StaticParameterPack import StaticParameterPack
+from AnnualReadAhead import AnnualReadAhead
 
 class BaseClass(object):
     def __init__(self, var, configuration):
@@ -35,8 +37,24 @@ class CoverFraction(BaseClass):
         self.coverFractionNC = str(self.configuration['landCoverFractionInputFile'])
         self.coverFractionVarName = str(self.configuration['landCoverFractionVariableName'])
         self.var.coverFraction = np.zeros((self.var.nCell))
+        self.cover_fraction_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            self.read_cover_fraction)
         self.update_cover_fraction()
         
+    def read_cover_fraction(self, year):
+        date = datetime.datetime(year, 1, 1, 0, 0, 0)
+        cover_fraction = vos.netcdf2PCRobjClone(
+            self.coverFractionNC.format(day=1, month=1, year=year),
+            self.coverFractionVarName,
+            date,
+            # useDoy = method_for_time_index,
+            # cloneMapAttributes = self.cloneMapAttributes,
+            cloneMapFileName = self.var.cloneMap,
+            LatitudeLongitude = True,
+            landmask = self.var.landmask)
+        return cover_fraction
+        
     def update_cover_fraction(self):
         
         # TODO: make flexible the day on which land cover is changed
@@ -45,18 +63,8 @@ class CoverFraction(BaseClass):
         start_of_year = (self.var._modelTime.doy == 1)
         if self.dynamicLandCover:
             if start_of_model_run or start_of_year:
-                date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)
-                self.var.coverFraction = vos.netcdf2PCRobjClone(
-                    self.coverFractionNC.format(
-                        day=self.var._modelTime.currTime.day,
-                        month=self.var._modelTime.currTime.month,
-                        year=self.var._modelTime.currTime.year),
-                    self.coverFractionVarName,
-                    date,
-                    # useDoy = method_for_time_index,
-                    # cloneMapAttributes = self.cloneMapAttributes,
-                    cloneMapFileName = self.var.cloneMap,
-                    LatitudeLongitude = True)[self.var.landmask]
+                self.var.coverFraction = self.cover_fraction_reader.get(self.var._modelTime.year)
+            self.cover_fraction_reader.update()
         else:
             if start_of_model_run:
                 date = datetime.datetime(self.staticLandCoverYear, 1, 1, 0, 0, 0)
@@ -70,7 +78,8 @@ class CoverFraction(BaseClass):
                     # useDoy = method_for_time_index,
                     # cloneMapAttributes = self.cloneMapAttributes,
                     cloneMapFileName = self.var.cloneMap,
-                    LatitudeLongitude = True)[self.var.landmask]
+                    LatitudeLongitude = True,
+                    landmask = self.var.landmask)
                 
     def dynamic(self):
         self.update_cover_fraction()
@@ -100,7 +109,9 @@ class CropCoefficient(BaseClass):
                 # useDoy = method_for_time_index,
                 # cloneMapAttributes = self.cloneMapAttributes,
                 cloneMapFileName = self.var.cloneMap,
-                LatitudeLongitude = True)[self.var.landmask]
+                LatitudeLongitude = True,
+                landmask = self.var.landmask,
+                cache = True)
         
     def dynamic(self):
         self.update_crop_coefficient()
@@ -140,25 +151,28 @@ class InterceptionCapacity(MinimumInterceptionCapacity):
                     # useDoy = method_for_time_index,
                     # cloneMapAttributes = self.cloneMapAttributes,
                     cloneMapFileName = self.var.cloneMap,
-                    LatitudeLongitude = True)[self.var.landmask]
+                    LatitudeLongitude = True,
+                    landmask = self.var.landmask,
+                    cache = True)
         self.var.interception_capacity = self.var.interception_capacity.clip(self.var.minInterceptCap, None)
         
     def dynamic(self):
         self.update_intercept_capacity()
 
 class RootFraction(BaseClass):
+    static_parameters = ('root_fraction',)
+
     def initial(self):
         self.rootFractionNC = str(self.configuration['rootFractionInputFile'])
         self.rootFractionVarName = str(self.configuration['rootFractionVariableName'])                
         self.read_root_fraction()
         
     def read_root_fraction(self):
-        landmask = np.broadcast_to(self.var.landmask, (2, self.var.nLat, self.var.nLon))
         root_fraction = vos.netcdf2PCRobjCloneWithoutTime(
             self.rootFractionNC,
             self.rootFractionVarName,
-            cloneMapFileName = self.var.cloneMap)
-        root_fraction = root_fraction[landmask].reshape(2,self.var.nCell)
+            cloneMapFileName = self.var.cloneMap,
+            landmask = self.var.landmask)
         root_fraction = np.broadcast_to(
             root_fraction[None,None,:,:],
             (self.var.nFarm, self.var.nCrop, 2, self.var.nCell))
@@ -185,6 +199,8 @@ class RootFraction(BaseClass):
         pass
 
 class MaxRootDepth(BaseClass):
+    static_parameters = ('max_root_depth', 'root_depth')
+
     def initial(self):
         self.var.max_root_depth = np.ones((self.var.nCell)) * 1.
 
@@ -230,9 +246,9 @@ class MaxRootDepthFromFile(MaxRootDepth):
         max_root_depth = vos.netcdf2PCRobjCloneWithoutTime(
             self.maxRootDepthNC,
             self.maxRootDepthVarName,
-            cloneMapFileName = self.var.cloneMap)  # nlat, nlon
-        max_root_depth = max_root_depth[self.var.landmask]
-        max_root_depth *= self.var.soildepth_factor  # CALIBRATION
+            cloneMapFileName = self.var.cloneMap,
+            landmask = self.var.landmask)
+        max_root_depth = max_root_depth * self.var.soildepth_factor  # CALIBRATION
         self.var.max_root_depth = np.broadcast_to(
             max_root_depth[None,None,:],
             (self.var.nFarm, self.var.nCrop, self.var.nCell))
@@ -254,6 +270,7 @@ class MaxRootDepthDynamic(MaxRootDepth):
 class LandCoverParameters(object):
     def __init__(self, LandCoverParameters_variable, config_section_name):
         self.var = LandCoverParameters_variable
+        self.config_section_name = config_section_name
         self.configuration = getattr(
             self.var._configuration,
             config_section_name)
@@ -269,9 +286,11 @@ class SealedLandParameters(LandCoverParameters):
         self.cover_fraction_module = CoverFraction(var, self.configuration)
         self.intercept_capacity_module = MinimumInterceptionCapacity(var, self.configuration)        
     def initial(self):
-        self.topo_parameters_module.initial()
+        pack = StaticParameterPack.from_configuration(self.var, self.config_section_name)
+        pack.run('topo', self.topo_parameters_module.initial, self.topo_parameters_module.static_parameters)
         self.cover_fraction_module.initial()
         self.intercept_capacity_module.initial()
+        pack.save()
     def dynamic(self):
         self.cover_fraction_module.dynamic()
         self.intercept_capacity_module.dynamic()
@@ -292,15 +311,17 @@ class NaturalVegetationParameters(LandCoverParameters):
         self.field_mgmt_parameters_module = FieldManagementParameters(var, self.configuration)
 
     def initial(self):
-        self.soil_parameters_module.initial()
-        self.topo_parameters_module.initial()
+        pack = StaticParameterPack.from_configuration(self.var, self.config_section_name)
+        pack.run('soil', self.soil_parameters_module.initial, self.soil_parameters_module.static_parameters)
+        pack.run('topo', self.topo_parameters_module.initial, self.topo_parameters_module.static_parameters)
         self.cover_fraction_module.initial()
         self.crop_coefficient_module.initial()
         self.intercept_capacity_module.initial()
-        self.root_depth_module.initial()
-        self.root_fraction_module.initial()
+        pack.run('root_depth', self.root_depth_module.initial, self.root_depth_module.static_parameters)
+        pack.run('root_fraction', self.root_fraction_module.initial, self.root_fraction_module.static_parameters)
         self.field_mgmt_parameters_module.initial()
-        self.soil_parameters_module.compute_soil_hydraulic_parameters()
+        pack.run('soil_hydraulic', self.soil_parameters_module.compute_soil_hydraulic_parameters, self.soil_parameters_module.hydraulic_parameters)
+        pack.save()
 
     def dynamic(self):
         self.soil_parameters_module.dynamic()
@@ -323,16 +344,18 @@ class ManagedLandParameters(LandCoverParameters):
         self.irrigation_parameters_module = IrrigationParameters(var, config_section_name)
 
     def initial(self):
-        self.soil_parameters_module.initial()
-        self.topo_parameters_module.initial()
+        pack = StaticParameterPack.from_configuration(self.var, self.config_section_name)
+        pack.run('soil', self.soil_parameters_module.initial, self.soil_parameters_module.static_parameters)
+        pack.run('topo', self.topo_parameters_module.initial, self.topo_parameters_module.static_parameters)
         self.cover_fraction_module.initial()
         self.crop_coefficient_module.initial()
         self.intercept_capacity_module.initial()
-        self.root_depth_module.initial()
-        self.root_fraction_module.initial()
+        pack.run('root_depth', self.root_depth_module.initial, self.root_depth_module.static_parameters)
+        pack.run('root_fraction', self.root_fraction_module.initial, self.root_fraction_module.static_parameters)
         self.field_mgmt_parameters_module.initial()
         self.irrigation_parameters_module.initial()
-        self.soil_parameters_module.compute_soil_hydraulic_parameters()
+        pack.run('soil_hydraulic', self.soil_parameters_module.compute_soil_hydraulic_parameters, self.soil_parameters_module.hydraulic_parameters)
+        pack.save()
 
     def dynamic(self):
         self.soil_parameters_module.dynamic()
@@ -363,8 +386,11 @@ class ManagedLandWithFarmerBehaviourParameters(LandCoverParameters):
         self.irrigation_parameters_module = IrrigationParameters(var, config_section_name)
 
     def initial(self):
-        self.soil_parameters_module.initial()
-        self.topo_parameters_module.initial()
+        # the root depth of this land cover changes during the
+        # growing season, so only soil and topography are packed
+        pack = StaticParameterPack.from_configuration(self.var, self.config_section_name)
+        pack.run('soil', self.soil_parameters_module.initial, self.soil_parameters_module.static_parameters)
+        pack.run('topo', self.topo_parameters_module.initial, self.topo_parameters_module.static_parameters)
         self.cover_fraction_module.initial()
 
         self.farm_parameters_module.initial()
@@ -381,6 +407,7 @@ class ManagedLandWithFarmerBehaviourParameters(LandCoverParameters):
         self.field_mgmt_parameters_module.initial()
         self.irrigation_parameters_module.initial()
         self.soil_parameters_module.compute_soil_hydraulic_parameters()
+        pack.save()
 
     def dynamic(self):
         self.soil_parameters_module.dynamic()
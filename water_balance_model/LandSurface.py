@@ -3,7 +3,6 @@
 
 import os
 import numpy as np
-import pcraster as pcr
 import VirtualOS as vos
 from Model import Model
 
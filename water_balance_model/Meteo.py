@@ -5,9 +5,21 @@ import os
 # from pcraster.framework import *
 # import pcraster as pcr
 import string
+import math
+import time
+import datetime
+import threading
 import numpy as np
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import hydro_model_builder.Messages
 import VirtualOS as vos
+from ForcingStore import ForcingStore
+from ForcingCache import ForcingCache
 # from OutputNetCDF import *
 # import ETPFunctions as refPotET
 
@@ -16,17 +28,24 @@ logger = logging.getLogger(__name__)
 
 class Meteo(object):
 
-    def __init__(self, Meteo_variable):
+    def __init__(self, Meteo_variable, use_forcing_store = True):
         self._configuration = Meteo_variable._configuration
         self._modelTime = Meteo_variable._modelTime
         self.cloneMapAttributes = Meteo_variable.cloneMapAttributes
         self.cloneMap = Meteo_variable.cloneMap
         self.landmask = Meteo_variable.landmask
+        self.use_forcing_store = use_forcing_store
 
     def initial(self):
         self.set_input_filenames()
+        self.set_forcing_store()
         self.set_nc_variable_names()
         self.set_meteo_conversion_factors()
+        self.set_forcing_variables()
+        self.set_forcing_cache()
+        self.set_block_read_options()
+        self.set_concurrent_read_options()
+        self.set_prefetch_options()
         # TODO: find out if we can delete this
         # # daily time step
         # self.usingDailyTimeStepForcingData = False
@@ -59,13 +78,35 @@ class Meteo(object):
                     msg = 'Filename ' + filename + ' contains invalid format arguments: only day, month and year are allowable'
                     raise Messages.AQError(msg)
                 
+    def set_forcing_store(self):
+        """Function to open the forcing store written by
+        ingest_forcing.py, if there is one for this
+        configuration. The forcing data in the store have 
+        been converted already."""
+        self.forcing_store = None
+        if not self.use_forcing_store:
+            return
+        if 'forcingStore' in self._configuration.METEO:
+            filename = str(self._configuration.METEO['forcingStore'])
+            if filename != 'None':
+                self.forcing_store = ForcingStore.open(
+                    filename,
+                    ['precipitation', 'tmin', 'tmax', 'tavg', 'referencePotET'],
+                    self._configuration.METEO,
+                    self.landmask,
+                    self._modelTime.startTime,
+                    self._modelTime.endTime)
+        
     def set_nc_variable_names(self):
         self.preVarName = self._configuration.METEO['precipitationVariableName']
         self.tminVarName = self._configuration.METEO['minDailyTemperatureVariableName']
         self.tmaxVarName = self._configuration.METEO['maxDailyTemperatureVariableName']
         self.tavgVarName = self._configuration.METEO['avgDailyTemperatureVariableName']
         self.refETPotVarName = self._configuration.METEO['refETPotVariableName']
-        self.check_nc_variable_names()
+        # the input files are not needed if the forcing is
+        # read from a forcing store
+        if self.forcing_store is None:
+            self.check_nc_variable_names()
         
     def check_nc_variable_names(self):
         # filenames = [self.preFileNC, self.tmpFileNC, self.tmpFileNC, self.etpFileNC]
@@ -116,6 +157,155 @@ class Meteo(object):
         if 'ETpotFactor' in self._configuration.METEO:
             self.etrefFactor = np.float64(self._configuration.METEO['refETPotFactor'])
         
+    def set_forcing_variables(self):
+        """Function to define the input file and netCDF 
+        variable name of each forcing variable"""
+        self.forcing_variables = OrderedDict([
+            ('precipitation', (self.preFileNC, self.preVarName)),
+            ('tmin', (self.minDailyTemperatureNC, self.tminVarName)),
+            ('tmax', (self.maxDailyTemperatureNC, self.tmaxVarName)),
+            ('tavg', (self.avgDailyTemperatureNC, self.tavgVarName)),
+            ('referencePotET', (self.etpFileNC, self.refETPotVarName))
+        ])
+        # files without date placeholders are read every time 
+        # step, so keep them open
+        if self.forcing_store is None:
+            for ncFile, varName in self.forcing_variables.values():
+                if len(vos.get_format_args(ncFile)) == 0:
+                    vos.filecache.pin(ncFile)
+
+    def set_forcing_cache(self):
+        self.forcing_cache = None
+        if self.forcing_store is None:
+            self.forcing_cache = ForcingCache.from_configuration(self)
+            
+    def read_forcing_variable(self, name, date):
+        """Function to read a forcing variable for a given 
+        date, returning values for the cells in the landmask"""
+        if self.forcing_store is not None:
+            return self.forcing_store.read(name, date)
+        ncFile, varName = self.forcing_variables[name]
+        ncFile = ncFile.format(day=date.day, month=date.month, year=date.year)
+        datestr = '%04i-%02i-%02i' % (date.year, date.month, date.day)
+        if self.forcing_cache is not None:
+            arr = self.forcing_cache.read(ncFile, varName, datestr)
+            if arr is not None:
+                return arr
+        if name in self.block_readers:
+            return self.block_readers[name].read(date)
+        method_for_time_index = None
+        return vos.netcdf2PCRobjClone(
+            ncFile,
+            varName,
+            datestr,
+            useDoy = method_for_time_index,
+            cloneMapAttributes = self.cloneMapAttributes,
+            cloneMapFileName = self.cloneMap,
+            LatitudeLongitude = True,
+            landmask = self.landmask)
+
+    def read_forcing_data(self, date):
+        """Function to read all forcing variables for a 
+        given date. If a thread pool is available the 
+        variables are read concurrently."""
+        names = list(self.forcing_variables.keys())
+        if self.read_pool is not None:
+            data = self.read_pool.map(
+                lambda name: self.read_forcing_variable(name, date),
+                names)
+        else:
+            data = [self.read_forcing_variable(name, date) for name in names]
+        return dict(zip(names, data))
+
+    def set_block_read_options(self):
+        """Function to decide how each forcing variable is read 
+        from file. Unless a block size is configured, variables 
+        whose chunks span several days are read in blocks of 
+        whole chunks (see vos.ReadPlan). Blocks are limited to 
+        max_block_size days."""
+        self.block_size = 0
+        if 'forcingBlockSize' in self._configuration.METEO:
+            self.block_size = int(self._configuration.METEO['forcingBlockSize'])
+        self.max_block_size = 366
+        if 'forcingMaxBlockSize' in self._configuration.METEO:
+            self.max_block_size = max(1, int(self._configuration.METEO['forcingMaxBlockSize']))
+        self.block_readers = dict()
+        if self.forcing_store is not None:
+            self.forcing_store.set_block_size(self.block_size)
+            return
+        read_plans = self.get_read_plans()
+        if self.block_size > 1:
+            self.block_readers = dict(
+                (name, ForcingBlockReader(self, ncFile, varName, self.block_size, self.max_block_size))
+                for name, (ncFile, varName) in self.forcing_variables.items())
+            logger.info('Reading meteorological forcing in blocks of %i days', self.block_size)
+        elif self.block_size == 0:
+            for name, (ncFile, varName) in self.forcing_variables.items():
+                plan = read_plans[name]
+                if plan.strategy == 'block':
+                    self.block_readers[name] = ForcingBlockReader(
+                        self, ncFile, varName, plan.time_chunk_size, self.max_block_size)
+
+    def get_read_plans(self):
+        """Function to get the read plan of each forcing 
+        variable (for the files of the first day), logging the
+        expected read amplification"""
+        date = self._modelTime.startTime
+        read_plans = dict()
+        for name, (ncFile, varName) in self.forcing_variables.items():
+            ncFile = ncFile.format(day=date.day, month=date.month, year=date.year)
+            plan = vos.get_read_plan(
+                ncFile,
+                varName,
+                cloneMapFileName = self.cloneMap,
+                cloneMapAttributes = self.cloneMapAttributes)
+            logger.info('Forcing variable ' + name + ' (' + ncFile + '): ' + plan.describe())
+            if plan.rechunk:
+                logger.warning(
+                    'Chunks of ' + ncFile + ' are much larger than the model domain; '
+                    'consider rechunking the file, e.g.: ' + plan.suggest_rechunk(ncFile))
+            read_plans[name] = plan
+        return read_plans
+            
+    def set_concurrent_read_options(self):
+        self.read_threads = 1
+        if 'forcingReadThreads' in self._configuration.METEO:
+            self.read_threads = int(self._configuration.METEO['forcingReadThreads'])
+        self.read_pool = None
+        self.forcing_data = None
+        if self.read_threads > 1:
+            if vos.netcdf_thread_safe:
+                self.read_pool = ThreadPool(
+                    min(self.read_threads, len(self.forcing_variables)))
+                logger.info('Reading meteorological forcing with %i threads', self.read_threads)
+            else:
+                logger.warning(
+                    'netCDF library is not declared thread-safe '
+                    '(threadSafeNetCDF in [globalOptions]): '
+                    'meteorological forcing is read serially')
+
+    def set_prefetch_options(self):
+        self.prefetch_depth = 0
+        if 'prefetchDepth' in self._configuration.METEO:
+            self.prefetch_depth = int(self._configuration.METEO['prefetchDepth'])
+        self.prefetcher = None
+        if self.prefetch_depth > 0:
+            dates = [
+                self._modelTime.startTime + datetime.timedelta(days=day)
+                for day in range(self._modelTime.nrOfTimeSteps)]
+            self.prefetcher = ForcingPrefetcher(
+                self.read_forcing_data,
+                dates,
+                self.prefetch_depth)
+            self.prefetcher.start()
+            logger.info('Prefetching meteorological forcing %i days ahead', self.prefetch_depth)
+
+    def get_forcing_data(self, name):
+        if self.forcing_data is not None:
+            return self.forcing_data.pop(name)
+        else:
+            return self.read_forcing_variable(name, self._modelTime.currTime)
+        
     def adjust_precipitation_input_data(self):
         # TODO: proper unit conversion
         self.precipitation = self.preConst + self.preFactor * self.precipitation * 0.001  # mm -> m
@@ -124,19 +314,9 @@ class Meteo(object):
         self.precipitation = np.floor(self.precipitation * 100000.)/100000.
 
     def read_precipitation_data(self):
-        method_for_time_index = None
-        self.precipitation = vos.netcdf2PCRobjClone(
-            self.preFileNC.format(
-                day=self._modelTime.currTime.day,
-                month=self._modelTime.currTime.month,
-                year=self._modelTime.currTime.year),
-            self.preVarName,
-            str(self._modelTime.fulldate),
-            useDoy = method_for_time_index,
-            cloneMapAttributes = self.cloneMapAttributes,
-            cloneMapFileName = self.cloneMap,
-            LatitudeLongitude = True)[self.landmask][None,None,:]
-        self.adjust_precipitation_input_data()
+        self.precipitation = self.get_forcing_data('precipitation')[None,None,:]
+        if self.forcing_store is None:
+            self.adjust_precipitation_input_data()
 
     def adjust_temperature_data(self):
         self.tmin = self.tminConst + self.tminFactor * self.tmin
@@ -147,71 +327,171 @@ class Meteo(object):
         self.tavg = np.round(self.tavg * 1000.) / 1000.
         
     def read_temperature_data(self):
-        method_for_time_index = None        
-        self.tmin = vos.netcdf2PCRobjClone(
-            self.minDailyTemperatureNC.format(
-                day=self._modelTime.currTime.day,
-                month=self._modelTime.currTime.month,
-                year=self._modelTime.currTime.year),
-            self.tminVarName,
-            str(self._modelTime.fulldate),
-            useDoy = method_for_time_index,
-            cloneMapAttributes = self.cloneMapAttributes,
-            cloneMapFileName = self.cloneMap,
-            LatitudeLongitude = True)[self.landmask][None,None,:]
-
-        self.tmax = vos.netcdf2PCRobjClone(
-            self.maxDailyTemperatureNC.format(
-                day=self._modelTime.currTime.day,
-                month=self._modelTime.currTime.month,
-                year=self._modelTime.currTime.year),
-            self.tmaxVarName,
-            str(self._modelTime.fulldate),
-            useDoy = method_for_time_index,
-            cloneMapAttributes = self.cloneMapAttributes,
-            cloneMapFileName = self.cloneMap,
-            LatitudeLongitude = True)[self.landmask][None,None,:]
-
-        self.tavg = vos.netcdf2PCRobjClone(
-            self.avgDailyTemperatureNC.format(
-                day=self._modelTime.currTime.day,
-                month=self._modelTime.currTime.month,
-                year=self._modelTime.currTime.year),
-            self.tavgVarName,
-            str(self._modelTime.fulldate),
-            useDoy = method_for_time_index,
-            cloneMapAttributes = self.cloneMapAttributes,
-            cloneMapFileName = self.cloneMap,
-            LatitudeLongitude = True)[self.landmask][None,None,:]
-        
-        self.adjust_temperature_data()
+        self.tmin = self.get_forcing_data('tmin')[None,None,:]
+        self.tmax = self.get_forcing_data('tmax')[None,None,:]
+        self.tavg = self.get_forcing_data('tavg')[None,None,:]
+        if self.forcing_store is None:
+            self.adjust_temperature_data()
 
     def adjust_reference_ET_data(self):
         # TODO: unit conversion
         self.referencePotET = self.etrefConst + self.etrefFactor * self.referencePotET * 0.001  # mm -> m
 
     def read_reference_ET_data(self):
-        method_for_time_index = None
-        self.referencePotET = vos.netcdf2PCRobjClone(
-            self.etpFileNC.format(
-                day=self._modelTime.currTime.day,
-                month=self._modelTime.currTime.month,
-                year=self._modelTime.currTime.year),
-            self.refETPotVarName,
-            str(self._modelTime.fulldate), 
-            useDoy = method_for_time_index,
-            cloneMapAttributes = self.cloneMapAttributes,
-            cloneMapFileName=self.cloneMap,
-            LatitudeLongitude = True)[self.landmask][None,None,:]
-        self.adjust_reference_ET_data()
+        self.referencePotET = self.get_forcing_data('referencePotET')[None,None,:]
+        if self.forcing_store is None:
+            self.adjust_reference_ET_data()
         
     def read_reference_EW_data(self):
         # **TODO**
         self.EWref = self.referencePotET.copy()
-        
+
+    def report_prefetch_wait_time(self):
+        if self.prefetcher is not None:
+            logger.info(
+                'Model waited %.2f s for prefetched meteorological forcing (%i days)',
+                self.prefetcher.wait_time,
+                self.prefetcher.count)
+            
+    def close(self):
+        """Function to release the resources used to read the
+        forcing at the end of the run"""
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        if self.read_pool is not None:
+            self.read_pool.close()
+            self.read_pool.join()
+            self.read_pool = None
+        if self.forcing_store is not None:
+            self.forcing_store.close()
+            self.forcing_store = None
+
     def dynamic(self):
+        if self.prefetcher is not None:
+            self.forcing_data = self.prefetcher.get(self._modelTime.currTime)
+        elif self.read_pool is not None:
+            self.forcing_data = self.read_forcing_data(self._modelTime.currTime)
         self.read_precipitation_data()
         self.read_temperature_data()
         self.read_reference_ET_data()
         self.read_reference_EW_data()  # for open water evaporation
+        if self._modelTime.endYear or self._modelTime.isLastTimeStep():
+            self.report_prefetch_wait_time()
+
+class ForcingBlockReader(object):
+    """Class to read a forcing variable in blocks of time 
+    steps. Each block is read as one hyperslab, aligned to the
+    chunking of the time dimension in the file, and is 
+    resampled and compressed to the landmask once. Daily 
+    values are then served from memory. Blocks hold at most
+    'max_block_size' time steps, even if a chunk spans more
+    (e.g. a file chunked along its whole time axis).
+    """
+    def __init__(self, meteo, ncFile, varName, block_size, max_block_size = 366):
+        self.cloneMap = meteo.cloneMap
+        self.cloneMapAttributes = meteo.cloneMapAttributes
+        self.landmask = meteo.landmask
+        self.ncFile = ncFile
+        self.varName = varName
+        self.block_size = block_size
+        self.max_block_size = max_block_size
+        self.limited = False
+        self.block = None
+        self.block_ncFile = None
+        self.block_start = 0
+        self.block_end = 0
+
+    def read(self, date):
+        ncFile = self.ncFile.format(day=date.day, month=date.month, year=date.year)
+        idx = vos.get_nc_time_index(
+            ncFile,
+            self.varName,
+            '%04i-%02i-%02i' % (date.year, date.month, date.day))
+        if ncFile != self.block_ncFile or not (self.block_start <= idx < self.block_end):
+            self.read_block(ncFile, idx)
+        return self.block[idx - self.block_start]
+
+    def read_block(self, ncFile, idx):
+        chunk_size = vos.get_time_chunk_size(ncFile, self.varName)
+        block_size = int(math.ceil(float(self.block_size) / chunk_size)) * chunk_size
+        start = (idx // chunk_size) * chunk_size
+        if block_size > self.max_block_size:
+            if not self.limited:
+                logger.info(
+                    'Reading %s from %s in blocks of %i time steps (forcingMaxBlockSize) instead of %i',
+                    self.varName, ncFile, self.max_block_size, block_size)
+                self.limited = True
+            block_size = self.max_block_size
+            start = (idx // block_size) * block_size
+        self.block = vos.netcdf2NumPyTimeIndexRange(
+            ncFile,
+            self.varName,
+            start,
+            start + block_size,
+            cloneMapFileName = self.cloneMap,
+            cloneMapAttributes = self.cloneMapAttributes,
+            LatitudeLongitude = True,
+            landmask = self.landmask)
+        self.block_ncFile = ncFile
+        self.block_start = start
+        self.block_end = start + self.block.shape[0]
+        
+class ForcingPrefetcher(object):
+    """Class to read forcing data ahead of the model in a 
+    background thread. Data for each date are placed in a 
+    bounded queue, so that at most 'depth' days are held in
+    memory at any time.
+    """
+    def __init__(self, read_function, dates, depth):
+        self.read_function = read_function
+        self.dates = dates
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.wait_time = 0.
+        self.count = 0
+
+    def start(self):
+        self.thread.start()
 
+    def run(self):
+        for date in self.dates:
+            if self.stopped.is_set():
+                return
+            try:
+                data = self.read_function(date)
+            except Exception as error:
+                logger.exception('Error prefetching forcing data for %s', date)
+                self.queue.put((date, None, error))
+                return
+            self.queue.put((date, data, None))
+
+    def get(self, date):
+        """Function to get the forcing data for a given date,
+        blocking until it is available"""
+        t0 = time.time()
+        prefetched_date, data, error = self.queue.get()
+        self.wait_time += time.time() - t0
+        self.count += 1
+        if error is not None:
+            raise error
+        if prefetched_date != date:
+            raise ValueError(
+                'Prefetched forcing data are for ' + str(prefetched_date)
+                + ', but data for ' + str(date) + ' were requested')
+        return data
+    
+    def stop(self):
+        """Function to stop the background thread, waiting 
+        until it has finished reading the current date"""
+        self.stopped.set()
+        # take data from the queue, so that the thread is not
+        # blocked waiting for room in it
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        
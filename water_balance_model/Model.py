@@ -7,9 +7,11 @@ import sys
 import math
 import gc
 import numpy as np 
-import pcraster as pcr
 import VirtualOS as vos
 
+import logging
+logger = logging.getLogger(__name__)
+
 # TODO:
 # class Model(object)
 # class GriddedModel(Model)
@@ -20,15 +22,35 @@ class Model(object):
     def __init__(self, configuration, modelTime, initialState = None):                
         self._configuration = configuration
         self._modelTime = modelTime
+        self.set_netcdf_options()
         self.set_clone_map()
         self.set_landmask()
         self.set_grid_cell_area()
         self.get_model_dimensions()
         
+    def set_netcdf_options(self):
+        thread_safe = False
+        if 'threadSafeNetCDF' in self._configuration.globalOptions:
+            thread_safe = bool(int(self._configuration.globalOptions['threadSafeNetCDF']))
+        vos.set_netcdf_thread_safe(thread_safe)
+        if 'maxOpenFiles' in self._configuration.globalOptions:
+            vos.filecache.set_capacity(int(self._configuration.globalOptions['maxOpenFiles']))
+        if 'fieldCacheSize' in self._configuration.globalOptions:
+            vos.fieldcache.set_max_bytes(
+                int(float(self._configuration.globalOptions['fieldCacheSize']) * 1024 ** 2))
+        
     def set_clone_map(self):
-        # TODO: REMOVE DEPENDENCY ON PCRASTER
-        pcr.setclone(self._configuration.cloneMap)  # TODO: CHECK IF THIS IS NECESSARY
+        """Function to set the clone map. With the numpy map
+        backend (the default) the clone, coordinates and landmask
+        are read from the map headers and arrays; PCRaster is 
+        only used if mapBackend is set to pcraster."""
+        map_backend = 'numpy'
+        if 'mapBackend' in self._configuration.globalOptions:
+            map_backend = str(self._configuration.globalOptions['mapBackend'])
+        vos.set_map_backend(map_backend)
         self.cloneMap = self._configuration.cloneMap
+        if vos.map_backend == 'pcraster':
+            vos.pcr.setclone(self.cloneMap)
         self.cloneMapAttributes = vos.getMapAttributesALL(self.cloneMap)
 
     def set_landmask(self):
@@ -39,20 +61,52 @@ class Model(object):
             self._configuration.globalOptions['inputDir'],
             True)
         self.landmask = self.landmask > 0
+        self.set_grid_window()
+
+    def set_grid_window(self):
+        """Function to crop the model grid to the bounding box
+        of the landmask (extended by landmaskPadding cells), if
+        cropToLandmask is set. Inputs are then read, and outputs
+        written, for the cropped grid only."""
+        self.ySlice = slice(0, self.landmask.shape[0])
+        self.xSlice = slice(0, self.landmask.shape[1])
+        crop_to_landmask = False
+        if 'cropToLandmask' in self._configuration.globalOptions:
+            crop_to_landmask = bool(int(self._configuration.globalOptions['cropToLandmask']))
+        if not crop_to_landmask:
+            return
+        padding = 0
+        if 'landmaskPadding' in self._configuration.globalOptions:
+            padding = int(self._configuration.globalOptions['landmaskPadding'])
+        self.ySlice, self.xSlice, self.cloneMapAttributes = vos.get_clone_window(
+            self.landmask,
+            self.cloneMapAttributes,
+            padding)
+        logger.info(
+            'Model grid cropped to the landmask: rows %i-%i, columns %i-%i of the clone map',
+            self.ySlice.start, self.ySlice.stop - 1, self.xSlice.start, self.xSlice.stop - 1)
+        self.landmask = self.landmask[self.ySlice, self.xSlice]
+        vos.set_clone_window(self.cloneMap, self.cloneMapAttributes)
 
     def set_grid_cell_area(self):
         grid_cell_area = vos.netcdf2PCRobjCloneWithoutTime(
             str(self._configuration.MASK_OUTLET['gridCellAreaInputFile']),
             str(self._configuration.MASK_OUTLET['gridCellAreaVariableName']),
-            cloneMapFileName = self.cloneMap)
-        self.grid_cell_area = grid_cell_area[self.landmask]
+            cloneMapFileName = self.cloneMap,
+            landmask = self.landmask)
+        self.grid_cell_area = grid_cell_area
 
     def get_model_dimensions(self):
         """Function to set model dimensions"""
+        if vos.map_backend == 'pcraster':
+            latitudes = np.unique(vos.pcr.pcr2numpy(vos.pcr.ycoordinate(self.cloneMap), vos.MV))[::-1]
+            longitudes = np.unique(vos.pcr.pcr2numpy(vos.pcr.xcoordinate(self.cloneMap), vos.MV))
+        else:
+            latitudes, longitudes = vos.get_map_coordinates(vos.getMapAttributesALL(self.cloneMap))
         self.nLat = int(self.cloneMapAttributes['rows'])
-        self.latitudes = np.unique(pcr.pcr2numpy(pcr.ycoordinate(self.cloneMap), vos.MV))[::-1]
+        self.latitudes = latitudes[self.ySlice]
         self.nLon = int(self.cloneMapAttributes['cols'])
-        self.longitudes = np.unique(pcr.pcr2numpy(pcr.xcoordinate(self.cloneMap), vos.MV))
+        self.longitudes = longitudes[self.xSlice]
         self.nCell = int(np.sum(self.landmask))
         self.nLayer = 3         # FIXED        
         self.dimensions = {
@@ -99,6 +99,20 @@ class ModelTime(object):
     def nrOfTimeSteps(self):
         return self._nrOfTimeSteps
     
+    @property
+    def nrOfMonthEnds(self):
+        # number of days in the simulation period which are the
+        # last day of a month
+        end = self._endTime + datetime.timedelta(days=1)
+        return (end.year - self._startTime.year) * 12 + end.month - self._startTime.month
+
+    @property
+    def nrOfYearEnds(self):
+        # number of days in the simulation period which are the
+        # last day of a year
+        end = self._endTime + datetime.timedelta(days=1)
+        return end.year - self._startTime.year
+    
     @property
     def fulldate(self):
         return self._fulldate
@@ -8,22 +8,187 @@ import time
 import re
 import glob
 import subprocess
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import netCDF4 as nc
 import numpy as np
-import pcraster as pcr
 import VirtualOS as vos
 
+from collections import OrderedDict
+from Messages import *
+
+import logging
+logger = logging.getLogger(__name__)
+
 # declare a global variable to hold valid names of time dimension
 valid_time_dimnames = ['time']
 
+# name of the dimension of variables which are compressed by 
+# gathering the cells in the landmask (see compress_by_gathering)
+landpoint_dimname = 'landpoint'
+
+# maximum size (in bytes) of a chunk of an output variable; HDF5
+# does not allow chunks of 4 GiB or more, and large chunks must be
+# read whole when a small part of the variable is read
+max_chunk_bytes = 64 * 1024 ** 2
+
+# OutputNetCDF objects which hold open files, so that all output
+# files can be closed at the end of the run (see close_output_files)
+open_writers = []
+
+# OutputWriter objects with a background thread
+output_writers = []
+
+def close_output_files():
+    """Function to close the output files of all OutputNetCDF
+    objects. This must be called at the end of the run (or when
+    the run is interrupted) to flush data which is not yet 
+    synced to disk. Output which is still queued in an 
+    OutputWriter is written first."""
+    error = None
+    while len(output_writers) > 0:
+        try:
+            output_writers.pop().close()
+        except Exception as e:
+            error = error or e
+    while len(open_writers) > 0:
+        open_writers.pop().close_all()
+    if error is not None:
+        raise error
+
+class OutputWriter(object):
+    """Class to write output to netCDF in a background thread,
+    so that writing (and compressing) output overlaps with the
+    computation of the next time step. Fields are copied when
+    they are queued, because the model updates its arrays in
+    place. The queue holds at most 'queue_size' fields, so that
+    the model waits for the writer if it falls behind. An error
+    in the writer is raised in the model at the next write (or
+    when the writer is closed). If queue_size is zero output is
+    written directly. In both cases the file is written under
+    its netCDF lock (see OutputNetCDF.add_data_to_netcdf).
+    """
+    def __init__(self, netcdfObj, queue_size = 0):
+        self.netcdfObj = netcdfObj
+        self.error = None
+        self.error_raised = False
+        self.wait_time = 0.
+        self.thread = None
+        if queue_size > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            output_writers.append(self)
+
+    @classmethod
+    def from_configuration(cls, netcdfObj, reporting_options):
+        queue_size = 0
+        if 'outputQueueSize' in reporting_options:
+            queue_size = int(reporting_options['outputQueueSize'])
+        return cls(netcdfObj, queue_size)
+
+    def write(self, ncFileName, varname, varField, timeStamp=None):
+        """Function to write a field to netCDF (see 
+        OutputNetCDF.add_data_to_netcdf)"""
+        self.check()
+        if self.thread is None:
+            self.netcdfObj.add_data_to_netcdf(ncFileName, varname, varField, timeStamp)
+            return
+        varField = np.array(varField, copy=True)
+        varField.flags.writeable = False
+        t0 = time.time()
+        self.queue.put((ncFileName, varname, varField, timeStamp))
+        self.wait_time += time.time() - t0
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                # after an error the queue is drained without
+                # writing, so that the model does not block
+                if self.error is None:
+                    self.netcdfObj.add_data_to_netcdf(*item)
+            except Exception as error:
+                logger.exception('Error writing %s to %s', item[1], item[0])
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None and not self.error_raised:
+            self.error_raised = True
+            raise self.error
+
+    def flush(self):
+        """Function to wait until all queued output is written"""
+        if self.thread is not None:
+            self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            logger.info('Model waited %.1f s for the output writer', self.wait_time)
+        if self in output_writers:
+            output_writers.remove(self)
+        self.check()
+
+class TimeChunkBuffer(object):
+    """Class to collect the fields of a variable for up to 
+    'size' consecutive time steps, which are written to netCDF
+    as one hyperslab.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.start = None
+        self.count = 0
+        self.times = None
+        self.fields = None
+
+    def is_next(self, posCnt):
+        return self.count == 0 or posCnt == self.start + self.count
+
+    def add(self, posCnt, time, field):
+        if self.fields is None:
+            self.times = np.zeros(self.size)
+            self.fields = np.zeros((self.size,) + field.shape, dtype=field.dtype)
+        if self.count == 0:
+            self.start = posCnt
+        self.times[self.count] = time
+        self.fields[self.count] = field
+        self.count += 1
+
+    def is_full(self):
+        return self.count == self.size
+
 class OutputNetCDF(object):
     
-    def __init__(self, netcdf_attr, model_dimensions, variable_list):
+    def __init__(self, netcdf_attr, model_dimensions, variable_list, reporting_options = None, landmask = None):
         self.model_dimensions = model_dimensions
         self.variable_list = variable_list
+        self.landmask = landmask
         self.set_netcdf_y_orientation(netcdf_attr)
         self.set_general_netcdf_attributes(netcdf_attr)
         self.set_netcdf_format_options(netcdf_attr)        
+        self.set_netcdf_write_options(reporting_options)
+
+        # files are opened once and kept open for the run, with
+        # the position of the next time step in each file
+        self.datasets = OrderedDict()
+        self.time_cursors = dict()
+        self.writes_since_sync = dict()
+
+        # buffers of the variables in files with a preallocated
+        # time axis, keyed by file and variable name
+        self.buffers = dict()
 
     def set_netcdf_format_options(self, netcdf_attr):
         self.format = 'NETCDF3_CLASSIC'
@@ -34,6 +199,32 @@ class OutputNetCDF(object):
             if netcdf_attr['zlib'] == "True":
                 self.zlib = True
         
+    def set_netcdf_write_options(self, reporting_options):
+        """Function to set the number of writes to a file 
+        after which it is synced to disk (0 = only when the file
+        is closed)"""
+        self.sync_interval = 0
+        if reporting_options is not None and 'syncInterval' in reporting_options:
+            self.sync_interval = int(reporting_options['syncInterval'])
+
+        # number of time steps which are buffered in memory and
+        # written at once to files with a preallocated time axis,
+        # chunked by the same number of time steps (0 = time axis
+        # is unlimited and each time step is written directly)
+        self.time_chunk = 0
+        if reporting_options is not None and 'outputTimeChunk' in reporting_options:
+            self.time_chunk = int(reporting_options['outputTimeChunk'])
+
+        # variables on the lat/lon grid are written for the cells
+        # in the landmask only, using CF compression by gathering
+        # (data are then passed as arrays of land cells, in the 
+        # order of the model)
+        self.compress_by_gathering = False
+        if reporting_options is not None and 'compressByGathering' in reporting_options:
+            self.compress_by_gathering = bool(int(reporting_options['compressByGathering']))
+        if self.compress_by_gathering and self.landmask is None:
+            raise ModelError('compressByGathering requires the landmask')
+
     def set_netcdf_y_orientation(self, netcdf_attr):        
         self.netcdf_y_orientation_follow_cf_convention = False
         if 'netcdf_y_orientation_follow_cf_convention' in netcdf_attr.keys():
@@ -48,15 +239,16 @@ class OutputNetCDF(object):
         self.attributeDictionary['title'      ] = netcdf_attr['title'      ]
         self.attributeDictionary['description'] = netcdf_attr['description']
         
-    def add_dimension_time(self, netcdf, dimname, dimvar):
-        """Function to add a time dimension to a netCDF file"""
+    def add_dimension_time(self, netcdf, dimname, dimvar, size=None):
+        """Function to add a time dimension to a netCDF file, 
+        which is unlimited unless 'size' is given"""
         shortname = self.variable_list.netcdf_short_name[dimname]
         try:
             datatype = self.variable_list.netcdf_datatype[dimname]
         except:
             datatype = 'f4'
         dimensions = self.variable_list.netcdf_dimensions[dimname]
-        netcdf.createDimension(shortname, None)
+        netcdf.createDimension(shortname, size)
         var = netcdf.createVariable(
             shortname,
             datatype,
@@ -108,21 +300,55 @@ class OutputNetCDF(object):
         var.units = self.variable_list.netcdf_unit[dimname]
         var[:] = np.array(dimvar)
 
-    def add_dimension(self, netcdf, dimname, dimvar):
+    def add_dimension_landpoint(self, netcdf):
+        """Function to add the dimension of the land cells, 
+        with the 'list' variable holding the index of each cell
+        in the lat/lon grid of the file (CF compression by 
+        gathering)"""
+        lat = self.variable_list.netcdf_short_name['lat']
+        lon = self.variable_list.netcdf_short_name['lon']
+        nLat, nLon = self.landmask.shape
+        rows, cols = np.nonzero(self.landmask)
+        if not self.netcdf_y_orientation_follow_cf_convention:
+            # latitudes are written from low to high
+            rows = nLat - 1 - rows
+        netcdf.createDimension(landpoint_dimname, len(rows))
+        var = netcdf.createVariable(
+            landpoint_dimname,
+            'i4',
+            (landpoint_dimname,),
+            zlib=self.zlib)
+        var.long_name = 'index of land cells in the ' + lat + ' ' + lon + ' grid'
+        var.compress = lat + ' ' + lon
+        var[:] = rows * nLon + cols
+
+    def get_netcdf_dimensions(self, varname):
+        """Function to get the dimensions of a variable in the
+        output files, which are compressed by gathering if 
+        compress_by_gathering is set"""
+        dims = tuple(self.variable_list.netcdf_dimensions[varname])
+        if self.compress_by_gathering and dims[-2:] == ('lat','lon'):
+            dims = dims[:-2] + (landpoint_dimname,)
+        return dims
+
+    def add_dimension(self, netcdf, dimname, dimvar, size=None):
         isTimeDim = dimname in ['time']
         if isTimeDim:
-            self.add_dimension_time(netcdf, dimname, None)
+            self.add_dimension_time(netcdf, dimname, None, size)
         else:
             self.add_dimension_not_time(netcdf, dimname, dimvar)
     
+    def get_datatype(self, varname):
+        try:
+            return self.variable_list.netcdf_datatype[varname]
+        except:
+            return 'f4'
+
     def add_variable(self, netcdf, varname, **kwargs):
         self.repair_variable_dict(varname)
         shortname = self.variable_list.netcdf_short_name[varname]
-        try:
-            datatype = self.variable_list.netcdf_datatype[varname]
-        except:
-            datatype = 'f4'
-        dimensions = self.variable_list.netcdf_dimensions[varname]
+        datatype = self.get_datatype(varname)
+        dimensions = self.get_netcdf_dimensions(varname)
         var = netcdf.createVariable(
             shortname,
             datatype,
@@ -152,54 +378,127 @@ class OutputNetCDF(object):
             var_dims = tuple(set(var_dims))            
         return var_dims
             
-    def create_netCDF(self, ncFileName, varname, dimensions=None):
-        """Function to create netCDF file"""
-        # FIXME: make dimensions a required arg
-        netcdf = nc.Dataset(ncFileName, 'w', format=self.format)
-        if dimensions is None:
-            dimensions = self.get_variable_dimensions(varname)
-        for dim in dimensions:
-            self.add_dimension(netcdf, dim, self.model_dimensions[dim])
+    def create_netCDF(self, ncFileName, varname, dimensions=None, nrOfTimeSteps=None):
+        """Function to create netCDF file. If output is 
+        buffered (time_chunk > 0) and the number of time steps
+        which will be written to the file is given, the time 
+        axis is preallocated and variables are chunked by 
+        time_chunk time steps."""
+        with vos.get_netcdf_lock(ncFileName):
+            # FIXME: make dimensions a required arg
+            self.close(ncFileName)
+            netcdf = self.create_dataset(ncFileName)
+            if dimensions is None:
+                dimensions = self.get_variable_dimensions(varname)
+            preallocate = self.time_chunk > 0 and nrOfTimeSteps is not None and nrOfTimeSteps > 0
+            for dim in dimensions:
+                size = None
+                if preallocate and dim in valid_time_dimnames:
+                    size = nrOfTimeSteps
+                self.add_dimension(netcdf, dim, self.model_dimensions[dim], size)
 
-        if isinstance(varname, basestring):
-            varname = [varname]
+            if isinstance(varname, basestring):
+                varname = [varname]
+
+            if any(landpoint_dimname in self.get_netcdf_dimensions(item) for item in varname):
+                self.add_dimension_landpoint(netcdf)
 
-        for item in varname:
-            self.add_variable(netcdf, item, zlib=self.zlib, fill_value=vos.MV)
+            for item in varname:
+                kwargs = {'zlib' : self.zlib, 'fill_value' : vos.MV}
+                if preallocate and self.format.startswith('NETCDF4'):
+                    kwargs['chunksizes'] = self.get_chunk_sizes(netcdf, item)
+                self.add_variable(netcdf, item, **kwargs)
             
-        attributeDictionary = self.attributeDictionary
-        for k, v in attributeDictionary.items():
-            setattr(netcdf,k,v)
+            attributeDictionary = self.attributeDictionary
+            for k, v in attributeDictionary.items():
+                setattr(netcdf,k,v)
+
+            netcdf.sync()
+            self.set_netcdf(ncFileName, netcdf)
+            if preallocate:
+                self.time_cursors[ncFileName] = 0
+                self.buffers[ncFileName] = dict()
+
+    def get_chunk_sizes(self, netcdf, varname):
+        """Function to get the chunk shape of a variable, 
+        which holds time_chunk time steps of the full grid. If
+        such a chunk would exceed max_chunk_bytes the largest 
+        spatial dimension of the chunk is halved (and then the
+        time dimension, if the chunk is still too large)."""
+        dimensions = self.get_netcdf_dimensions(varname)
+        chunksizes = []
+        for dim in dimensions:
+            size = len(netcdf.dimensions[dim])
+            if dim in valid_time_dimnames:
+                size = min(self.time_chunk, size)
+            chunksizes.append(max(1, size))
+        itemsize = np.dtype(self.get_datatype(varname)).itemsize
+        while int(np.prod(chunksizes)) * itemsize > max_chunk_bytes:
+            spatial = [idx for idx, dim in enumerate(dimensions) if dim not in valid_time_dimnames and chunksizes[idx] > 1]
+            if len(spatial) == 0:
+                spatial = [idx for idx in range(len(chunksizes)) if chunksizes[idx] > 1]
+            if len(spatial) == 0:
+                break
+            idx = max(spatial, key=lambda idx: chunksizes[idx])
+            chunksizes[idx] = (chunksizes[idx] + 1) // 2
+        return chunksizes
+
+    def set_netcdf(self, ncFileName, netcdf):
+        self.datasets[ncFileName] = netcdf
+        self.time_cursors[ncFileName] = None
+        self.writes_since_sync[ncFileName] = 0
+        if self not in open_writers:
+            open_writers.append(self)
+        
+    def get_netcdf(self, ncFileName):
+        """Function to get the open netCDF file 'ncFileName',
+        opening it (for appending) if necessary"""
+        if ncFileName not in self.datasets:
+            self.set_netcdf(ncFileName, self.open_dataset(ncFileName))
+        return self.datasets[ncFileName]
+
+    def create_dataset(self, ncFileName):
+        return nc.Dataset(ncFileName, 'w', format=self.format)
 
-        netcdf.sync()
-        netcdf.close()
+    def open_dataset(self, ncFileName):
+        return nc.Dataset(ncFileName, 'a')
         
     def add_data_to_netcdf(self, ncFileName, varname, varField, timeStamp=None, posCnt=None):
-        """Function to write data to netCDF. If first opens 
-        the netCDF file specified by 'ncFileName', identifies 
+        """Function to write data to netCDF. It gets the open 
+        netCDF file specified by 'ncFileName', identifies 
         the variable name and dimensions corresponding to 
         'varname', and adds the data using the appropriate 
         method depending on whether the variable is 
-        time-varying or not.
+        time-varying or not. The file is synced to disk every 
+        'sync_interval' writes.
         """
-        netcdf = nc.Dataset(ncFileName, 'a')
-        short_name = self.variable_list.netcdf_short_name[varname]
-        dims = self.variable_list.netcdf_dimensions[varname]
-        has_time_dim = any([dim in valid_time_dimnames for dim in dims])
-        if has_time_dim:
-            self.add_data_to_netcdf_with_time(netcdf, short_name, dims, varField, timeStamp, posCnt)
-        else:
-            self.add_data_to_netcdf_without_time(netcdf, short_name, dims, varField)            
-        netcdf.sync()
-        netcdf.close()
+        with vos.get_netcdf_lock(ncFileName):
+            netcdf = self.get_netcdf(ncFileName)
+            short_name = self.variable_list.netcdf_short_name[varname]
+            dims = self.get_netcdf_dimensions(varname)
+            has_time_dim = any([dim in valid_time_dimnames for dim in dims])
+            if has_time_dim:
+                self.add_data_to_netcdf_with_time(netcdf, short_name, dims, varField, timeStamp, posCnt, ncFileName)
+            else:
+                self.add_data_to_netcdf_without_time(netcdf, short_name, dims, varField)            
+            self.writes_since_sync[ncFileName] += 1
+            if self.sync_interval > 0 and self.writes_since_sync[ncFileName] >= self.sync_interval:
+                netcdf.sync()
+                self.writes_since_sync[ncFileName] = 0
         
-    def add_data_to_netcdf_with_time(self, netcdf, shortVarName, var_dims, varField, timeStamp=None, posCnt=None):
+    def add_data_to_netcdf_with_time(self, netcdf, shortVarName, var_dims, varField, timeStamp=None, posCnt=None, ncFileName=None):
         time_dimname = [dim for dim in var_dims if dim in valid_time_dimnames][0]
         date_time = netcdf.variables[time_dimname]
         if posCnt is None:
-            posCnt = len(date_time)
+            # the time cursor is taken from the file when it is
+            # first written, and tracked afterwards
+            if self.time_cursors.get(ncFileName) is None:
+                self.time_cursors[ncFileName] = len(date_time)
+            posCnt = self.time_cursors[ncFileName]
+        if ncFileName is not None:
+            self.time_cursors[ncFileName] = max(self.time_cursors.get(ncFileName) or 0, posCnt + 1)
 
-        date_time[posCnt] = nc.date2num(
+        time_value = nc.date2num(
             timeStamp,
             date_time.units,
             date_time.calendar)
@@ -209,21 +508,75 @@ class OutputNetCDF(object):
         # config specifies NOT to follow CF convention then
         # we must flip the latitude dimension of the variable
         # such that latitudes go from low to high.
-        if not self.netcdf_y_orientation_follow_cf_convention:
+        if not self.netcdf_y_orientation_follow_cf_convention and landpoint_dimname not in var_dims:
             varField = np.flip(varField, axis=-2)
-        
+
+        if ncFileName in self.buffers:
+            buffers = self.buffers[ncFileName]
+            if shortVarName not in buffers:
+                buffers[shortVarName] = TimeChunkBuffer(self.time_chunk)
+            buffer = buffers[shortVarName]
+            if not buffer.is_next(posCnt):
+                self.write_buffer(netcdf, shortVarName, var_dims, buffer)
+            buffer.add(posCnt, time_value, varField)
+            if buffer.is_full():
+                self.write_buffer(netcdf, shortVarName, var_dims, buffer)
+            return
+
+        date_time[posCnt] = time_value
         time_axis = [i for i in range(len(var_dims)) if var_dims[i] == time_dimname][0]
         slc = [slice(None)] * len(var_dims)
         slc[time_axis] = posCnt
-        netcdf.variables[shortVarName][slc] = varField
+        netcdf.variables[shortVarName][tuple(slc)] = varField
+
+    def write_buffer(self, netcdf, shortVarName, var_dims, buffer):
+        """Function to write the time steps held in a buffer
+        to netCDF as one hyperslab"""
+        if buffer.count == 0:
+            return
+        time_dimname = [dim for dim in var_dims if dim in valid_time_dimnames][0]
+        time_slc = slice(buffer.start, buffer.start + buffer.count)
+        netcdf.variables[time_dimname][time_slc] = buffer.times[:buffer.count]
+        time_axis = [i for i in range(len(var_dims)) if var_dims[i] == time_dimname][0]
+        slc = [slice(None)] * len(var_dims)
+        slc[time_axis] = time_slc
+        netcdf.variables[shortVarName][tuple(slc)] = np.moveaxis(
+            buffer.fields[:buffer.count], 0, time_axis)
+        buffer.count = 0
+
+    def flush(self, ncFileName):
+        """Function to write buffered time steps to a file"""
+        with vos.get_netcdf_lock(ncFileName):
+            if ncFileName in self.buffers and ncFileName in self.datasets:
+                netcdf = self.datasets[ncFileName]
+                for shortVarName, buffer in self.buffers[ncFileName].items():
+                    var_dims = netcdf.variables[shortVarName].dimensions
+                    self.write_buffer(netcdf, shortVarName, var_dims, buffer)
     
     def add_data_to_netcdf_without_time(self, netcdf, shortVarName, var_dims, varField):
         """Function to write data to netCDF without a time dimension"""
-        if not self.netcdf_y_orientation_follow_cf_convention:
+        if not self.netcdf_y_orientation_follow_cf_convention and landpoint_dimname not in var_dims:
             varField = np.flip(varField, axis=-2)
         netcdf.variables[shortVarName][:] = varField           
         
     def close(self, ncFileName):
         """Function to close netCDF file"""
-        rootgrp = nc.Dataset(ncFileName,'w')
-        rootgrp.close()
+        with vos.get_netcdf_lock(ncFileName):
+            if ncFileName in self.datasets:
+                try:
+                    self.flush(ncFileName)
+                finally:
+                    self.datasets.pop(ncFileName).close()
+                    del self.time_cursors[ncFileName]
+                    del self.writes_since_sync[ncFileName]
+                    self.buffers.pop(ncFileName, None)
+
+    def close_all(self):
+        """Function to close all open netCDF files"""
+        for ncFileName in list(self.datasets.keys()):
+            try:
+                self.close(ncFileName)
+            except Exception as e:
+                logger.error('Failed to close ' + ncFileName + ': ' + str(e))
+        if self in open_writers:
+            open_writers.remove(self)
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import zlib
+import threading
+import numpy as np
+
+from OutputNetCDF import OutputNetCDF, valid_time_dimnames, landpoint_dimname
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Output can be written to chunked directory stores following the
+# Zarr (version 2) storage specification, instead of netCDF files.
+# Each chunk of a variable is a separate file, so that a chunk is
+# written without rewriting the rest of the variable. A store holds
+# the output of a single run, on the grid of that run. Chunks and
+# metadata are written under a temporary name and renamed, so that
+# a store can be read while it is written.
+# Dimension names are stored in the '_ARRAY_DIMENSIONS' attribute of
+# each variable, as expected by xarray.
+zarr_suffix = '.zarr'
+
+# dimensions which are chunked in space (see outputSpaceChunk)
+spatial_dimnames = ['lat','lon',landpoint_dimname]
+
+def write_file(filename, data):
+    """Function to write a file under a temporary name and
+    rename it"""
+    tmp_filename = filename + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident) + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_filename, filename)
+
+def write_json(filename, obj):
+    write_file(filename, json.dumps(obj, indent=4, sort_keys=True).encode('utf-8'))
+
+def read_json(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def get_json_value(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+class ZarrDimension(object):
+    def __init__(self, store, name, size):
+        self.store = store
+        self.name = name
+        self.size = size
+
+    def isunlimited(self):
+        return self.size is None
+
+    def __len__(self):
+        if self.size is not None:
+            return self.size
+        # the length of an unlimited dimension is the length
+        # of the longest variable along it
+        size = 0
+        for var in self.store.variables.values():
+            if self.name in var.dimensions:
+                size = max(size, var.shape[var.dimensions.index(self.name)])
+        return size
+
+class ZarrArray(object):
+    """Class to write a variable of a ZarrStore. Attributes
+    which are set on the object are stored as attributes of
+    the variable, as for a netCDF4 variable.
+    """
+    def __init__(self, store, name, dtype, dimensions, shape, chunks, fill_value = None, zlib = False, attrs = None):
+        self.__dict__['_attrs'] = dict(attrs or {})
+        self._store = store
+        self._name = name
+        self._path = os.path.join(store.path, name)
+        self.dtype = np.dtype(dtype)
+        self.dimensions = tuple(dimensions)
+        self.shape = tuple(shape)
+        self.chunks = tuple(chunks)
+        self._fill_value = fill_value
+        self._zlib = zlib
+        self._unlimited = tuple(store.dimensions[dim].isunlimited() for dim in dimensions)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_') or name in ['dtype','dimensions','shape','chunks']:
+            self.__dict__[name] = value
+        else:
+            self._attrs[name] = get_json_value(value)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_attrs'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def ncattrs(self):
+        return list(self._attrs.keys())
+
+    def write_metadata(self):
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+        fill_value = self._fill_value
+        if fill_value is not None:
+            fill_value = get_json_value(self.dtype.type(fill_value))
+        compressor = None
+        if self._zlib:
+            compressor = {'id' : 'zlib', 'level' : 1}
+        write_json(os.path.join(self._path, '.zarray'), {
+            'zarr_format' : 2,
+            'shape' : list(self.shape),
+            'chunks' : list(self.chunks),
+            'dtype' : self.dtype.newbyteorder('<').str,
+            'compressor' : compressor,
+            'fill_value' : fill_value,
+            'order' : 'C',
+            'filters' : None})
+        attrs = dict(self._attrs)
+        attrs['_ARRAY_DIMENSIONS'] = list(self.dimensions)
+        write_json(os.path.join(self._path, '.zattrs'), attrs)
+
+    def get_region(self, key):
+        """Function to convert an index (integers and slices
+        with unit step) to the start and stop of the region it
+        selects along each dimension, and the shape of the
+        data which is assigned to it"""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 0 and key[-1] is Ellipsis:
+            key = key[:-1]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        start, stop, shape = [], [], []
+        for idx, size, unlimited in zip(key, self.shape, self._unlimited):
+            if isinstance(idx, slice):
+                i0 = 0 if idx.start is None else idx.start
+                i1 = size if idx.stop is None else idx.stop
+                if not unlimited:
+                    i1 = min(i1, size)
+                start.append(i0)
+                stop.append(i1)
+                shape.append(i1 - i0)
+            else:
+                start.append(int(idx))
+                stop.append(int(idx) + 1)
+        return start, stop, tuple(shape)
+
+    def __setitem__(self, key, value):
+        start, stop, shape = self.get_region(key)
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), shape)
+        value = value.reshape([i1 - i0 for i0, i1 in zip(start, stop)])
+
+        # unlimited dimensions grow to hold the data
+        new_shape = tuple(max(size, i1) for size, i1 in zip(self.shape, stop))
+        grown = new_shape != self.shape
+        self.shape = new_shape
+
+        first = [i0 // c for i0, c in zip(start, self.chunks)]
+        last = [(i1 - 1) // c for i1, c in zip(stop, self.chunks)]
+        for chunk_index in np.ndindex(*[l - f + 1 for f, l in zip(first, last)]):
+            chunk_index = tuple(f + i for f, i in zip(first, chunk_index))
+            self.write_chunk(chunk_index, start, stop, value)
+        if grown:
+            self.write_metadata()
+
+    def write_chunk(self, chunk_index, start, stop, value):
+        """Function to write the part of 'value' (which is
+        assigned to the region from 'start' to 'stop') which
+        falls in a chunk. If the region does not cover the
+        chunk, the chunk is read and updated."""
+        chunk_slc, value_slc = [], []
+        covered = True
+        for idx, c, i0, i1, size, unlimited in zip(chunk_index, self.chunks, start, stop, self.shape, self._unlimited):
+            c0 = idx * c
+            c1 = c0 + c
+            j0 = max(c0, i0)
+            j1 = min(c1, i1)
+            chunk_slc.append(slice(j0 - c0, j1 - c0))
+            value_slc.append(slice(j0 - i0, j1 - i0))
+            # the edge chunk of an unlimited dimension may be
+            # extended by later writes
+            end = c1 if unlimited else min(c1, size)
+            if j0 > c0 or j1 < end:
+                covered = False
+        filename = os.path.join(self._path, '.'.join(str(idx) for idx in chunk_index))
+        if covered:
+            chunk = np.empty(self.chunks, dtype=self.dtype)
+            if self._fill_value is not None:
+                chunk.fill(self._fill_value)
+        else:
+            chunk = self.read_chunk(filename)
+        chunk[tuple(chunk_slc)] = value[tuple(value_slc)]
+        data = chunk.astype(self.dtype.newbyteorder('<')).tobytes()
+        if self._zlib:
+            data = zlib.compress(data, 1)
+        write_file(filename, data)
+
+    def read_chunk(self, filename):
+        if not os.path.exists(filename):
+            chunk = np.zeros(self.chunks, dtype=self.dtype)
+            if self._fill_value is not None:
+                chunk.fill(self._fill_value)
+            return chunk
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if self._zlib:
+            data = zlib.decompress(data)
+        chunk = np.frombuffer(data, dtype=self.dtype.newbyteorder('<'))
+        return chunk.reshape(self.chunks).astype(self.dtype)
+
+class ZarrStore(object):
+    """Class to write a chunked directory store with the
+    methods of a netCDF4 Dataset which are used by
+    OutputNetCDF. Variables are chunked by 'time_chunk' time
+    steps (unless chunk sizes are given) and by 'space_chunk'
+    cells along each spatial dimension (0 = not chunked).
+    """
+    def __init__(self, path, mode = 'w', zlib = False, time_chunk = 1, space_chunk = 0):
+        self.__dict__['_attrs'] = dict()
+        self.path = path
+        self.zlib = zlib
+        self.time_chunk = max(1, time_chunk)
+        self.space_chunk = space_chunk
+        self.dimensions = dict()
+        self.variables = dict()
+        if mode == 'w':
+            # remove an existing store, whose chunks would
+            # otherwise be read as part of the new one
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+            write_json(os.path.join(path, '.zgroup'), {'zarr_format' : 2})
+            self.write_metadata()
+        else:
+            self.read_metadata()
+
+    def __setattr__(self, name, value):
+        if name in ['path','zlib','time_chunk','space_chunk','dimensions','variables']:
+            self.__dict__[name] = value
+        else:
+            self._attrs[name] = get_json_value(value)
+
+    def ncattrs(self):
+        return list(self._attrs.keys())
+
+    def read_metadata(self):
+        """Function to open an existing store for appending.
+        Dimensions are unlimited if they are along the time
+        axis."""
+        self._attrs.update(read_json(os.path.join(self.path, '.zattrs')))
+        shapes = dict()
+        for name in sorted(os.listdir(self.path)):
+            if not os.path.exists(os.path.join(self.path, name, '.zarray')):
+                continue
+            zarray = read_json(os.path.join(self.path, name, '.zarray'))
+            attrs = read_json(os.path.join(self.path, name, '.zattrs'))
+            dims = attrs.pop('_ARRAY_DIMENSIONS')
+            for dim, size in zip(dims, zarray['shape']):
+                self.dimensions.setdefault(
+                    dim,
+                    ZarrDimension(self, dim, None if dim in valid_time_dimnames else size))
+            self.variables[name] = ZarrArray(
+                self,
+                name,
+                zarray['dtype'],
+                dims,
+                zarray['shape'],
+                zarray['chunks'],
+                zarray['fill_value'],
+                zarray['compressor'] is not None,
+                attrs)
+
+    def write_metadata(self):
+        write_json(os.path.join(self.path, '.zattrs'), dict(self._attrs))
+
+    def createDimension(self, name, size = None):
+        self.dimensions[name] = ZarrDimension(self, name, size)
+        return self.dimensions[name]
+
+    def get_chunks(self, dimensions, chunksizes = None):
+        chunks = []
+        for i, dim in enumerate(dimensions):
+            size = len(self.dimensions[dim])
+            if chunksizes is not None:
+                chunk = chunksizes[i]
+            elif self.dimensions[dim].isunlimited() or dim in valid_time_dimnames:
+                chunk = self.time_chunk
+            else:
+                chunk = size
+            if dim in spatial_dimnames and self.space_chunk > 0:
+                chunk = min(chunk, self.space_chunk)
+            chunks.append(max(1, chunk))
+        return chunks
+
+    def createVariable(self, name, datatype, dimensions, zlib = False, fill_value = None, chunksizes = None, **kwargs):
+        shape = [len(self.dimensions[dim]) for dim in dimensions]
+        var = ZarrArray(
+            self,
+            name,
+            datatype,
+            dimensions,
+            shape,
+            self.get_chunks(dimensions, chunksizes),
+            fill_value,
+            zlib)
+        var.write_metadata()
+        self.variables[name] = var
+        return var
+
+    def sync(self):
+        self.write_metadata()
+        for var in self.variables.values():
+            var.write_metadata()
+
+    def close(self):
+        self.sync()
+
+class OutputZarr(OutputNetCDF):
+    """Class to write output to chunked directory stores
+    (Zarr version 2) instead of netCDF files, with the same
+    interface as OutputNetCDF. The store for a file name
+    'name.nc' is the directory 'name.zarr'.
+    """
+    def __init__(self, netcdf_attr, model_dimensions, variable_list, reporting_options = None, landmask = None):
+        super(OutputZarr, self).__init__(netcdf_attr, model_dimensions, variable_list, reporting_options, landmask)
+        self.space_chunk = 0
+        if reporting_options is not None and 'outputSpaceChunk' in reporting_options:
+            self.space_chunk = int(reporting_options['outputSpaceChunk'])
+
+    def get_store_path(self, ncFileName):
+        root, ext = os.path.splitext(ncFileName)
+        return root + zarr_suffix
+
+    def create_dataset(self, ncFileName):
+        return ZarrStore(
+            self.get_store_path(ncFileName),
+            'w',
+            self.zlib,
+            self.time_chunk,
+            self.space_chunk)
+
+    def open_dataset(self, ncFileName):
+        return ZarrStore(
+            self.get_store_path(ncFileName),
+            'a',
+            self.zlib,
+            self.time_chunk,
+            self.space_chunk)
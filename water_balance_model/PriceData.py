@@ -6,6 +6,7 @@ import numpy as np
 import datetime as datetime
 
 import VirtualOS as vos
+from AnnualReadAhead import AnnualReadAhead
 
 import logging
 logger = logging.getLogger(__name__)
@@ -26,6 +27,9 @@ class FertiliserPrice(object):
         self.var.NitrogenPrice = arr_zeros.copy()
         self.var.PhosphorusPrice = arr_zeros.copy()
         self.var.PotassiumPrice = arr_zeros.copy()
+        self.fertiliser_price_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            self.read_fertiliser_prices)
 
     def reset_initial_conditions(self):
         pass
@@ -38,33 +42,41 @@ class FertiliserPrice(object):
             date,
             useDoy = None,
             cloneMapFileName = self.var.cloneMap,
-            LatitudeLongitude = True)        
-        fert_price = fert_price[self.var.landmask]
+            LatitudeLongitude = True,
+            landmask = self.var.landmask,
+            cache = True)
         return fert_price
 
+    def read_fertiliser_prices(self, year):
+        """Function to read the fertiliser prices of a given 
+        year (prices without an input file are omitted)"""
+        date = datetime.datetime(year, 1, 1, 0, 0, 0)
+        prices = dict()
+        if not self.NitrogenPriceFileNC == "None":                
+            prices['NitrogenPrice'] = self.read_fertiliser_price(
+                self.NitrogenPriceFileNC,
+                self.NitrogenPriceVarName,
+                date)
+        if not self.PhosphorusPriceFileNC == "None":
+            prices['PhosphorusPrice'] = self.read_fertiliser_price(
+                self.PhosphorusPriceFileNC,
+                self.PhosphorusPriceVarName,
+                date)
+        if not self.PotassiumPriceFileNC == "None":
+            prices['PotassiumPrice'] = self.read_fertiliser_price(
+                self.PotassiumPriceFileNC,
+                self.PotassiumPriceVarName,
+                date)
+        return prices
+    
     def set_fertiliser_price(self):
         start_of_model_run = (self.var._modelTime.timeStepPCR == 1)
         start_of_year = (self.var._modelTime.doy == 1)
         if start_of_model_run or start_of_year:
-            date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)        
-            if not self.NitrogenPriceFileNC == "None":                
-                self.var.NitrogenPrice = self.read_fertiliser_price(
-                    self.NitrogenPriceFileNC,
-                    self.NitrogenPriceVarName,
-                    date)
-                # print np.max(self.var.NitrogenPrice)
-            if not self.PhosphorusPriceFileNC == "None":
-                self.var.PhosphorusPrice = self.read_fertiliser_price(
-                    self.PhosphorusPriceFileNC,
-                    self.PhosphorusPriceVarName,
-                    date)
-                # print np.max(self.var.PhosphorusPrice)
-            if not self.PotassiumPriceFileNC == "None":
-                self.var.PotassiumPrice = self.read_fertiliser_price(
-                    self.PotassiumPriceFileNC,
-                    self.PotassiumPriceVarName,
-                    date)
-                # print np.max(self.var.PotassiumPrice)
+            prices = self.fertiliser_price_reader.get(self.var._modelTime.year)
+            for name, price in prices.items():
+                setattr(self.var, name, price)
+        self.fertiliser_price_reader.update()
 
     def dynamic(self):
         self.set_fertiliser_price()
@@ -77,30 +89,36 @@ class CropPrice(object):
         
     def initial(self):
         self.var.CropPrice = np.zeros((self.var.nFarm, self.var.nCrop, self.var.nCell))
+        self.crop_price_reader = AnnualReadAhead.from_configuration(
+            self.var,
+            self.read_crop_price)
 
+    def read_crop_price(self, year):
+        date = datetime.datetime(year, 1, 1, 0, 0, 0)
+        crop_price = vos.netcdf2PCRobjClone(
+            self.CropPriceFileNC,
+            self.CropPriceVarName,
+            date,
+            useDoy = None,
+            cloneMapFileName = self.var.cloneMap,
+            LatitudeLongitude = True,
+            landmask = self.var.landmask,
+            cache = True)
+        crop_price = np.broadcast_to(
+            crop_price[None,:,:],
+            (self.var.nFarm,
+             self.var.nCrop,
+             self.var.nCell)).copy()
+        return crop_price
+        
     def set_crop_price(self):
         """Function to read crop area"""
-        start_of_model_run = (self.var._modelTime.timeStepPCR == 1)
-        start_of_year = (self.var._modelTime.doy == 1)
-        if start_of_model_run or start_of_year:
-            if not self.CropPriceFileNC == "None":
-                date = datetime.datetime(self.var._modelTime.year, 1, 1, 0, 0, 0)
-                crop_price = vos.netcdf2PCRobjClone(
-                    self.CropPriceFileNC,
-                    self.CropPriceVarName,
-                    date,
-                    useDoy = None,
-                    cloneMapFileName = self.var.cloneMap,
-                    LatitudeLongitude = True)
-                crop_price = np.reshape(
-                    crop_price[self.var.landmask_crop],
-                    (self.var.nCrop, self.var.nCell))
-                crop_price = np.broadcast_to(
-                    crop_price[None,:,:],
-                    (self.var.nFarm,
-                     self.var.nCrop,
-                     self.var.nCell)).copy()
-                self.var.CropPrice = crop_price
+        if not self.CropPriceFileNC == "None":
+            start_of_model_run = (self.var._modelTime.timeStepPCR == 1)
+            start_of_year = (self.var._modelTime.doy == 1)
+            if start_of_model_run or start_of_year:
+                self.var.CropPrice = self.crop_price_reader.get(self.var._modelTime.year)
+            self.crop_price_reader.update()
                                             
     def dynamic(self):
         self.set_crop_price()
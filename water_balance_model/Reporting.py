@@ -6,31 +6,108 @@ import shutil
 from types import NoneType
 from collections import OrderedDict
 from OutputNetCDF import *
+from OutputZarr import OutputZarr
 
 import logging
 logger = logging.getLogger(__name__)
 
-class Reporting(object):
+# output backends which can be selected with outputBackend
+output_backends = {
+    'netcdf' : OutputNetCDF,
+    'zarr'   : OutputZarr}
+
+# reporting options, with the suffix of the output files, the
+# period over which variables are aggregated ('day', 'month' or
+# 'year'), the statistic ('last', 'mean', 'sum' or 'max') and a
+# description for the log
+reporting_aggregations = (
+    ('outDailyTotNC', 'dailyTot', 'day',   'last', 'daily value'),
+    ('outMonthAvgNC', 'monthAvg', 'month', 'mean', 'monthly average'),
+    ('outMonthEndNC', 'monthEnd', 'month', 'last', 'month end value'),
+    ('outMonthTotNC', 'monthTot', 'month', 'sum',  'monthly total'),
+    ('outMonthMaxNC', 'monthMax', 'month', 'max',  'monthly maximum'),
+    ('outYearAvgNC',  'yearAvg',  'year',  'mean', 'yearly average'),
+    ('outYearEndNC',  'yearEnd',  'year',  'last', 'year end value'),
+    ('outYearTotNC',  'yearTot',  'year',  'sum',  'yearly total'),
+    ('outYearMaxNC',  'yearMax',  'year',  'max',  'yearly maximum'))
+
+class Accumulator(object):
+    """Class to aggregate a model variable over a reporting
+    period. The buffer has the shape of the model variable
+    (i.e. holds the cells in the landmask) and is updated in
+    place. For the 'last' statistic nothing is accumulated,
+    and the value of the model variable at the end of the
+    period is reported.
+    """
+    def __init__(self, var, suffix, period, statistic, ncFile, shape):
+        self.var = var
+        self.suffix = suffix
+        self.period = period
+        self.statistic = statistic
+        self.ncFile = ncFile
+        self.count = 0
+        self.buffer = None
+        if statistic != 'last':
+            self.buffer = np.zeros(shape)
+
+    def update(self, data):
+        if self.statistic in ['mean','sum']:
+            np.add(self.buffer, data, out=self.buffer)
+        elif self.statistic == 'max':
+            np.maximum(self.buffer, data, out=self.buffer)
+        self.count += 1
+
+    def value(self, data):
+        if self.statistic == 'last':
+            return data
+        if self.statistic == 'mean':
+            return self.buffer / self.count
+        return self.buffer
+
+    def reset(self):
+        if self.buffer is not None:
+            self.buffer.fill(0)
+        self.count = 0
 
+class Reporting(object):
+    """Class to report model variables to output files. The
+    variables are listed in 'reporting_options', which may be
+    a land cover section, while the way the output is written
+    (backend, chunking, queue etc.) is always configured in
+    [reportingOptions].
+    """
     def __init__(self, model, output_dir, netcdf_attr, reporting_options, variable_list, run_id=None):
         self._model = model
         self._modelTime = model._modelTime
         self.output_dir = output_dir
         self.reporting_options = reporting_options
-        self.initiate_reporting(netcdf_attr, variable_list, run_id)        
+        self.output_options = model._configuration.reportingOptions
+        self.initiate_reporting(netcdf_attr, variable_list, run_id)
 
-    def create_netcdf_file(self, var, suffix):
+    def create_netcdf_file(self, var, suffix, nrOfTimeSteps = None):
         ncFile = self.output_dir + "/" + str(var) + str(suffix) + ".nc"
-        self.netcdfObj.create_netCDF(ncFile, var)
+        self.netcdfObj.create_netCDF(ncFile, var, nrOfTimeSteps = nrOfTimeSteps)
+        return ncFile
 
     def initiate_reporting(self, netcdf_attr, variable_list, run_id):
-        """Function to create netCDF files for each output 
-        variable
+        """Function to create netCDF files for each output
+        variable, and an accumulator for each variable and
+        aggregation
         """
-        self.netcdfObj = OutputNetCDF(
+        backend = 'netcdf'
+        if 'outputBackend' in self.output_options:
+            backend = str(self.output_options['outputBackend'])
+        if backend not in output_backends:
+            raise ModelError('unknown output backend ' + backend + ' (must be one of ' + ', '.join(sorted(output_backends)) + ')')
+        self.netcdfObj = output_backends[backend](
             netcdf_attr,
             self._model.dimensions,
-            variable_list)
+            variable_list,
+            self.output_options,
+            self._model.landmask)
+        self.output_writer = OutputWriter.from_configuration(
+            self.netcdfObj,
+            self.output_options)
 
         if run_id is None:
             run_id = ''
@@ -38,292 +115,69 @@ class Reporting(object):
             run_id = '_' + str(run_id)
         self.run_id = run_id
 
-        self.initiate_daily_total_reporting()
-        self.initiate_month_average_reporting()
-        self.initiate_month_end_reporting()
-        self.initiate_month_total_reporting()
-        self.initiate_month_maximum_reporting()
-        self.initiate_year_average_reporting()
-        self.initiate_year_end_reporting()
-        self.initiate_year_total_reporting()
-        self.initiate_year_maximum_reporting()
-        
-        self.variables_for_report = (
-            self.outDailyTotNC +
-            self.outMonthAvgNC +
-            self.outMonthEndNC +
-            self.outMonthTotNC +
-            self.outMonthMaxNC +
-            self.outYearAvgNC +
-            self.outYearEndNC +
-            self.outYearTotNC +
-            self.outYearMaxNC
-            )
-
-        # reduce above list to unique values, and remove None
-        self.variables_for_report = list(set(self.variables_for_report))
-        if "None" in self.variables_for_report:
-            self.variables_for_report.remove("None")
+        nrOfTimeSteps = {
+            'day'   : self._modelTime.nrOfTimeSteps,
+            'month' : self._modelTime.nrOfMonthEnds,
+            'year'  : self._modelTime.nrOfYearEnds}
+        self.accumulators = []
+        for option, suffix, period, statistic, description in reporting_aggregations:
+            for var in self.get_variable_names_for_reporting(option):
+                logger.info("Creating the netcdf file for reporting the %s of variable %s.", description, str(var))
+                ncFile = self.create_netcdf_file(
+                    var,
+                    self.run_id + "_" + suffix + "_output",
+                    nrOfTimeSteps[period])
+                self.accumulators.append(
+                    Accumulator(
+                        var,
+                        suffix,
+                        period,
+                        statistic,
+                        ncFile,
+                        vars(self._model)[var].shape))
 
     def get_variable_names_for_reporting(self, option):
+        if option not in self.reporting_options:
+            return []
         var_names = [str(var.strip()) for var in self.reporting_options[option].split(',')]
-        return list(set(var_names))
-    
-    def initiate_daily_total_reporting(self):
-        self.outDailyTotNC = ["None"]
-        try:
-            self.outDailyTotNC = self.get_variable_names_for_reporting('outDailyTotNC')
-        except:
-            pass
-        
-        if self.outDailyTotNC[0] != "None":
-            for var in self.outDailyTotNC:
-                logger.info("Creating the netcdf file for reporting the daily value of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_dailyTot_output")
-
-    def initiate_month_average_reporting(self):
-        self.outMonthAvgNC = ["None"]
-        try:
-            self.outMonthAvgNC = self.get_variable_names_for_reporting('outMonthAvgNC')
-        except:
-            pass
-        if self.outMonthAvgNC[0] != "None":
-            for var in self.outMonthAvgNC:
-                logger.info("Creating the netcdf file for reporting the monthly average of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_monthAvg_output")
-                vars(self)[var+'_monthAvg'] = np.zeros(vars(self._model)[var].shape[:-1] + (self._model.nLat, self._model.nLon))
-
-    def initiate_month_end_reporting(self):
-        self.outMonthEndNC = ["None"]
-        try:
-            self.outMonthEndNC = list(set(self.reporting_options['outMonthEndNC'].split(",")))
-        except:
-            pass
-        if self.outMonthEndNC[0] != "None":
-            for var in self.outMonthEndNC:
-                logger.info("Creating the netcdf file for reporting the month end value of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_monthEnd_output")
-                vars(self)[var+'_monthEnd'] = np.zeros(vars(self._model)[var].shape[:-1] + (self._model.nLat, self._model.nLon))
-
-    def initiate_month_total_reporting(self):
-        self.outMonthTotNC = ["None"]
-        try:
-            self.outMonthTotNC = self.get_variable_names_for_reporting('outMonthTotNC')
-        except:
-            pass
-        if self.outMonthTotNC[0] != "None":
-            for var in self.outMonthTotNC:
-                logger.info("Creating the netcdf file for reporting the monthly average of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_monthTot_output")
-                vars(self)[var+'_monthTot'] = np.zeros(vars(self._model)[var].shape[:-1] + (self._model.nLat, self._model.nLon))
-
-    def initiate_month_maximum_reporting(self):
-        self.outMonthMaxNC = ["None"]
-        try:
-            self.outMonthMaxNC = list(set(self.reporting_options['outMonthMaxNC'].split(",")))
-        except:
-            pass
-        if self.outMonthMaxNC[0] != "None":
-            for var in self.outMonthMaxNC:
-                logger.info("Creating the netcdf file for reporting the monthly maximum of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_monthMax_output")
-                vars(self)[var+'_monthMax'] = np.zeros(vars(self._model)[var].shape[:-1] + (self._model.nLat, self._model.nLon))
-
-    def initiate_year_average_reporting(self):
-        self.outYearAvgNC = ["None"]
-        try:
-            self.outYearAvgNC = list(set(self.reporting_options['outYearAvgNC'].split(",")))
-        except:
-            pass
-        if self.outYearAvgNC[0] != "None":
-            for var in self.outYearAvgNC:
-                logger.info("Creating the netcdf file for reporting the yearly average of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_yearAvg_output")
-                vars(self)[var+'_yearAvg'] = np.zeros(vars(self._model)[var].shape[:-1] + (self._model.nLat, self._model.nLon))
-                # vars(self)[var+'_yearAvg'] = np.zeros((vars(self._model)[var].shape))
-
-    def initiate_year_end_reporting(self):
-        self.outYearEndNC = ["None"]
-        try:
-            self.outYearEndNC = list(set(self.reporting_options['outYearEndNC'].split(",")))
-        except:
-            pass
-        if self.outYearEndNC[0] != "None":
-            for var in self.outYearEndNC:
-                logger.info("Creating the netcdf file for reporting the year end value of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_yearEnd_output")
-                vars(self)[var+'_yearEnd'] = np.zeros((vars(self._model)[var].shape))
-
-    def initiate_year_total_reporting(self):
-        self.outYearTotNC = ["None"]
-        try:
-            self.outYearTotNC = self.get_variable_names_for_reporting('outYearTotNC')
-        except:
-            pass
-        if self.outYearTotNC[0] != "None":
-            for var in self.outYearTotNC:
-                logger.info("Creating the netcdf file for reporting the yearly total of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_yearTot_output")
-                vars(self)[var+'_yearTot'] = np.zeros(vars(self._model)[var].shape[:-1] + (self._model.nLat, self._model.nLon))
-
-    def initiate_year_maximum_reporting(self):
-        self.outYearMaxNC = ["None"]
-        try:
-            self.outYearMaxNC = list(set(self.reporting_options['outYearMaxNC'].split(",")))
-        except:
-            pass
-        if self.outYearMaxNC[0] != "None":
-            for var in self.outYearMaxNC:
-                logger.info("Creating the netcdf file for reporting the yearly maximum of variable %s.", str(var))
-                self.create_netcdf_file(var, self.run_id + "_yearMax_output")
-                vars(self)[var+'_yearMax'] = np.zeros(vars(self._model)[var].shape[:-1] + (self._model.nLat, self._model.nLon))
-                
-    def post_processing(self):
-        """Function to process model variables to output variables. 
-        This generally means assigning values to an array with 
-        spatial dimensions equal to those of the current landmask.
+        var_names = [var for var in var_names if var not in ['', 'None']]
+        return sorted(set(var_names))
+
+    def get_output_field(self, data):
+        """Function to get the field which is written for an
+        array of the cells in the landmask. Unless the output
+        is compressed by gathering, this is an array with the
+        spatial dimensions of the model grid.
         """
-        if len(self.variables_for_report) > 0:
-            for var in self.variables_for_report:
-                d = vars(self._model)[var]
-                arr = np.ones(d.shape[:-1] + (self._model.nLat, self._model.nLon)) * vos.MV
-                arr[...,self._model.landmask] = d
-                vars(self)[var] = arr
-               
+        if self.netcdfObj.compress_by_gathering:
+            return data
+        arr = np.full(data.shape[:-1] + (self._model.nLat, self._model.nLon), vos.MV)
+        arr[...,self._model.landmask] = data
+        return arr
+
+    def is_end_of_period(self, period):
+        if period == 'month':
+            return self._modelTime.endMonth
+        if period == 'year':
+            return self._modelTime.endYear
+        return True
+
     def report(self):
         logger.info("reporting for time %s", self._modelTime.currTime)
-        self.post_processing()
         self.time_stamp = datetime.datetime(
             self._modelTime.year,
             self._modelTime.month,
             self._modelTime.day,
             0)
-        
-        self.report_daily_total()
-        self.report_month_average()
-        self.report_month_end()
-        self.report_month_total()
-        self.report_month_maximum()
-        self.report_year_average()
-        self.report_year_end()
-        self.report_year_total()
-        self.report_year_maximum()
-        
-    def report_daily_total(self):
-        if self.outDailyTotNC[0] != "None":
-            for var in self.outDailyTotNC:
-                fn = self.output_dir + "/" + str(var) + self.run_id + "_dailyTot_output.nc"
-                self.netcdfObj.add_data_to_netcdf(
-                    fn,
-                    var,
-                    self.__getattribute__(var),
+        end_of_period = dict(
+            (period, self.is_end_of_period(period)) for period in ['day','month','year'])
+        for accumulator in self.accumulators:
+            data = vars(self._model)[accumulator.var]
+            accumulator.update(data)
+            if end_of_period[accumulator.period]:
+                self.output_writer.write(
+                    accumulator.ncFile,
+                    accumulator.var,
+                    self.get_output_field(accumulator.value(data)),
                     self.time_stamp)
-
-    def report_month_average(self):
-        if self.outMonthAvgNC[0] != "None":
-            for var in self.outMonthAvgNC:
-                if self._modelTime.day == 1: vars(self)[var+'_monthAvg'].fill(0)
-                vars(self)[var+'_monthAvg'] += vars(self)[var]
-                if self._modelTime.endMonth:
-                    divd = np.min((self._modelTime.timeStepPCR, self._modelTime.day))
-                    vars(self)[var+'_monthAvg'] = vars(self)[var+'_monthAvg'] / divd
-                    fn = self.output_dir + "/" + str(var) + self.run_id + "_monthAvg_output.nc"
-                    self.netcdfObj.add_data_to_netcdf(
-                        fn,
-                        var,
-                        self.__getattribute__(var+'_monthAvg'),
-                        self.time_stamp)
-                    
-    def report_month_end(self):
-        if self.outMonthEndNC[0] != "None":
-            for var in self.outMonthEndNC:
-                if self._modelTime.endMonth:
-                    vars(self)[var+'_monthEnd'] = vars(self)[var]
-                    fn = self.output_dir + "/" + str(var) + self.run_id + "_monthEnd_output.nc"
-                    self.netcdfObj.add_data_to_netcdf(
-                        fn,
-                        var,
-                        self.__getattribute__(var+'_monthEnd'),
-                        self.time_stamp)
-
-    def report_month_total(self):
-        if self.outMonthTotNC[0] != "None":
-            for var in self.outMonthTotNC:
-                if self._modelTime.day == 1: vars(self)[var+'_monthTot'].fill(0)
-                vars(self)[var+'_monthTot'][...,self._model.landmask] += vars(self)[var][...,self._model.landmask]
-                
-                if self._modelTime.endMonth:
-                    fn = self.output_dir + "/" + str(var) + self.run_id + "_monthTot_output.nc"
-                    self.netcdfObj.add_data_to_netcdf(
-                        fn,
-                        var,
-                        self.__getattribute__(var+'_monthTot'),
-                        self.time_stamp)                    
-
-    def report_month_maximum(self):
-        if self.outMonthMaxNC[0] != "None":
-            for var in self.outMonthMaxNC:
-                if self._modelTime.day == 1: vars(self)[var+'_monthMax'].fill(0)
-                vars(self)[var+'_monthMax'] = vars(self)[var+'_monthMax'].clip(vars(self)[var], None)
-                if self._modelTime.endMonth:
-                    fn = self.output_dir + "/" + str(var) + self.run_id + "_monthMax_output.nc"
-                    self.netcdfObj.add_data_to_netcdf(
-                        fn,
-                        var,
-                        self.__getattribute__(var+'_monthMax'),
-                        self.time_stamp)                    
-
-    def report_year_average(self):
-        if self.outYearAvgNC[0] != "None":
-            for var in self.outYearAvgNC:
-                if self._modelTime.doy == 1: vars(self)[var+'_yearAvg'].fill(0)
-                vars(self)[var+'_yearAvg'] += vars(self)[var]
-                if self._modelTime.endYear:
-                    divd = np.min((self._modelTime.timeStepPCR, self._modelTime.doy))
-                    vars(self)[var+'_yearAvg'] = vars(self)[var+'_yearAvg'] / divd
-                    fn = self.output_dir + "/" + str(var) + self.run_id + "_yearAvg_output.nc"
-                    self.netcdfObj.add_data_to_netcdf(
-                        fn,
-                        var,
-                        self.__getattribute__(var+'_yearAvg'),
-                        self.time_stamp)
-                    
-
-    def report_year_end(self):
-        if self.outYearEndNC[0] != "None":
-            for var in self.outYearEndNC:
-                if self._modelTime.endYear:
-                    vars(self)[var+'_yearEnd'] = vars(self)[var]
-                    fn = self.output_dir + "/" + str(var) + self.run_id + "_yearEnd_output.nc"
-                    self.netcdfObj.add_data_to_netcdf(
-                        fn,
-                        var,
-                        self.__getattribute__(var+'_yearEnd'),
-                        self.time_stamp)
-
-    def report_year_total(self):
-        if self.outYearTotNC[0] != "None":
-            for var in self.outYearTotNC:
-                if self._modelTime.doy == 1: vars(self)[var+'_yearTot'].fill(0)
-                vars(self)[var+'_yearTot'][...,self._model.landmask] += vars(self)[var][...,self._model.landmask]
-                if self._modelTime.endYear:
-                    fn = self.output_dir + "/" + str(var) + self.run_id + "_yearTot_output.nc"
-                    self.netcdfObj.add_data_to_netcdf(
-                        fn,
-                        var,
-                        self.__getattribute__(var+'_yearTot'),
-                        self.time_stamp)                    
-
-    def report_year_maximum(self):
-        if self.outYearMaxNC[0] != "None":
-            for var in self.outYearMaxNC:
-                if self._modelTime.doy == 1:
-                    vars(self)[var+'_yearMax'].fill(0)
-                vars(self)[var+'_yearMax'] = vars(self)[var+'_yearMax'].clip(vars(self)[var], None)
-                if self._modelTime.endYear:
-                    fn = self.output_dir + "/" + str(var) + self.run_id + "_yearMax_output.nc"
-                    self.netcdfObj.add_data_to_netcdf(
-                        fn,
-                        var,
-                        self.__getattribute__(var+'_yearMax'),
-                        self.time_stamp)
+                accumulator.reset()
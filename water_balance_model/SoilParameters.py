@@ -3,12 +3,21 @@
 
 import os
 import numpy as np
-import pcraster as pcr
 import VirtualOS as vos
 import netCDF4 as nc
 
 class SoilParameters(object):
 
+    # attributes set by 'initial' and by
+    # 'compute_soil_hydraulic_parameters'
+    static_parameters = (
+        'nLayer', 'soildepth_factor', 'soil_depth', 'crop_group_number',
+        'ksat', 'th_s', 'th_res', 'van_genuchten_alpha', 'van_genuchten_lambda')
+    hydraulic_parameters = (
+        'van_genuchten_n', 'van_genuchten_m', 'van_genuchten_inv_n',
+        'van_genuchten_inv_m', 'van_genuchten_inv_alpha',
+        'wc_sat', 'wc_res', 'wc_range', 'wc_fc', 'wc_wp', 'k_fc12', 'k_fc23')
+
     def __init__(self, SoilParameters_variable, config_section_name):
         """Initialise SoilParameters object"""
         self.var = SoilParameters_variable
@@ -25,13 +34,15 @@ class SoilParameters(object):
         soildepth1 = vos.netcdf2PCRobjCloneWithoutTime(
             str(self.var._configuration.SOIL['soilDepthOneInputFile']),
             str(self.var._configuration.SOIL['soilDepthOneVariableName']),
-            cloneMapFileName=self.var.cloneMap)[self.var.landmask]
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         soildepth1 = np.maximum(0.05, soildepth1 - soildepth0)
 
         soildepth2 = vos.netcdf2PCRobjCloneWithoutTime(
             str(self.var._configuration.SOIL['soilDepthTwoInputFile']),
             str(self.var._configuration.SOIL['soilDepthTwoVariableName']),
-            cloneMapFileName=self.var.cloneMap)[self.var.landmask]
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         soildepth2 = np.maximum(0.05, soildepth2)
         soil_depth = np.stack([soildepth0, soildepth1, soildepth2])
 
@@ -48,15 +59,15 @@ class SoilParameters(object):
         self.var.crop_group_number = vos.netcdf2PCRobjCloneWithoutTime(
             str(self.var._configuration.SOIL['cropGroupNumberInputFile']),
             str(self.var._configuration.SOIL['cropGroupNumberVariableName']),
-            cloneMapFileName=self.var.cloneMap)[self.var.landmask]
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         
         # These parameters have dimensions depth,lat,lon
-        landmask = np.broadcast_to(self.var.landmask, (self.var.nLayer, self.var.nLat, self.var.nLon))
         ksat = vos.netcdf2PCRobjCloneWithoutTime(
             str(self.lc_configuration['KsatInputFile']),
             str(self.lc_configuration['KsatVariableName']),
-            cloneMapFileName=self.var.cloneMap)
-        ksat = ksat[landmask].reshape(self.var.nLayer,self.var.nCell)
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         self.var.ksat = np.broadcast_to(ksat[None,None,:,:], (self.var.nFarm, self.var.nCrop, self.var.nLayer, self.var.nCell)).copy()
         self.var.ksat /= 100.   # cm d-1 -> m d-1 ***TODO*** put factor in config
 
@@ -64,32 +75,32 @@ class SoilParameters(object):
         th_s = vos.netcdf2PCRobjCloneWithoutTime(
             self.lc_configuration['saturatedWaterContentInputFile'],
             self.lc_configuration['saturatedWaterContentVariableName'],
-            cloneMapFileName=self.var.cloneMap)
-        th_s = th_s[landmask].reshape(self.var.nLayer,self.var.nCell)
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         self.var.th_s = np.broadcast_to(th_s[None,None,:,:], (self.var.nFarm, self.var.nCrop, self.var.nLayer, self.var.nCell))
 
         # # Field capacity
         # th_fc = vos.netcdf2PCRobjCloneWithoutTime(
         #     self.lc_configuration['fieldCapacityInputFile'],
         #     self.lc_configuration['fieldCapacityVariableName'],
-        #     cloneMapFileName=self.var.cloneMap)
-        # th_fc = th_fc[landmask].reshape(self.var.nLayer,self.var.nCell)
+        #     cloneMapFileName=self.var.cloneMap,
+        #     landmask=self.var.landmask)
         # self.var.th_fc = np.broadcast_to(th_fc[None,None,:,:], (self.var.nFarm, self.var.nCrop, self.var.nLayer, self.var.nCell))
 
         # # Wilting point
         # th_wp = vos.netcdf2PCRobjCloneWithoutTime(
         #     self.lc_configuration['wiltingPointInputFile'],
         #     self.lc_configuration['wiltingPointVariableName'],
-        #     cloneMapFileName=self.var.cloneMap)
-        # th_wp = th_wp[landmask].reshape(self.var.nLayer,self.var.nCell)
+        #     cloneMapFileName=self.var.cloneMap,
+        #     landmask=self.var.landmask)
         # self.var.th_wp = np.broadcast_to(th_wp[None,None,:,:], (self.var.nFarm, self.var.nCrop, self.var.nLayer, self.var.nCell))
 
         # Residual water content
         th_res = vos.netcdf2PCRobjCloneWithoutTime(
             self.lc_configuration['residualWaterContentInputFile'],
             self.lc_configuration['residualWaterContentVariableName'],
-            cloneMapFileName=self.var.cloneMap)
-        th_res = th_res[landmask].reshape(self.var.nLayer,self.var.nCell)
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         self.var.th_res = np.broadcast_to(th_res[None,None,:,:], (self.var.nFarm, self.var.nCrop, self.var.nLayer, self.var.nCell))
 
         # # The following is adapted from AOS_ComputeVariables.m, lines 25
@@ -99,8 +110,8 @@ class SoilParameters(object):
         van_genuchten_alpha = vos.netcdf2PCRobjCloneWithoutTime(
             self.lc_configuration['alphaInputFile'],
             self.lc_configuration['alphaVariableName'],
-            cloneMapFileName=self.var.cloneMap)
-        van_genuchten_alpha = van_genuchten_alpha[landmask].reshape(self.var.nLayer,self.var.nCell)
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         self.var.van_genuchten_alpha = np.broadcast_to(
             van_genuchten_alpha[None,None,:,:],
             (self.var.nFarm, self.var.nCrop, self.var.nLayer, self.var.nCell))
@@ -109,8 +120,8 @@ class SoilParameters(object):
         van_genuchten_lambda = vos.netcdf2PCRobjCloneWithoutTime(
             self.lc_configuration['lambdaInputFile'],
             self.lc_configuration['lambdaVariableName'],
-            cloneMapFileName=self.var.cloneMap)
-        van_genuchten_lambda = van_genuchten_lambda[landmask].reshape(self.var.nLayer,self.var.nCell)
+            cloneMapFileName=self.var.cloneMap,
+            landmask=self.var.landmask)
         self.var.van_genuchten_lambda = np.broadcast_to(
             van_genuchten_lambda[None,None,:,:],
             (self.var.nFarm, self.var.nCrop, self.var.nLayer, self.var.nCell))
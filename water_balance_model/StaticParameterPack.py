@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+
+from Messages import ModelError
+
+import logging
+logger = logging.getLogger(__name__)
+
+# pack file layout: signature, header length (uint64, little
+# endian), JSON header, then the arrays, each aligned to
+# 'pack_alignment' bytes
+pack_signature = b'WBSTATICPACK0001'
+pack_alignment = 64
+
+class StaticParameterPack(object):
+    """Class to store the static parameters of a land cover,
+    including derived parameters, in a single file which is
+    memory mapped by later runs with the same configuration
+    and input files.
+
+    Parameters are computed in named groups by 'run', which
+    records a copy of the attributes of the land cover object
+    listed for each group. If the pack file exists the attributes are
+    restored from the file instead. The pack is keyed by a
+    hash of the configuration sections and the modification
+    times of the input files referred to in them, so a change
+    to either creates a new pack.
+    """
+    def __init__(self, var, config_section_name, pack_dir = None):
+        self.var = var
+        self.config_section_name = config_section_name
+        self.enabled = pack_dir is not None
+        self.groups = dict()
+        self.recorded = dict()
+        self.unlisted = dict()
+        self.loaded = False
+        if not self.enabled:
+            return
+        self.filename = os.path.join(
+            pack_dir,
+            config_section_name + '_' + self.get_key() + '.pack')
+        if os.path.exists(self.filename):
+            try:
+                self.groups = read_pack(self.filename)
+                self.loaded = True
+                logger.info('Loading static parameters from ' + self.filename)
+            except (IOError, ValueError) as e:
+                logger.warning('Unable to read static parameter pack ' + self.filename + ': ' + str(e))
+
+    @classmethod
+    def from_configuration(cls, var, config_section_name):
+        pack_dir = None
+        if 'staticParameterPackDir' in var._configuration.globalOptions:
+            pack_dir = str(var._configuration.globalOptions['staticParameterPackDir'])
+            if pack_dir == 'None':
+                pack_dir = None
+        if pack_dir is not None and not os.path.exists(pack_dir):
+            os.makedirs(pack_dir)
+        return cls(var, config_section_name, pack_dir)
+
+    def get_key(self):
+        """Function to compute the key of the pack"""
+        configuration = self.var._configuration
+        h = hashlib.sha1()
+        for section in [self.config_section_name, 'SOIL']:
+            for key, value in sorted(getattr(configuration, section).items()):
+                h.update(repr((section, key, value)).encode())
+                update_hash_with_file(h, value)
+        h.update(repr(str(configuration.cloneMap)).encode())
+        update_hash_with_file(h, configuration.cloneMap)
+        h.update(repr((self.var.nFarm, self.var.nCrop, self.var.nCell)).encode())
+        h.update(np.ascontiguousarray(self.var.landmask).tobytes())
+        return h.hexdigest()
+
+    def run(self, name, function, attrs):
+        """Function to compute a group of parameters, or to
+        restore them from the pack. 'attrs' lists the attributes
+        of the land cover object set by the group."""
+        if self.loaded and name in self.groups:
+            for attr, value in self.groups[name].items():
+                vars(self.var)[attr] = value
+            return
+        if not self.enabled:
+            function()
+            return
+        before = dict((attr, id(value)) for attr, value in vars(self.var).items())
+        function()
+        # attributes set by the group which are not listed would
+        # be missing when the group is restored from the pack
+        unlisted = sorted(
+            attr for attr, value in vars(self.var).items()
+            if before.get(attr) != id(value) and attr not in attrs)
+        if len(unlisted) > 0:
+            self.unlisted[name] = unlisted
+        missing = [attr for attr in attrs if attr not in vars(self.var)]
+        if len(missing) > 0:
+            logger.debug('Static parameter group ' + name + ' did not set ' + ', '.join(missing))
+            return
+        values = dict((attr, vars(self.var)[attr]) for attr in attrs)
+        # groups which set other objects (e.g. strings) are
+        # computed in every run
+        if not all(is_packable(value) for value in values.values()):
+            logger.debug('Static parameter group ' + name + ' cannot be packed')
+            return
+        # the arrays are copied, so that changes made by the
+        # model after the group has run are not saved
+        copies = dict()
+        for attr, value in values.items():
+            if id(value) not in copies:
+                copies[id(value)] = copy_parameter(value)
+            values[attr] = copies[id(value)]
+        self.recorded[name] = values
+
+    def save(self):
+        """Function to write the recorded parameters to the
+        pack file (if the pack was not loaded)"""
+        if not self.enabled or self.loaded:
+            return
+        if len(self.unlisted) > 0:
+            raise ModelError(
+                'Static parameter groups of ' + self.config_section_name + ' set attributes which are not listed: '
+                + '; '.join(name + ': ' + ', '.join(attrs) for name, attrs in sorted(self.unlisted.items())))
+        if len(self.recorded) == 0:
+            return
+        tmp_filename = self.filename + '.' + str(os.getpid()) + '.tmp'
+        write_pack(tmp_filename, self.recorded)
+        os.rename(tmp_filename, self.filename)
+        logger.info('Static parameters written to ' + self.filename)
+        self.recorded = dict()
+
+def update_hash_with_file(h, filename):
+    if isinstance(filename, basestring) and os.path.isfile(filename):
+        st = os.stat(filename)
+        h.update(repr((st.st_mtime, st.st_size)).encode())
+
+def is_packable(value):
+    if isinstance(value, np.ndarray):
+        return value.dtype.kind in 'biuf'
+    return isinstance(value, (bool, int, long, float, np.number, np.bool_))
+
+def get_compact_array(arr):
+    """Function to remove the axes along which an array has
+    been broadcast (i.e. has zero strides)"""
+    if arr.flags.writeable or 0 not in arr.strides:
+        return arr
+    return arr[tuple(slice(0, 1) if stride == 0 else slice(None) for stride in arr.strides)]
+
+def copy_parameter(value):
+    """Function to copy a parameter, keeping arrays which
+    have been broadcast compact"""
+    if not isinstance(value, np.ndarray):
+        return value
+    if isinstance(value, np.ma.MaskedArray):
+        return value.copy()
+    compact = get_compact_array(value)
+    if compact.shape == value.shape:
+        return value.copy()
+    return np.broadcast_to(compact.copy(), value.shape)
+
+class PackWriter(object):
+    def __init__(self):
+        self.arrays = []
+        self.size = 0
+
+    def add(self, arr):
+        """Function to add an array to the pack, returning its
+        description in the header"""
+        compact = np.ascontiguousarray(get_compact_array(arr))
+        offset = int(np.ceil(float(self.size) / pack_alignment) * pack_alignment)
+        self.arrays.append((offset, compact))
+        self.size = offset + compact.nbytes
+        info = {
+            'dtype' : compact.dtype.str,
+            'shape' : list(compact.shape),
+            'broadcast_shape' : None,
+            'offset' : offset}
+        if compact.shape != arr.shape:
+            info['broadcast_shape'] = list(arr.shape)
+        return info
+
+    def write(self, filename, header):
+        header = json.dumps(header).encode()
+        data_start = len(pack_signature) + 8 + len(header)
+        data_start = int(np.ceil(float(data_start) / pack_alignment) * pack_alignment)
+        with open(filename, 'wb') as f:
+            f.write(pack_signature)
+            f.write(struct.pack('<Q', data_start))
+            f.write(header)
+            for offset, arr in self.arrays:
+                f.seek(data_start + offset)
+                f.write(arr.tobytes())
+
+def write_pack(filename, groups):
+    writer = PackWriter()
+    header = dict()
+    for name, attrs in groups.items():
+        header[name] = dict()
+        stored = dict()
+        for attr, value in attrs.items():
+            if not isinstance(value, np.ndarray):
+                header[name][attr] = {'value' : np.asarray(value).item()}
+            elif id(value) in stored:
+                header[name][attr] = {'alias' : stored[id(value)]}
+            else:
+                stored[id(value)] = attr
+                info = writer.add(np.ma.getdata(value))
+                if isinstance(value, np.ma.MaskedArray):
+                    info['mask'] = writer.add(np.ma.getmaskarray(value))
+                header[name][attr] = info
+    writer.write(filename, header)
+
+def map_array(filename, data_start, info):
+    dtype = np.dtype(str(info['dtype']))
+    shape = tuple(info['shape'])
+    if np.prod(shape) == 0:
+        arr = np.zeros(shape, dtype=dtype)
+    else:
+        arr = np.memmap(
+            filename,
+            dtype = dtype,
+            mode = 'c',
+            offset = data_start + info['offset'],
+            shape = shape).view(np.ndarray)
+    if info['broadcast_shape'] is not None:
+        arr = np.broadcast_to(arr, tuple(info['broadcast_shape']))
+    return arr
+
+def read_pack(filename):
+    """Function to read a pack file. Arrays are memory mapped
+    copy-on-write, so that the model may modify them without
+    changing the file."""
+    with open(filename, 'rb') as f:
+        signature = f.read(len(pack_signature))
+        if signature != pack_signature:
+            raise ValueError('not a static parameter pack')
+        data_start = struct.unpack('<Q', f.read(8))[0]
+        header = f.read(data_start - len(pack_signature) - 8)
+    header = json.loads(header.rstrip(b'\0').decode())
+    groups = dict()
+    for name, attrs in header.items():
+        groups[name] = dict()
+        aliases = dict()
+        for attr, info in attrs.items():
+            attr = str(attr)
+            if 'value' in info:
+                groups[name][attr] = info['value']
+            elif 'alias' in info:
+                aliases[attr] = str(info['alias'])
+            else:
+                arr = map_array(filename, data_start, info)
+                if 'mask' in info:
+                    arr = np.ma.MaskedArray(arr, mask=map_array(filename, data_start, info['mask']))
+                groups[name][attr] = arr
+        for attr, target in aliases.items():
+            groups[name][attr] = groups[name][target]
+    return groups
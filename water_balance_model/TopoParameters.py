@@ -3,12 +3,19 @@
 
 import os
 import numpy as np
-import pcraster as pcr
 import VirtualOS as vos
 import netCDF4 as nc
 
+relative_elevation_var_names = [
+    'dzRel0001','dzRel0005','dzRel0010','dzRel0020',
+    'dzRel0030','dzRel0040','dzRel0050','dzRel0060',
+    'dzRel0070','dzRel0080','dzRel0090','dzRel0100']
+
 class TopoParameters(object):
 
+    # attributes set by 'initial'
+    static_parameters = tuple(relative_elevation_var_names) + ('elevation_standard_deviation',)
+
     def __init__(self, TopoParameters_variable, config_section_name):
         """Initialise TopoParameters object"""
         self.var = TopoParameters_variable
@@ -18,27 +25,26 @@ class TopoParameters(object):
         self.read()
         
     def read(self):
-        relative_elevation_var_names = [
-            'dzRel0001','dzRel0005','dzRel0010','dzRel0020',
-            'dzRel0030','dzRel0040','dzRel0050','dzRel0060',
-            'dzRel0070','dzRel0080','dzRel0090','dzRel0100']
-            
         for var_name in relative_elevation_var_names:
             d = vos.netcdf2PCRobjCloneWithoutTime(
                 str(self.lc_configuration['relativeElevationInputFile']),
                 var_name,
-                cloneMapFileName=self.var.cloneMap)[self.var.landmask]
+                cloneMapFileName=self.var.cloneMap,
+                landmask=self.var.landmask)
             vars(self.var)[var_name] = d
 
         self.var.elevation_standard_deviation = vos.netcdf2PCRobjCloneWithoutTime(
             str(self.lc_configuration['elevationStandardDeviationInputFile']),
             'dem_standard_deviation',
-            cloneMapFileName = self.var.cloneMap)[self.var.landmask]
+            cloneMapFileName = self.var.cloneMap,
+            landmask = self.var.landmask)
         
     def dynamic(self):
         pass
 
 class TopoParametersNaturalVegetation(TopoParameters):
+    static_parameters = TopoParameters.static_parameters + ('arno_beta_add', 'arno_beta', 'arno_beta_oro')
+
     def initial(self):
         super(TopoParametersNaturalVegetation, self).initial()
         self.compute_arno_beta()
@@ -15,20 +15,232 @@ import types
 import calendar
 import glob
 import time
+import struct
+import threading
+import functools
 
 import netCDF4 as nc
 import numpy as np
 import numpy.ma as ma
-import pcraster as pcr
 import string
+import zlib
 
 from Messages import *
 
+from collections import OrderedDict
+
 import logging
 logger = logging.getLogger(__name__)
 
+class FileCache(object):
+    """Cache of open netCDF datasets, to minimize/reduce 
+    opening/closing files. At most 'capacity' datasets are 
+    kept open: when the cache is full the least recently used
+    dataset which is not pinned or being read is closed.
+    Pinned files (e.g. multi-year forcing files which are read
+    every time step) are never closed.
+    """
+    def __init__(self, capacity = 64):
+        self.capacity = capacity
+        self.datasets = OrderedDict()
+        self.pinned = set()
+        self.in_use = dict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, ncFile):
+        return ncFile in self.datasets
+
+    def __len__(self):
+        return len(self.datasets)
+    
+    def get(self, ncFile):
+        """Function to get the dataset of a netCDF file, 
+        opening it if it is not in the cache"""
+        with self.lock:
+            f = self.datasets.pop(ncFile, None)
+            if f is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                f = nc.Dataset(ncFile)
+            self.datasets[ncFile] = f
+            self.evict()
+            return f
+        
+    def pin(self, ncFile):
+        with self.lock:
+            self.pinned.add(ncFile)
+
+    def unpin(self, ncFile):
+        with self.lock:
+            self.pinned.discard(ncFile)
+            self.evict()
+
+    def acquire(self, ncFile):
+        """Function to mark a file as being read, so that its
+        dataset is not closed until it is released"""
+        with self.lock:
+            self.in_use[ncFile] = self.in_use.get(ncFile, 0) + 1
+
+    def release(self, ncFile):
+        with self.lock:
+            count = self.in_use.pop(ncFile) - 1
+            if count > 0:
+                self.in_use[ncFile] = count
+
+    def set_capacity(self, capacity):
+        with self.lock:
+            self.capacity = max(1, int(capacity))
+            self.evict()
+        
+    def evict(self):
+        """Function to close the least recently used datasets
+        until the number of open datasets is within capacity.
+        The most recently used dataset, pinned datasets and
+        datasets which are being read (see acquire) are skipped.
+        """
+        excess = len(self.datasets) - self.capacity
+        if excess <= 0:
+            return
+        for ncFile in list(self.datasets.keys())[:-1]:
+            if excess <= 0:
+                break
+            if ncFile in self.pinned or self.in_use.get(ncFile, 0) > 0:
+                continue
+            self.close(ncFile)
+            self.evictions += 1
+            excess -= 1
+
+    def close(self, ncFile):
+        """Function to close a dataset and remove the cached 
+        information derived from it"""
+        f = self.datasets.pop(ncFile)
+        try:
+            f.close()
+        except RuntimeError:
+            pass
+        for cache in (timeindexcache, gridmappingfilecache):
+            for key in [key for key in cache.keys() if key[0] == ncFile]:
+                del cache[key]
+
+    def close_all(self):
+        with self.lock:
+            for ncFile in list(self.datasets.keys()):
+                self.close(ncFile)
+
+    def report(self):
+        logger.info(
+            'netCDF file cache: %i hits, %i misses, %i evictions (%i files open)',
+            self.hits,
+            self.misses,
+            self.evictions,
+            len(self.datasets))
+
+class FieldCache(object):
+    """Cache of fields read from netCDF files (after 
+    resampling and compression to the landmask), so that 
+    fields which are read repeatedly, such as climatologies, 
+    are only read once. Fields are kept within a budget of 
+    'max_bytes', evicting the least recently used field. 
+    Cached fields are shared, and therefore read-only.
+    """
+    def __init__(self, max_bytes = 256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.fields = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, read_function):
+        """Function to get a field from the cache, calling 
+        read_function to read it if it is not present"""
+        with self.lock:
+            arr = self.fields.pop(key, None)
+            if arr is not None:
+                self.fields[key] = arr
+                self.hits += 1
+                return arr
+            self.misses += 1
+        arr = read_function()
+        arr.setflags(write=False)
+        with self.lock:
+            if key not in self.fields and arr.nbytes <= self.max_bytes:
+                self.fields[key] = arr
+                self.nbytes += arr.nbytes
+                self.evict()
+        return arr
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+            
+    def evict(self):
+        while self.nbytes > self.max_bytes:
+            key, arr = self.fields.popitem(last=False)
+            self.nbytes -= arr.nbytes
+            self.evictions += 1
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.
+        return float(self.hits) / total
+    
+    def report(self):
+        logger.info(
+            'netCDF field cache: %i hits, %i misses (hit rate %.1f%%), %i evictions, %.1f MB cached',
+            self.hits,
+            self.misses,
+            100. * self.hit_rate(),
+            self.evictions,
+            self.nbytes / 1024. ** 2)
+        
 # file cache to minimize/reduce opening/closing files.  
-filecache = dict()
+filecache = FileCache()
+
+# cache of fields read at a given time (see netcdf2PCRobjClone)
+fieldcache = FieldCache()
+
+# cache of map attributes, keyed by (path, mtime, arcDegree)
+mapattrcache = dict()
+
+# cache of MapMapping objects, keyed by the attributes of the
+# input map and the clone map
+mapmappingcache = dict()
+
+# cache of netCDF time axis indices, keyed by (path, time variable)
+timeindexcache = dict()
+
+# cache of GridMapping objects, keyed by input grid and clone
+# attributes, and the mapping used for each file
+gridmappingcache = dict()
+gridmappingfilecache = dict()
+
+# windows of clone maps to which the model grid is cropped,
+# keyed by absolute path - see set_clone_window
+clonewindows = dict()
+
+# cache of static fields (read by netcdf2PCRobjCloneWithoutTime)
+# shared between model components while the model is initialised,
+# keyed by canonical path, variable, grid mapping and landmask -
+# see start_static_read_cache
+staticreadcache = None
+staticreadhits = 0
+
+# lock to serialize access to netCDF files (and the caches above)
+# when files are read from more than one thread, because the
+# netCDF/HDF5 libraries are not generally thread-safe. If the
+# libraries are built to be thread-safe, different files may be
+# read concurrently and only access to the same file is locked.
+netcdf_lock = threading.RLock()
+netcdf_thread_safe = False
+netcdf_file_locks = dict()
 
 # Global variables:
 MV = 1e20
@@ -37,6 +249,46 @@ smallNumber = 1E-39
 # Tuple of netcdf file suffixes (extensions) that can be used:
 netcdf_suffixes = ('.nc4','.nc')
 
+# Tuple of GeoTIFF file suffixes
+geotiff_suffixes = ('.tif','.tiff')
+
+# Backend used to read maps on the clone (see set_map_backend):
+# with 'numpy' the clone and maps are read from their headers
+# and arrays, and PCRaster is only imported if it is selected
+map_backends = ('numpy','pcraster')
+map_backend = 'numpy'
+pcr = None
+
+# PCRaster (CSF) map header layout
+csf_signature = b'RUU CROSS SYSTEM MAP FORMAT'
+csf_header_size = 256
+
+# numpy types of the CSF cell representations
+csf_cell_types = {
+    0x00 : 'u1',                # UINT1
+    0x04 : 'i1',                # INT1
+    0x11 : 'u2',                # UINT2
+    0x15 : 'i2',                # INT2
+    0x22 : 'u4',                # UINT4
+    0x26 : 'i4',                # INT4
+    0x5A : 'f4',                # REAL4
+    0xDB : 'f8'}                # REAL8
+
+# sizes and struct formats of the TIFF field types
+tiff_field_types = {
+    1  : (1, 'B'),              # BYTE
+    2  : (1, 's'),              # ASCII
+    3  : (2, 'H'),              # SHORT
+    4  : (4, 'I'),              # LONG
+    6  : (1, 'b'),              # SBYTE
+    8  : (2, 'h'),              # SSHORT
+    9  : (4, 'i'),              # SLONG
+    11 : (4, 'f'),              # FLOAT
+    12 : (8, 'd')}              # DOUBLE
+
+# numpy type kinds of the TIFF sample formats
+tiff_sample_formats = {1 : 'u', 2 : 'i', 3 : 'f'}
+
 # def getFileList(inputDir, filePattern):
 # 	'''creates a dictionary of	files meeting the pattern specified'''
 # 	fileNameList = glob.glob(os.path.join(inputDir, filePattern))
@@ -70,6 +322,49 @@ def gdal_warp(input_filename, output_filename, minx, miny, maxx, maxy):
     subprocess.check_output(cmd, shell=True)
     # os.system(cmd)
 
+def set_netcdf_thread_safe(thread_safe):
+    """Function to declare whether the netCDF/HDF5 libraries
+    are thread-safe, in which case different files can be
+    read concurrently from several threads.
+    """
+    global netcdf_thread_safe
+    netcdf_thread_safe = bool(thread_safe)
+
+def set_map_backend(backend):
+    """Function to select the backend used to read maps on
+    the clone ('numpy' or 'pcraster'). PCRaster is imported
+    when it is selected.
+    """
+    global map_backend, pcr
+    if backend not in map_backends:
+        raise ModelError('unknown map backend ' + str(backend) + ' (must be one of ' + ', '.join(map_backends) + ')')
+    if backend == 'pcraster' and pcr is None:
+        import pcraster as pcr
+    map_backend = backend
+
+def get_netcdf_lock(ncFile):
+    if not netcdf_thread_safe:
+        return netcdf_lock
+    with netcdf_lock:
+        return netcdf_file_locks.setdefault(str(ncFile), threading.RLock())
+    
+def with_netcdf_lock(func):
+    """Decorator to hold the lock for a netCDF file while a 
+    function which reads from it is running. The file must be
+    the first argument of the function. The file is marked as
+    being read in the file cache, so that its dataset is not
+    closed by another thread in the meantime.
+    """
+    @functools.wraps(func)
+    def locked_func(ncFile, *args, **kwargs):
+        filecache.acquire(ncFile)
+        try:
+            with get_netcdf_lock(ncFile):
+                return func(ncFile, *args, **kwargs)
+        finally:
+            filecache.release(ncFile)
+    return locked_func
+
 def get_clone_map_extent(cloneMapFileName):
     cloneAtt = getMapAttributesALL(cloneMapFileName)
     xmin = cloneAtt['xUL']
@@ -95,15 +390,9 @@ def check_format_args_ok(format_args, allowable_args, allow_duplicates=True):
         format_args_ok = not any_duplicates(format_args)
     return format_args_ok
 
+@with_netcdf_lock
 def check_if_nc_variable_has_dimension(ncFile, varname, dimname):
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-    else:
-        try:
-            f = nc.Dataset(ncFile)
-        except:
-            AQFileError(ncFile)
-        filecache[ncFile] = f
+    f = read_netCDF(ncFile)
     res = False
     try:
         res = (dimname in f.variables[varname].dimensions)
@@ -111,32 +400,20 @@ def check_if_nc_variable_has_dimension(ncFile, varname, dimname):
         pass
     return res
 
+@with_netcdf_lock
 def checkVariableInNC(ncFile,varName):
     logger.debug('Check whether the variable: '+str(varName)+' is defined in the file: '+str(ncFile))    
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-    else:
-        try:
-            f = nc.Dataset(ncFile)
-        except:
-            ModelFileError(ncFile)
-        filecache[ncFile] = f
+    f = read_netCDF(ncFile)
 
     varName = str(varName)    
     return varName in f.variables.keys()
 
+@with_netcdf_lock
 def get_dimension_variable(ncFile,dimName):    
     if not checkVariableInNC(ncFile, dimName):            
         dimvar = None
     else:
-        if ncFile in filecache.keys():
-            f = filecache[ncFile]
-        else:
-            try:
-                f = nc.Dataset(ncFile)
-            except:
-                ModelFileError(ncFile)
-            filecache[ncFile] = f
+        f = read_netCDF(ncFile)
     
         dimName = str(dimName)
         dimvar = f.variables[dimName][:]    
@@ -324,12 +601,7 @@ def get_dimension_variable(ncFile,dimName):
 #     return (outnp)
 
 def read_netCDF(ncFile):
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
-    return f
+    return filecache.get(ncFile)
 
 def rename_latlong_dims(f, LatitudeLongitude):
     if LatitudeLongitude == True:
@@ -415,88 +687,250 @@ def get_time_calendar(nctime):
 #     if yULClone != yULInput: sameClone = False
 #     return sameClone
     
-# TODO: refactor
-def resample_nc_data(f, varName, cloneMapFileName, timeDimName = None, timeIndex = None):
-
-    # TODO: https://stackoverflow.com/a/35507245 (xarray and dask)
+class GridMapping(object):
+    """Mapping between the grid of a netCDF input and the 
+    clone map. It holds the window of the input grid which
+    covers the clone (in file coordinates, so that only this
+    window is read from file), whether the latitude axis of
+    the input must be flipped, and the refinement factor.
+    The mapping depends only on the input coordinates and the
+    clone attributes, so it is computed once for each 
+    combination (see get_grid_mapping).
+    """
+    def __init__(self, input_latitudes, input_longitudes, attributeClone = None):
+        self.rowsInput = len(input_latitudes)
+        self.colsInput = len(input_longitudes)
+        self.sameClone = True
+        if attributeClone is not None:
+            cellsizeClone = attributeClone['cellsize']
+            rowsClone = attributeClone['rows']
+            colsClone = attributeClone['cols']
+            xULClone = attributeClone['xUL']
+            yULClone = attributeClone['yUL']
+
+            # get the attributes of input (netCDF)
+            cellsizeInput = float(abs(input_latitudes[0] - input_latitudes[1]))
+            xULInput = np.min(input_longitudes) - 0.5 * cellsizeInput
+            yULInput = np.max(input_latitudes) + 0.5 * cellsizeInput
+
+            # check whether both maps have the same attributes 
+            # NB: the original code (PCRGLOBWB) used the following line to test
+            # equality between cellsize:
+            #     if cellsizeClone != cellsizeInput: sameClone = False
+            # but this is not sensible when dealing with decimal degrees
+            # (e.g. 5 arcminute -> 0.08333333) and netCDF files which may have
+            # varying levels of precision depending on the creation options of the
+            # user. Instead, test almost equality:
+            if abs(cellsizeClone - cellsizeInput) > 1e-8: self.sameClone = False
+            if rowsClone != self.rowsInput: self.sameClone = False
+            if colsClone != self.colsInput: self.sameClone = False
+            if xULClone != xULInput: self.sameClone = False
+            if yULClone != yULInput: self.sameClone = False
+
+        # the model stores latitudes from high to low (N -> S)
+        netcdf_y_orientation_follow_cf_convention = (input_latitudes[0] - input_latitudes[1]) > 0
+        self.flip = not netcdf_y_orientation_follow_cf_convention
+        if self.flip:
+            input_latitudes = input_latitudes[::-1]
+
+        # window of the (flipped) input grid covering the clone
+        self.ySlice = slice(0, self.rowsInput)
+        self.xSlice = slice(0, self.colsInput)
+        self.factor = 1
+        
+        # offset (in clone cells) of the clone map within the
+        # first input cell of the window, which is non-zero if
+        # the clone is not aligned with the (coarser) input 
+        # grid, e.g. if the model grid is cropped
+        self.yOffset = 0
+        self.xOffset = 0
+        self.rowsClone = None
+        self.colsClone = None
+        if self.sameClone == False:
+            logger.debug('Crop to the clone map with upper left corner (x,y): '+ str(xULClone) + ' , ' + str(yULClone))
+            self.factor = int(round(float(cellsizeInput) / float(cellsizeClone)))
+            self.rowsClone = int(rowsClone)
+            self.colsClone = int(colsClone)
+
+            # the first input cell of the window is the cell 
+            # containing the centre of the first clone cell;
+            # longitudes are ascending (i.e. W -> E), hence we *add* half
+            # the clone cellsize to the clone map western boundary
+            minX    = min(abs(input_longitudes[:] - (xULClone + 0.5 * cellsizeClone)))
+            xIdxSta = int(np.where(abs(input_longitudes[:] - (xULClone + 0.5 * cellsizeClone)) == minX)[0][0])
+            xOffset = (xULClone - (input_longitudes[xIdxSta] - 0.5 * cellsizeInput)) / cellsizeClone
+            self.xOffset = min(max(int(round(xOffset)), 0), self.factor - 1)
+            xIdxEnd = int(math.ceil(xIdxSta + (self.xOffset + colsClone) / (cellsizeInput / cellsizeClone)))
+
+            # latitudes are descending (i.e. N -> S), hence we *subtract*
+            # half the clone cellsize from the clone map northern boundary
+            minY    = min(abs(input_latitudes - (yULClone - 0.5 * cellsizeClone)))
+            yIdxSta = int(np.where(abs(input_latitudes - (yULClone - 0.5 * cellsizeClone)) == minY)[0][0])
+            yOffset = ((input_latitudes[yIdxSta] + 0.5 * cellsizeInput) - yULClone) / cellsizeClone
+            self.yOffset = min(max(int(round(yOffset)), 0), self.factor - 1)
+            yIdxEnd = int(math.ceil(yIdxSta + (self.yOffset + rowsClone) / (cellsizeInput / cellsizeClone)))
+
+            self.xSlice = slice(xIdxSta, min(xIdxEnd, self.colsInput))
+            self.ySlice = slice(yIdxSta, min(yIdxEnd, self.rowsInput))
+            if self.factor > 1:
+                logger.debug('Resample: input cell size = '
+                             + str(float(cellsizeInput))
+                             + ' ; output/clone cell size = '
+                             + str(float(cellsizeClone)))
+
+        # the same window in the coordinates of the file
+        self.xReadSlice = self.xSlice
+        self.yReadSlice = self.ySlice
+        if self.flip:
+            self.yReadSlice = slice(
+                self.rowsInput - self.ySlice.stop,
+                self.rowsInput - self.ySlice.start)
+
+        # (landmask, indices) pairs - see get_landmask_indices
+        self.landmask_indices = []
+
+    def read(self, ncvar, slc):
+        """Function to read the window covering the clone map
+        from a netCDF variable whose last two dimensions are
+        latitude and longitude. 'slc' selects the other 
+        dimensions.
+        """
+        slc = list(slc)
+        slc[-2] = self.yReadSlice
+        slc[-1] = self.xReadSlice
+        data = ncvar[tuple(slc)]
+        if self.flip:
+            data = np.flip(data, axis=-2)
+        return data
+
+    def resample(self, data):
+        """Function to resample data read with 'read' to the 
+        clone map"""
+        arr = regridData2FinerGrid(self.factor, data, MV)
+        if self.rowsClone is not None:
+            arr = arr[...,
+                      self.yOffset:(self.yOffset + self.rowsClone),
+                      self.xOffset:(self.xOffset + self.colsClone)]
+        return arr
+
+    def get_landmask_indices(self, landmask):
+        """Function to get, for each cell in the landmask (in
+        the order given by landmask indexing), the flat index
+        of the input cell containing it within the window 
+        returned by 'read'.
+        """
+        for mask, indices in self.landmask_indices:
+            if mask is landmask:
+                return indices
+        rows, cols = np.nonzero(landmask)
+        ncols = self.xSlice.stop - self.xSlice.start
+        indices = ((rows + self.yOffset) // self.factor) * ncols + ((cols + self.xOffset) // self.factor)
+        self.landmask_indices.append((landmask, indices))
+        return indices
     
-    # compare spatial attributes of input map with those of clone map
+    def gather(self, data, landmask):
+        """Function to take the values of the cells in the
+        landmask directly from data read with 'read'. This is
+        equivalent to resample(data)[..., landmask], but does
+        not allocate the data on the (finer) clone grid. As in
+        regridData2FinerGrid, data which are refined (factor
+        > 1) are returned as float64 without a mask.
+        """
+        indices = self.get_landmask_indices(landmask)
+        if self.factor > 1:
+            data = np.ma.getdata(data).astype(np.float64)
+        data = data.reshape(data.shape[:-2] + (-1,))
+        return data.take(indices, axis=-1)
+
+def set_clone_window(cloneMapFileName, attributes):
+    """Function to crop the model grid to a window of the 
+    clone map, with the given raster attributes. Inputs read
+    on the clone map are then read (and resampled) for the
+    window only.
+    """
+    clonewindows[os.path.abspath(str(cloneMapFileName))] = dict(attributes)
+
+def get_clone_attributes(cloneMapFileName):
+    """Function to get the raster attributes of the model
+    grid defined by a clone map (i.e. of its window, if the
+    grid is cropped)"""
+    key = os.path.abspath(str(cloneMapFileName))
+    if key in clonewindows:
+        return dict(clonewindows[key])
+    return getMapAttributesALL(cloneMapFileName)
+
+def get_clone_window(landmask, attributes, padding = 0):
+    """Function to get the bounding box of the cells in a 
+    landmask, extended by 'padding' cells on each side (within
+    the clone). Returns the row and column slices of the box
+    and its raster attributes.
+    """
+    rows, cols = np.nonzero(landmask)
+    if len(rows) == 0:
+        raise ModelError('landmask does not contain any cells')
+    ySlice = slice(
+        max(0, int(rows.min()) - padding),
+        min(landmask.shape[0], int(rows.max()) + 1 + padding))
+    xSlice = slice(
+        max(0, int(cols.min()) - padding),
+        min(landmask.shape[1], int(cols.max()) + 1 + padding))
+    window = dict(attributes)
+    window['xUL'] = attributes['xUL'] + xSlice.start * attributes['cellsize']
+    window['yUL'] = attributes['yUL'] - ySlice.start * attributes['cellsize']
+    window['rows'] = float(ySlice.stop - ySlice.start)
+    window['cols'] = float(xSlice.stop - xSlice.start)
+    return ySlice, xSlice, window
+
+def get_clone_key(cloneMapFileName, cloneMapAttributes = None):
+    if cloneMapFileName is None:
+        return None
+    if cloneMapAttributes is None:
+        cloneMapAttributes = get_clone_attributes(cloneMapFileName)
+    return tuple(sorted(cloneMapAttributes.items()))
+
+def get_grid_mapping(ncFile, f, cloneMapFileName, cloneMapAttributes = None):
+    """Function to get the GridMapping between a netCDF file
+    and the clone map. Mappings are cached for each file, so 
+    that the coordinates of a file are read once, and shared
+    between files with the same grid.
+    """
+    clone_key = get_clone_key(cloneMapFileName, cloneMapAttributes)
+    file_key = (ncFile, clone_key)
+    if file_key not in gridmappingfilecache:
+        input_latitudes = f.variables['lat'][:]
+        input_longitudes = f.variables['lon'][:]
+        grid_key = (
+            len(input_latitudes), len(input_longitudes),
+            float(input_latitudes[0]), float(input_latitudes[-1]),
+            float(input_longitudes[0]), float(input_longitudes[-1]),
+            clone_key)
+        if grid_key not in gridmappingcache:
+            attributeClone = None
+            if clone_key is not None:
+                attributeClone = dict(clone_key)
+            gridmappingcache[grid_key] = GridMapping(
+                input_latitudes,
+                input_longitudes,
+                attributeClone)
+        gridmappingfilecache[file_key] = gridmappingcache[grid_key]
+    return gridmappingfilecache[file_key]
+
+def resample_nc_data(f, varName, grid_mapping, timeDimName = None, timeIndex = None, landmask = None):
 
+    # TODO: https://stackoverflow.com/a/35507245 (xarray and dask)
     var_dims = f.variables[varName].dimensions
     slc = [slice(None)] * len(var_dims)
     if (timeIndex is not None) and (timeDimName is not None):
         time_axis = [i for i in range(len(var_dims)) if var_dims[i] == timeDimName][0]
         slc[time_axis] = timeIndex
-    cropData = f.variables[varName][slc]
-    
-    input_latitudes = f.variables['lat'][:]
-    input_longitudes = f.variables['lon'][:]
-    sameClone = True
-    if cloneMapFileName != None:
-        attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        
-        # get the attributes of input (netCDF)
-        cellsizeInput = float(abs(input_latitudes[0] - input_latitudes[1]))
-        rowsInput = len(input_latitudes)
-        colsInput = len(input_longitudes)
-        xULInput = np.min(input_longitudes) - 0.5 * cellsizeInput
-        yULInput = np.max(input_latitudes) + 0.5 * cellsizeInput
-        
-        # check whether both maps have the same attributes 
-        # NB: the original code (PCRGLOBWB) used the following line to test
-        # equality between cellsize:
-        #     if cellsizeClone != cellsizeInput: sameClone = False
-        # but this is not sensible when dealing with decimal degrees
-        # (e.g. 5 arcminute -> 0.08333333) and netCDF files which may have
-        # varying levels of precision depending on the creation options of the
-        # user. Instead, test almost equality:
-        if abs(cellsizeClone - cellsizeInput) > 1e-8: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
-
-    netcdf_y_orientation_follow_cf_convention = (input_latitudes[0] - input_latitudes[1]) > 0
-    if not netcdf_y_orientation_follow_cf_convention:
-        cropData = np.flip(cropData, axis=-2)
-        input_latitudes = input_latitudes[::-1]
-        
-    factor = 1
-    if sameClone == False:
-        logger.debug('Crop to the clone map with upper left corner (x,y): '+ str(xULClone) + ' , ' + str(yULClone))
-        minX    = min(abs(input_longitudes[:] - (xULClone + 0.5 * cellsizeInput)))
-
-        # longitudes are ascending (i.e. W -> E), hence we *add* half
-        # the input cellsize to the clone map western boundary
-        xIdxSta = int(np.where(abs(input_longitudes[:] - (xULClone + 0.5 * cellsizeInput)) == minX)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone / (cellsizeInput / cellsizeClone)))        
-        xStep   = (xIdxEnd - xIdxSta) / abs(xIdxEnd - xIdxSta)
-
-        # latitudes are descending (i.e. N -> S), hence we *subtract*
-        # half the input cellsize from the clone map northern boundary
-        minY    = min(abs(input_latitudes - (yULClone - 0.5 * cellsizeInput)))
-        yIdxSta = int(np.where(abs(input_latitudes - (yULClone - 0.5 * cellsizeInput)) == minY)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone / (cellsizeInput / cellsizeClone)))
-        yStep   = (yIdxEnd - yIdxSta) / abs(yIdxEnd - yIdxSta)
-
-        xSlice = slice(xIdxSta, xIdxEnd, xStep)
-        ySlice = slice(yIdxSta, yIdxEnd, yStep)
-        cropData = cropData[...,ySlice, xSlice]
-        factor = int(round(float(cellsizeInput) / float(cellsizeClone)))
-        
-    if factor > 1:
-        logger.debug('Resample: input cell size = '
-                     + str(float(cellsizeInput))
-                     + ' ; output/clone cell size = '
-                     + str(float(cellsizeClone)))
-    arr = regridData2FinerGrid(factor,cropData,MV)
+    cropData = grid_mapping.read(f.variables[varName], slc)
+    if landmask is not None:
+        arr = grid_mapping.gather(cropData, landmask)
+    else:
+        arr = grid_mapping.resample(cropData)
     return arr
 
+@with_netcdf_lock
 def netcdf2NumpyDailyTimeSlice(ncFile, varName, startDate, #endDate,
                                useDoy = None,
                                cloneMapFileName = None,
@@ -509,20 +943,17 @@ def netcdf2NumpyDailyTimeSlice(ncFile, varName, startDate, #endDate,
     f = rename_latlong_dims(f, LatitudeLongitude)
     t_varname = get_time_variable_name(f)
     t_dimname = get_time_dimension_name(f)
-    t_unit = get_time_units(f.variables[t_varname])
-    t_calendar = get_time_calendar(f.variables[t_varname])
-    startDate = format_date(startDate, f.variables[t_varname], useDoy)
+    time_index = get_netcdf_time_index(ncFile, f, t_varname)
+    startDate = format_date(startDate, time_index, useDoy, ncFile, varName)
     endDate = startDate + datetime.timedelta(days=1)
-    lastDateInNC = nc.num2date(f.variables[t_varname][-1], units=t_unit, calendar=t_calendar)
-    startIndex = nc.date2index(datetime.datetime(startDate.year, startDate.month, startDate.day, 0, 0, 0), f.variables[t_varname])
-    if endDate <= lastDateInNC:
-        endIndex = nc.date2index(datetime.datetime(endDate.year, endDate.month, endDate.day, 0, 0, 0), f.variables[t_varname])
-        # print endIndex
+    startIndex = time_index.exact_index(startDate)
+    if endDate <= time_index.last_date:
+        endIndex = time_index.exact_index(endDate)
     else:
-        endIndex = f.variables[t_varname].size        
+        endIndex = time_index.size
     timeIndex = np.arange(startIndex, endIndex)
-    # print timeIndex
-    arr = resample_nc_data(f, varName, cloneMapFileName, t_dimname, timeIndex)
+    grid_mapping = get_grid_mapping(ncFile, f, cloneMapFileName)
+    arr = resample_nc_data(f, varName, grid_mapping, t_dimname, timeIndex)
     f = None
     return arr
 
@@ -542,7 +973,8 @@ def get_nearest_date_to_year(year, date):
         date = datetime.datetime(year, date.month, date.day)
     return date
 
-def format_date(date, nctime, useDoy):
+def format_date(date, time_index, useDoy, ncFile = None, varName = None):
+    dateInput = date
     if isinstance(date, str):
         date = datetime.datetime.strptime(str(date),'%Y-%m-%d')        
     date = datetime.datetime(date.year,date.month,date.day)  # currently only support daily
@@ -551,8 +983,8 @@ def format_date(date, nctime, useDoy):
     if useDoy == "monthly":
         date = datetime.datetime(date.year,date.month,int(1))
     if useDoy == "yearly" or useDoy == "monthly" or useDoy == "daily_seasonal":
-        first_year_in_nc_file = findFirstYearInNCTime(nctime)
-        last_year_in_nc_file  =  findLastYearInNCTime(nctime)
+        first_year_in_nc_file = time_index.first_year
+        last_year_in_nc_file  = time_index.last_year
         if date.year < first_year_in_nc_file:
             date = get_nearest_date_to_year(first_year_in_nc_file, date)
             msg = get_message_for_using_nearest_year(ncFile, varName, dateInput, date)
@@ -565,25 +997,73 @@ def format_date(date, nctime, useDoy):
 
     return date
 
-def get_date_index_exact(ncFile, date, t_varname, t_unit, t_calendar):
-    datenum = nc.date2num(date, t_unit, t_calendar)
-    timevar = ncFile[t_varname][:]
-    idx = int(np.nonzero(timevar == datenum)[0][0])
-    return idx
-
-def get_date_index_before(ncFile, date, t_varname, t_unit, t_calendar):
-    datenum = nc.date2num(date, t_unit, t_calendar)
-    timevar = ncFile[t_varname][:]
-    times_before_current_time = np.nonzero(timevar < datenum)
-    idx = int(np.max(times_before_current_time))
-    return idx
-
-def get_date_index_after(ncFile, date, t_varname, t_unit, t_calendar):
-    datenum = nc.date2num(date, t_unit, t_calendar)
-    timevar = ncFile[t_varname][:]
-    times_after_current_time = np.nonzero(timevar > datenum)
-    idx = int(np.max(times_after_current_time))
-    return idx
+class NetCDFTimeIndex(object):
+    """Index of the time axis of a netCDF file. The time 
+    variable is read and decoded once, after which dates are 
+    resolved to time indices with a hash lookup (exact match)
+    or a binary search on the sorted axis (nearest before or 
+    after). Resolved dates are memoized.
+    """
+    def __init__(self, nctime):
+        self.units = get_time_units(nctime)
+        self.calendar = get_time_calendar(nctime)
+        times = np.asarray(nctime[:], dtype=np.float64)
+        self.size = times.size
+        
+        # map each time value to its (first) index in the file
+        self.exact = {}
+        for idx, value in enumerate(times):
+            self.exact.setdefault(float(value), idx)
+            
+        self.order = np.argsort(times, kind='mergesort')
+        self.sorted_times = times[self.order]
+        self.first_date = nc.num2date(self.sorted_times[0], self.units, self.calendar)
+        self.last_date = nc.num2date(self.sorted_times[-1], self.units, self.calendar)
+        self.first_year = self.first_date.year
+        self.last_year = self.last_date.year
+        self.resolved = {}
+
+    def date2num(self, date):
+        return float(nc.date2num(date, self.units, self.calendar))
+    
+    def exact_index(self, date):
+        """Function to get the index of a date which must be 
+        present in the time axis
+        """
+        idx, option = self.resolve(date)
+        if option != 'exact':
+            raise ValueError('date ' + str(date) + ' not found in time axis')
+        return idx
+    
+    def resolve(self, date):
+        """Function to resolve a date to a time index. Returns
+        the index and the option used to select it ('exact', 
+        'before' or 'after').
+        """
+        try:
+            return self.resolved[date]
+        except KeyError:
+            pass
+        datenum = self.date2num(date)
+        if datenum in self.exact:
+            res = (self.exact[datenum], 'exact')
+        else:
+            pos = int(np.searchsorted(self.sorted_times, datenum))
+            if pos > 0:
+                res = (int(self.order[pos - 1]), 'before')
+            else:
+                res = (int(self.order[0]), 'after')
+        self.resolved[date] = res
+        return res
+    
+def get_netcdf_time_index(ncFile, f, t_varname):
+    """Function to get the time index of an opened netCDF 
+    file, building it the first time the file is read.
+    """
+    key = (ncFile, t_varname)
+    if key not in timeindexcache:
+        timeindexcache[key] = NetCDFTimeIndex(f.variables[t_varname])
+    return timeindexcache[key]
         
 def get_date_availability_message(date, available=True):
     if available:
@@ -607,60 +1087,268 @@ def get_message_for_using_date_before_or_after(ncFile, varName, date, using_befo
     msg += "\n"
     return msg
     
-def get_time_index(ncFile, varName, date, t_varname, t_unit, t_calendar):    
-    try:
-        idx = get_date_index_exact(ncFile, date, t_varname, t_unit, t_calendar)
+def get_time_index(ncFile, varName, date, time_index):
+    idx, option = time_index.resolve(date)
+    if option == 'exact':
         msg = get_date_availability_message(date, available=True)
         logger.debug(msg)
-    except:
+    else:
         msg = get_date_availability_message(date, available=False)
         logger.debug(msg)
-        try:
-            idx = get_date_index_before(ncFile, date, t_varname, t_unit, t_calendar)
-            msg = get_message_for_using_date_before_or_after(ncFile, varName, date, using_before=True)
-        except:
-            idx = get_date_index_after(ncFile, date, t_varname, t_unit, t_calendar)
-            msg = get_message_for_using_date_before_or_after(ncFile, varName, date, using_before=False)
+        msg = get_message_for_using_date_before_or_after(ncFile, varName, date, using_before=(option == 'before'))
         logger.debug(msg)
     return idx
     
+@with_netcdf_lock
 def netcdf2PCRobjClone(ncFile,varName,dateInput,
                        useDoy = None,
                        cloneMapFileName  = None,
                        cloneMapAttributes = None,
                        LatitudeLongitude = True,
-                       specificFillValue = None):
-    
+                       specificFillValue = None,
+                       landmask = None,
+                       cache = False):
+    """Function to read a netCDF variable at a given date on
+    the clone map. If landmask is supplied only the cells in
+    the landmask are returned (i.e. the result is the same as
+    indexing the clone map array with landmask), and these
+    are taken directly from the input grid. If cache is True
+    the field is kept in the field cache, and the (read-only)
+    cached array is returned when the same field is requested
+    again.
+    """
     logger.debug('Reading variable: ' + str(varName) + ' from the file: ' + str(ncFile))
     f = read_netCDF(ncFile)
     varName = str(varName)
     f = rename_latlong_dims(f, LatitudeLongitude)
     t_varname = get_time_variable_name(f)
     t_dimname = get_time_dimension_name(f)
-    date = format_date(dateInput, f.variables[t_varname], useDoy)
-    t_unit = get_time_units(f.variables[t_varname])
-    t_calendar = get_time_calendar(f.variables[t_varname])
-    timeIndex = get_time_index(f, varName, date, t_varname, t_unit, t_calendar)
+    time_index = get_netcdf_time_index(ncFile, f, t_varname)
+    date = format_date(dateInput, time_index, useDoy, ncFile, varName)
+    timeIndex = get_time_index(ncFile, varName, date, time_index)
     logger.debug('Using date index ' + str(timeIndex))
-    arr = resample_nc_data(f, varName, cloneMapFileName, t_dimname, timeIndex)
+    grid_mapping = get_grid_mapping(ncFile, f, cloneMapFileName, cloneMapAttributes)
+    if cache:
+        landmask_key = None
+        if landmask is not None:
+            landmask_key = id(landmask)
+        key = (os.path.realpath(ncFile), varName, timeIndex, grid_mapping, landmask_key)
+        return fieldcache.get(
+            key,
+            lambda: resample_nc_data(f, varName, grid_mapping, t_dimname, timeIndex, landmask))
+    arr = resample_nc_data(f, varName, grid_mapping, t_dimname, timeIndex, landmask)
     f = None
     return arr
 
+@with_netcdf_lock
+def get_nc_time_index(ncFile, varName, dateInput, useDoy = None):
+    """Function to get the index of a date along the time
+    dimension of a netCDF file, following the same rules as
+    netcdf2PCRobjClone.
+    """
+    f = read_netCDF(ncFile)
+    varName = str(varName)
+    t_varname = get_time_variable_name(f)
+    time_index = get_netcdf_time_index(ncFile, f, t_varname)
+    date = format_date(dateInput, time_index, useDoy, ncFile, varName)
+    return get_time_index(ncFile, varName, date, time_index)
+
+@with_netcdf_lock
+def get_nc_dates(ncFile):
+    """Function to get the dates along the time dimension of
+    a netCDF file, as 'YYYY-MM-DD' strings
+    """
+    f = read_netCDF(ncFile)
+    nctime = f.variables[get_time_variable_name(f)]
+    dates = nc.num2date(
+        np.asarray(nctime[:], dtype=np.float64),
+        get_time_units(nctime),
+        get_time_calendar(nctime))
+    return ['%04i-%02i-%02i' % (date.year, date.month, date.day) for date in dates]
+
+@with_netcdf_lock
+def get_time_chunk_size(ncFile, varName):
+    """Function to get the chunk size along the time 
+    dimension of a netCDF variable (1 if the variable is not
+    chunked)
+    """
+    f = read_netCDF(ncFile)
+    var = f.variables[str(varName)]
+    t_dimname = get_time_dimension_name(f)
+    chunking = var.chunking()
+    if not isinstance(chunking, (list, tuple)) or t_dimname not in var.dimensions:
+        return 1
+    return int(chunking[var.dimensions.index(t_dimname)])
+
+class ReadPlan(object):
+    """Plan for reading the time steps of a netCDF variable,
+    based on the chunking and compression of the variable and
+    the window of the input grid covering the clone map. 
+
+    A compressed chunk is decompressed in full whenever any of
+    its values is read, so reading one time step from chunks
+    which span several time steps, or which extend beyond the
+    window, reads more data than needed. The ratio of the data
+    decompressed to the data needed is the read amplification.
+    If chunks span several time steps the variable is read in
+    blocks of whole chunks ('block'), otherwise one time step 
+    at a time ('step'). If the amplification is still high 
+    when reading blocks (i.e. chunks are much larger than the 
+    window) the file should be rechunked.
+    """
+    max_amplification = 4.
+    
+    def __init__(self, var, timeDimName, grid_mapping):
+        dims = list(var.dimensions)
+        self.dimensions = dims
+        self.timeDimName = timeDimName
+        chunking = var.chunking()
+        filters = var.filters() or {}
+        self.chunking = None
+        if isinstance(chunking, (list, tuple)):
+            self.chunking = tuple(int(size) for size in chunking)
+        self.compressed = any(
+            filters.get(name, False) for name in ('zlib', 'szip', 'zstd', 'bzip2', 'blosc'))
+        self.time_chunk_size = 1
+        if self.chunking is not None and timeDimName in dims:
+            self.time_chunk_size = self.chunking[dims.index(timeDimName)]
+        self.window = (
+            grid_mapping.yReadSlice.stop - grid_mapping.yReadSlice.start,
+            grid_mapping.xReadSlice.stop - grid_mapping.xReadSlice.start)
+
+        self.block_amplification = 1.
+        if self.chunking is not None and self.compressed:
+            for slc, size in zip(
+                    (grid_mapping.yReadSlice, grid_mapping.xReadSlice),
+                    self.chunking[-2:]):
+                nchunks = (slc.stop - 1) // size - slc.start // size + 1
+                self.block_amplification *= float(nchunks * size) / (slc.stop - slc.start)
+        else:
+            self.time_chunk_size = 1
+        self.step_amplification = self.block_amplification * self.time_chunk_size
+        
+        self.strategy = 'step'
+        self.amplification = self.step_amplification
+        if self.time_chunk_size > 1:
+            self.strategy = 'block'
+            self.amplification = self.block_amplification
+        self.rechunk = self.amplification > self.max_amplification
+
+    def describe(self):
+        if self.chunking is None:
+            layout = 'contiguous'
+        else:
+            layout = 'chunks ' + str(self.chunking)
+            if self.compressed:
+                layout += ', compressed'
+        msg = (layout + ': read amplification %.1fx per time step' % self.step_amplification)
+        if self.strategy == 'block':
+            msg += (', %.1fx reading blocks of %i time steps'
+                    % (self.block_amplification, self.time_chunk_size))
+        return msg
+    
+    def suggest_rechunk(self, ncFile):
+        """Function to suggest a command to rechunk the file so
+        that each chunk covers the window"""
+        chunks = ['%s/%i' % (self.dimensions[-2], self.window[0]),
+                  '%s/%i' % (self.dimensions[-1], self.window[1])]
+        if self.timeDimName in self.dimensions:
+            chunks.insert(0, '%s/%i' % (self.timeDimName, self.time_chunk_size))
+        return 'nccopy -c ' + ','.join(chunks) + ' ' + str(ncFile) + ' <output>'
+        
+@with_netcdf_lock
+def get_read_plan(ncFile, varName,
+                  cloneMapFileName = None,
+                  cloneMapAttributes = None,
+                  LatitudeLongitude = True):
+    """Function to get the ReadPlan of a netCDF variable"""
+    f = read_netCDF(ncFile)
+    f = rename_latlong_dims(f, LatitudeLongitude)
+    t_dimname = get_time_dimension_name(f)
+    grid_mapping = get_grid_mapping(ncFile, f, cloneMapFileName, cloneMapAttributes)
+    return ReadPlan(f.variables[str(varName)], t_dimname, grid_mapping)
+
+@with_netcdf_lock
+def netcdf2NumPyTimeIndexRange(ncFile, varName, startIndex, endIndex,
+                               cloneMapFileName = None,
+                               cloneMapAttributes = None,
+                               LatitudeLongitude = True,
+                               landmask = None):
+    """Function to read time steps startIndex (inclusive) to
+    endIndex (exclusive) of a netCDF variable as a single 
+    hyperslab. The time dimension of the returned array is 
+    the first axis. If landmask is supplied only the cells
+    in the landmask are returned (see netcdf2PCRobjClone).
+    """
+    logger.debug('Reading variable: ' + str(varName) + ' (time steps ' + str(startIndex) + ' to ' + str(endIndex) + ') from the file: ' + str(ncFile))
+    f = read_netCDF(ncFile)
+    varName = str(varName)
+    f = rename_latlong_dims(f, LatitudeLongitude)
+    t_dimname = get_time_dimension_name(f)
+    endIndex = min(endIndex, len(f.dimensions[t_dimname]))
+    grid_mapping = get_grid_mapping(ncFile, f, cloneMapFileName, cloneMapAttributes)
+    arr = resample_nc_data(f, varName, grid_mapping, t_dimname, slice(startIndex, endIndex), landmask)
+    time_axis = list(f.variables[varName].dimensions).index(t_dimname)
+    f = None
+    return np.moveaxis(arr, time_axis, 0)
+
+@with_netcdf_lock
 def netcdf2PCRobjCloneWithoutTime(
         ncFile, varName,
         cloneMapFileName  = None,
         LatitudeLongitude = True,
         specificFillValue = None,
-        absolutePath = None):        
+        absolutePath = None,
+        landmask = None):        
     
     logger.debug('Reading variable: ' + str(varName) + ' from the file: ' + str(ncFile))
     f = read_netCDF(ncFile)
     varName = str(varName)
     f = rename_latlong_dims(f, LatitudeLongitude)
-    arr = resample_nc_data(f, varName, cloneMapFileName)
+    grid_mapping = get_grid_mapping(ncFile, f, cloneMapFileName)
+    if staticreadcache is not None:
+        return read_static_field(ncFile, f, varName, grid_mapping, landmask)
+    arr = resample_nc_data(f, varName, grid_mapping, landmask = landmask)
     f = None
     return arr
 
+def start_static_read_cache():
+    """Function to start sharing static fields between model
+    components. While the cache is active a field which has
+    already been read (from the same file, on the same grid)
+    is not read again; instead the same read-only array is 
+    returned.
+    """
+    global staticreadcache, staticreadhits
+    staticreadcache = dict()
+    staticreadhits = 0
+
+def stop_static_read_cache():
+    """Function to stop sharing static fields. Arrays which 
+    have been returned remain shared (and read-only)."""
+    global staticreadcache
+    if staticreadcache is not None:
+        logger.debug(
+            'Static fields: %i read, %i shared reads',
+            len(staticreadcache),
+            staticreadhits)
+    staticreadcache = None
+    
+def read_static_field(ncFile, f, varName, grid_mapping, landmask = None):
+    global staticreadhits
+    landmask_key = None
+    if landmask is not None:
+        landmask_key = id(landmask)
+    key = (os.path.realpath(ncFile), varName, grid_mapping, landmask_key)
+    if key in staticreadcache:
+        staticreadhits += 1
+        return staticreadcache[key]
+    arr = resample_nc_data(f, varName, grid_mapping, landmask = landmask)
+    arr.setflags(write=False)
+    staticreadcache[key] = arr
+    return arr
+
+@with_netcdf_lock
 def netcdf2NumPyTimeSlice(ncFile,varName,startDate,endDate,
                           useDoy = None,
                           cloneMapFileName = None,
@@ -673,19 +1361,17 @@ def netcdf2NumPyTimeSlice(ncFile,varName,startDate,endDate,
     f = rename_latlong_dims(f, LatitudeLongitude)
     t_varname = get_time_variable_name(f)
     t_dimname = get_time_dimension_name(f)
-    t_unit = get_time_units(f.variables[t_varname])
-    t_calendar = get_time_calendar(f.variables[t_varname])
-    startDate = format_date(startDate, f.variables[t_varname], useDoy)
-    endDate = format_date(endDate, f.variables[t_varname], useDoy)
-    lastDateInNC = nc.num2date(f.variables[t_varname][-1], units=t_unit, calendar=t_calendar)
-    startIndex = nc.date2index(datetime.datetime(startDate.year, startDate.month, startDate.day, 0, 0, 0), f.variables[t_varname])
-    if endDate <= lastDateInNC:
-        endIndex = nc.date2index(datetime.datetime(endDate.year, endDate.month, endDate.day, 0, 0, 0), f.variables[t_varname])
-        # print endIndex
+    time_index = get_netcdf_time_index(ncFile, f, t_varname)
+    startDate = format_date(startDate, time_index, useDoy, ncFile, varName)
+    endDate = format_date(endDate, time_index, useDoy, ncFile, varName)
+    startIndex = time_index.exact_index(startDate)
+    if endDate <= time_index.last_date:
+        endIndex = time_index.exact_index(endDate)
     else:
-        endIndex = f.variables[t_varname].size    
+        endIndex = time_index.size
     timeIndex = np.arange(startIndex, endIndex + 1)
-    arr = resample_nc_data(f, varName, cloneMapFileName, t_dimname, timeIndex)
+    grid_mapping = get_grid_mapping(ncFile, f, cloneMapFileName)
+    arr = resample_nc_data(f, varName, grid_mapping, t_dimname, timeIndex)
     f = None
     return arr
     
@@ -767,10 +1453,41 @@ def netcdf2NumPyTimeSlice(ncFile,varName,startDate,endDate,
     # cropData = None 
     # return (outnp)
 
+def read_map_clone(v,cloneMapFileName,absolutePath=None,isLddMap=False,cover=None,isNomMap=False):
+    """Function to read a map (PCRaster, GeoTIFF or netCDF) or
+    a constant value on the clone map with numpy only. Maps 
+    are resampled in the same way as in readPCRmapClone, which
+    returns the same array if PCRaster is used.
+    """
+    logger.debug('read file/values: '+str(v))
+    if v == "None":
+        return None
+    if not re.match(r"[0-9.-]*$",v):
+        if absolutePath != None: v = getFullPath(v,absolutePath)
+        data = read_map_data(v)
+        if not isSameClone(v,cloneMapFileName):
+            mapping = get_map_mapping(v, cloneMapFileName)
+            if isNomMap == True:
+                data = mapping.mode(data)
+            else:
+                data = mapping.nearest(data)
+            if isLddMap == True: data[~(data < 10.)] = np.nan
+            if isNomMap == True: data[~(data >  0.)] = np.nan
+    else:
+        attributeClone = getMapAttributesALL(cloneMapFileName)
+        data = np.full(
+            (int(attributeClone['rows']), int(attributeClone['cols'])),
+            float(v))
+    if cover is not None:
+        data = np.where(np.isnan(data), cover, data)
+    return data
+
 def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,cover=None,isNomMap=False):
 	# v: inputMapFileName or floating values
 	# cloneMapFileName: If the inputMap and cloneMap have different clones,
 	#                   resampling will be done.   
+    if map_backend == 'numpy':
+        return read_map_clone(v,cloneMapFileName,absolutePath,isLddMap,cover,isNomMap)
     logger.debug('read file/values: '+str(v))
     if v == "None":
         #~ PCRmap = str("None")
@@ -783,18 +1500,23 @@ def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,c
         if sameClone == True:
             PCRmap = pcr.readmap(v)
         else:
-            # resample using GDAL:
-            output = tmpDir+'temp.map'
-            warp = gdalwarpPCR(v,output,cloneMapFileName,tmpDir,isLddMap,isNomMap)
-            # read from temporary file and delete the temporary file:
-            PCRmap = pcr.readmap(output)
-            if isLddMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) < 10., PCRmap)
-            if isLddMap == True: PCRmap = pcr.ldd(PCRmap)
-            if isNomMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) >  0., PCRmap)
-            if isNomMap == True: PCRmap = pcr.nominal(PCRmap)
-            if os.path.isdir(tmpDir):
-                shutil.rmtree(tmpDir)
-            os.makedirs(tmpDir)
+            # resample in memory (nearest neighbour, or the most
+            # common class for nominal maps with cells smaller 
+            # than the clone)
+            mapping = get_map_mapping(v, cloneMapFileName)
+            data = read_pcraster_map_data(v)
+            if isNomMap == True:
+                data = mapping.mode(data)
+            else:
+                data = mapping.nearest(data)
+            if isLddMap == True: data[~(data < 10.)] = np.nan
+            if isNomMap == True: data[~(data >  0.)] = np.nan
+            if isLddMap == True:
+                PCRmap = pcr.numpy2pcr(pcr.Ldd, data, np.nan)
+            elif isNomMap == True:
+                PCRmap = pcr.numpy2pcr(pcr.Nominal, data, np.nan)
+            else:
+                PCRmap = pcr.numpy2pcr(pcr.Scalar, data, np.nan)
     else:
         PCRmap = pcr.spatial(pcr.scalar(float(v)))
     if cover != None:
@@ -928,25 +1650,325 @@ def getFullPath(inputPath,absolutePath,completeFileName = True):
 
     return fullPath    		
 
+def read_pcraster_map_header(mapFileName):
+    """Function to read the raster attributes of a PCRaster
+    (CSF) map directly from its file header. This replaces a
+    call to 'mapattr -p', which requires spawning a process.
+    """
+    with open(mapFileName, 'rb') as f:
+        header = f.read(csf_header_size)
+    if len(header) < csf_header_size or not header.startswith(csf_signature):
+        raise ModelFileError(mapFileName, msg="File is not a PCRaster map\n")
+
+    # the byte order field is written in the native byte order
+    # of the machine which created the map, and has value 1
+    if struct.unpack('<I', header[46:50])[0] == 1:
+        byteorder = '<'
+    else:
+        byteorder = '>'
+        
+    xUL, yUL = struct.unpack(byteorder + 'dd', header[84:100])
+    rows, cols = struct.unpack(byteorder + 'II', header[100:108])
+    cellsize = struct.unpack(byteorder + 'd', header[108:116])[0]
+    return {'cellsize' : float(cellsize),
+            'rows'     : float(rows),
+            'cols'     : float(cols),
+            'xUL'      : float(xUL),
+            'yUL'      : float(yUL)}
+
+def read_pcraster_map_data(mapFileName):
+    """Function to read the cell values of a PCRaster (CSF) 
+    map directly from file, as a float64 array with missing 
+    values set to NaN.
+    """
+    with open(mapFileName, 'rb') as f:
+        header = f.read(csf_header_size)
+        if struct.unpack('<I', header[46:50])[0] == 1:
+            byteorder = '<'
+        else:
+            byteorder = '>'
+        cell_repr = struct.unpack(byteorder + 'H', header[66:68])[0]
+        rows, cols = struct.unpack(byteorder + 'II', header[100:108])
+        if cell_repr not in csf_cell_types:
+            raise ModelFileError(mapFileName, msg="Unknown cell representation in PCRaster map\n")
+        dtype = np.dtype(csf_cell_types[cell_repr]).newbyteorder(byteorder)
+        data = np.fromfile(f, dtype=dtype, count=rows * cols).reshape(rows, cols)
+    if dtype.kind == 'f':
+        # missing values are NaN (all bits set)
+        return data.astype(np.float64)
+    if dtype.kind == 'u':
+        mv = np.iinfo(dtype).max
+    else:
+        mv = np.iinfo(dtype).min
+    arr = data.astype(np.float64)
+    arr[data == mv] = np.nan
+    return arr
+
+def read_geotiff_tags(f, mapFileName):
+    """Function to read the tags of the first image in a 
+    (classic, not BigTIFF) TIFF file, as a dictionary of 
+    tuples of values"""
+    byteorder = {b'II' : '<', b'MM' : '>'}.get(f.read(2))
+    if byteorder is None:
+        raise ModelFileError(mapFileName, msg="File is not a GeoTIFF\n")
+    version, offset = struct.unpack(byteorder + 'HI', f.read(6))
+    if version != 42:
+        raise ModelFileError(mapFileName, msg="Only classic (not BigTIFF) GeoTIFF files are supported\n")
+    f.seek(offset)
+    nTags = struct.unpack(byteorder + 'H', f.read(2))[0]
+    entries = [struct.unpack(byteorder + 'HHI4s', f.read(12)) for i in range(nTags)]
+    tags = dict()
+    for tag, field_type, count, value in entries:
+        if field_type not in tiff_field_types:
+            continue
+        size, fmt = tiff_field_types[field_type]
+        if size * count > 4:
+            f.seek(struct.unpack(byteorder + 'I', value)[0])
+            value = f.read(size * count)
+        if field_type == 2:
+            tags[tag] = (value[:count].rstrip(b'\x00').decode('ascii'),)
+        else:
+            tags[tag] = struct.unpack(byteorder + fmt * count, value[:(size * count)])
+    tags['byteorder'] = byteorder
+    return tags
+
+def get_geotiff_attributes(tags, mapFileName):
+    if 33550 not in tags or 33922 not in tags:
+        raise ModelFileError(mapFileName, msg="GeoTIFF does not contain a pixel scale and tie point\n")
+    scalex, scaley = tags[33550][:2]
+    i, j, k, x, y, z = tags[33922][:6]
+    return {'cellsize' : float(scalex),
+            'rows'     : float(tags[257][0]),
+            'cols'     : float(tags[256][0]),
+            'xUL'      : float(x - i * scalex),
+            'yUL'      : float(y + j * scaley)}
+
+def read_geotiff_header(mapFileName):
+    """Function to read the raster attributes of a GeoTIFF
+    from its pixel scale and tie point tags. Cells are assumed
+    to be square and the raster north-up.
+    """
+    with open(mapFileName, 'rb') as f:
+        tags = read_geotiff_tags(f, mapFileName)
+    return get_geotiff_attributes(tags, mapFileName)
+
+def read_geotiff_data(mapFileName):
+    """Function to read the cell values of a single band 
+    GeoTIFF (uncompressed or deflate compressed, in strips or
+    tiles) as a float64 array, with the nodata value set to 
+    NaN.
+    """
+    with open(mapFileName, 'rb') as f:
+        tags = read_geotiff_tags(f, mapFileName)
+        byteorder = tags['byteorder']
+        rows = tags[257][0]
+        cols = tags[256][0]
+        compression = tags.get(259, (1,))[0]
+        if tags.get(277, (1,))[0] != 1 or compression not in (1, 8, 32946) or tags.get(317, (1,))[0] != 1:
+            raise ModelFileError(
+                mapFileName,
+                msg="Only single band GeoTIFF files without compression or with deflate compression (without predictor) are supported\n")
+        kind = tiff_sample_formats[tags.get(339, (1,))[0]]
+        dtype = np.dtype(kind + str(tags[258][0] // 8)).newbyteorder(byteorder)
+        if 322 in tags:
+            blockRows, blockCols = tags[323][0], tags[322][0]
+            offsets, counts = tags[324], tags[325]
+        else:
+            blockRows, blockCols = min(tags.get(278, (rows,))[0], rows), cols
+            offsets, counts = tags[273], tags[279]
+        nBlockCols = int(np.ceil(float(cols) / blockCols))
+        data = np.empty((rows, cols), dtype=dtype)
+        for idx, (offset, count) in enumerate(zip(offsets, counts)):
+            f.seek(offset)
+            block = f.read(count)
+            if compression != 1:
+                block = zlib.decompress(block)
+            block = np.frombuffer(block, dtype=dtype)
+            row = (idx // nBlockCols) * blockRows
+            col = (idx % nBlockCols) * blockCols
+            # strips at the end of the image may be shorter
+            block = block[:((block.size // blockCols) * blockCols)].reshape(-1, blockCols)
+            nRows = min(block.shape[0], rows - row)
+            nCols = min(blockCols, cols - col)
+            data[row:(row + nRows), col:(col + nCols)] = block[:nRows,:nCols]
+    arr = data.astype(np.float64)
+    if 42113 in tags:
+        nodata = float(tags[42113][0])
+        arr[arr == nodata] = np.nan
+    return arr
+
+@with_netcdf_lock
+def read_netcdf_map_data(ncFile):
+    """Function to read the (first) variable of a netCDF file
+    on its latitude and longitude grid, oriented north up, as
+    a float64 array with missing values set to NaN.
+    """
+    f = read_netCDF(ncFile)
+    f = rename_latlong_dims(f, True)
+    latitudes = f.variables['lat'][:]
+    longitudes = f.variables['lon'][:]
+    varName = None
+    for name, var in f.variables.items():
+        if (name not in ('lat','lon','latitude','longitude')
+            and len(var.dimensions) >= 2
+            and var.shape[-2:] == (len(latitudes), len(longitudes))):
+            varName = name
+            break
+    if varName is None:
+        raise ModelFileError(ncFile, msg="File does not contain a variable on its latitude and longitude grid\n")
+    # the first field is used if the variable has further
+    # (e.g. time) dimensions
+    var = f.variables[varName]
+    data = var[((0,) * (var.ndim - 2)) + (slice(None), slice(None))]
+    if isinstance(data, np.ma.MaskedArray):
+        data = data.astype(np.float64).filled(np.nan)
+    data = np.asarray(data, dtype=np.float64)
+    if len(latitudes) > 1 and latitudes[0] < latitudes[1]:
+        data = data[::-1,:]
+    if len(longitudes) > 1 and longitudes[0] > longitudes[1]:
+        data = data[:,::-1]
+    return data
+
+def read_map_data(mapFileName):
+    """Function to read the cell values of a map (PCRaster, 
+    GeoTIFF or netCDF) as a float64 array with missing values
+    set to NaN"""
+    mapFileName = str(mapFileName)
+    if mapFileName.endswith(netcdf_suffixes):
+        return read_netcdf_map_data(mapFileName)
+    if mapFileName.lower().endswith(geotiff_suffixes):
+        return read_geotiff_data(mapFileName)
+    return read_pcraster_map_data(mapFileName)
+
+def get_map_coordinates(attributes):
+    """Function to get the latitudes (north to south) and 
+    longitudes (west to east) of the cell centres of a map
+    from its raster attributes"""
+    cellsize = attributes['cellsize']
+    latitudes = attributes['yUL'] - (np.arange(int(attributes['rows'])) + 0.5) * cellsize
+    longitudes = attributes['xUL'] + (np.arange(int(attributes['cols'])) + 0.5) * cellsize
+    return latitudes, longitudes
+
+class MapMapping(object):
+    """Mapping from the cells of an input map to the cells of
+    the clone map, for maps whose attributes differ from the
+    clone. The value of a clone cell is taken from the input
+    cell containing its centre ('nearest'), or from the most
+    common value of the input cells it covers ('mode'), which
+    are sampled at the centres of a factor x factor grid 
+    within the clone cell, where factor is the ratio of the
+    clone and input cell sizes. The mapping depends only on 
+    the attributes of both maps, so it is computed once for
+    each combination (see get_map_mapping).
+    """
+    def __init__(self, attributeInput, attributeClone):
+        rows = int(attributeClone['rows'])
+        cols = int(attributeClone['cols'])
+        cellsizeClone = attributeClone['cellsize']
+        cellsizeInput = attributeInput['cellsize']
+        self.rowsInput = int(attributeInput['rows'])
+        self.colsInput = int(attributeInput['cols'])
+        self.factor = max(1, int(round(cellsizeClone / cellsizeInput)))
+        
+        # sample points within each clone cell, as fractions
+        # of the clone cell size
+        offsets = (np.arange(self.factor) + 0.5) / self.factor
+        x = attributeClone['xUL'] + (np.arange(cols)[:,None] + offsets[None,:]) * cellsizeClone
+        y = attributeClone['yUL'] - (np.arange(rows)[:,None] + offsets[None,:]) * cellsizeClone
+        colsIdx = np.floor((x - attributeInput['xUL']) / cellsizeInput).astype(np.int64)
+        rowsIdx = np.floor((attributeInput['yUL'] - y) / cellsizeInput).astype(np.int64)
+        colsIdx[(colsIdx < 0) | (colsIdx >= self.colsInput)] = -1
+        rowsIdx[(rowsIdx < 0) | (rowsIdx >= self.rowsInput)] = -1
+
+        # flat indices of the input cells at the sample points,
+        # with shape (rows, cols, factor * factor); -1 if the 
+        # point lies outside the input map
+        indices = (rowsIdx[:,None,:,None] * self.colsInput + colsIdx[None,:,None,:])
+        indices[(rowsIdx[:,None,:,None] < 0) | (colsIdx[None,:,None,:] < 0)] = -1
+        self.window_indices = indices.reshape(rows, cols, self.factor * self.factor)
+
+        # input cells containing the centre of each clone cell
+        xc = attributeClone['xUL'] + (np.arange(cols) + 0.5) * cellsizeClone
+        yc = attributeClone['yUL'] - (np.arange(rows) + 0.5) * cellsizeClone
+        colsIdx = np.floor((xc - attributeInput['xUL']) / cellsizeInput).astype(np.int64)
+        rowsIdx = np.floor((attributeInput['yUL'] - yc) / cellsizeInput).astype(np.int64)
+        self.indices = rowsIdx[:,None] * self.colsInput + colsIdx[None,:]
+        self.indices[(rowsIdx[:,None] < 0) | (rowsIdx[:,None] >= self.rowsInput)
+                     | (colsIdx[None,:] < 0) | (colsIdx[None,:] >= self.colsInput)] = -1
+
+    def take(self, data, indices):
+        data = np.append(data.ravel(), np.nan)
+        return data[indices]
+
+    def nearest(self, data):
+        return self.take(data, self.indices)
+
+    def mode(self, data):
+        if self.factor == 1:
+            return self.nearest(data)
+        window = self.take(data, self.window_indices)
+        arr = np.full(window.shape[:-1], np.nan)
+        count = np.zeros(window.shape[:-1], dtype=np.int64)
+        # classes are visited in ascending order, so ties are
+        # resolved in favour of the lowest class
+        for value in np.unique(window[~np.isnan(window)]):
+            n = np.sum(window == value, axis=-1)
+            arr[n > count] = value
+            count = np.maximum(count, n)
+        return arr
+
+def get_map_mapping(inputMapFileName, cloneMapFileName):
+    attributeInput = getMapAttributesALL(inputMapFileName)
+    attributeClone = getMapAttributesALL(cloneMapFileName)
+    key = (tuple(sorted(attributeInput.items())), tuple(sorted(attributeClone.items())))
+    if key not in mapmappingcache:
+        mapmappingcache[key] = MapMapping(attributeInput, attributeClone)
+    return mapmappingcache[key]
+
+@with_netcdf_lock
+def read_netcdf_map_header(ncFile):
+    """Function to derive the raster attributes of a netCDF
+    file from its latitude and longitude coordinates. The 
+    attributes are computed in the same way as in 
+    resample_nc_data.
+    """
+    f = read_netCDF(ncFile)
+    f = rename_latlong_dims(f, True)
+    latitudes = f.variables['lat'][:]
+    longitudes = f.variables['lon'][:]
+    cellsize = float(abs(latitudes[0] - latitudes[1]))
+    return {'cellsize' : cellsize,
+            'rows'     : float(len(latitudes)),
+            'cols'     : float(len(longitudes)),
+            'xUL'      : float(np.min(longitudes) - 0.5 * cellsize),
+            'yUL'      : float(np.max(latitudes) + 0.5 * cellsize)}
+
 def getMapAttributesALL(cloneMap,arcDegree=True):
-    cOut,err = subprocess.Popen(str('mapattr -p %s ' %(cloneMap)), stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
-    # print cOut
-
-    if err !=None or cOut == []:
-        print "Something wrong with mattattr in VirtualOS, maybe clone Map does not exist ? "
-        sys.exit()
-
-    cellsize = float(cOut.split()[7])
-    if arcDegree == True: cellsize = round(cellsize * 360000.)/360000.
-    mapAttr = {'cellsize': float(cellsize)        ,\
-               'rows'    : float(cOut.split()[3]) ,\
-               'cols'    : float(cOut.split()[5]) ,\
-               'xUL'     : float(cOut.split()[17]),\
-               'yUL'     : float(cOut.split()[19])}
-    co = None; cOut = None; err = None
-    del co; del cOut; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
-    return mapAttr 
+    """Function to get the raster attributes (cellsize, rows,
+    cols, xUL, yUL) of a map. Attributes are cached for the 
+    lifetime of the process, keyed by path and modification
+    time, so that the header of each map is only parsed once.
+    """
+    cloneMap = str(cloneMap)
+    try:
+        mtime = os.path.getmtime(cloneMap)
+    except OSError:
+        raise ModelFileError(cloneMap)
+
+    key = (os.path.abspath(cloneMap), mtime, arcDegree)
+    if key not in mapattrcache:
+        if cloneMap.endswith(netcdf_suffixes):
+            mapAttr = read_netcdf_map_header(cloneMap)
+        elif cloneMap.lower().endswith(geotiff_suffixes):
+            mapAttr = read_geotiff_header(cloneMap)
+        else:
+            mapAttr = read_pcraster_map_header(cloneMap)
+        if arcDegree == True:
+            mapAttr['cellsize'] = float(round(mapAttr['cellsize'] * 360000.)/360000.)
+        mapattrcache[key] = mapAttr
+        
+    # return a copy so that callers cannot modify the cache
+    return dict(mapattrcache[key])
 
 def getLastDayOfMonth(date):
     ''' returns the last day of the month for a given date '''
@@ -987,13 +2009,10 @@ def regridData2FinerGrid(rescaleFac, coarse, MV):
 
     return fine
 
+@with_netcdf_lock
 def findLastYearInNCFile(ncFile):
     # open a netcdf file:
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
+    f = read_netCDF(ncFile)
 
     # last datetime
     last_datetime_year = findLastYearInNCTime(f.variables['time']) 
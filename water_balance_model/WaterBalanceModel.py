@@ -3,7 +3,6 @@
 
 import os
 import numpy as np
-import pcraster as pcr
 import VirtualOS as vos
 from Model import Model
 
@@ -28,11 +27,18 @@ class WaterBalanceModel(Model):
         self.lc_module = LandSurface(self)
         
     def initial(self):
+        # static inputs which are shared between land covers 
+        # are read once
+        vos.start_static_read_cache()
         self.meteo_module.initial()
         self.groundwater_module.initial()
         self.canal_module.initial()
         self.lc_module.initial()
+        vos.stop_static_read_cache()
         
+    def close(self):
+        self.meteo_module.close()
+
     def dynamic(self):
         self.meteo_module.dynamic()
         self.groundwater_module.dynamic()
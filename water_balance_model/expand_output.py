@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Script to expand an output file which is compressed by gathering
+# (see compressByGathering in [reportingOptions]) to the full lat/lon
+# grid, with cells outside the landmask set to the fill value. Usage:
+#
+#     python expand_output.py <input.nc> <output.nc>
+
+import sys
+import netCDF4 as nc
+import numpy as np
+
+import VirtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+def get_gathered_dimensions(f):
+    """Function to get the dimensions of a netCDF file which
+    are compressed by gathering, as a dictionary mapping each
+    dimension to its list of indices and the names of the
+    dimensions it compresses"""
+    gathered = dict()
+    for name, var in f.variables.items():
+        if var.dimensions == (name,) and 'compress' in var.ncattrs():
+            gathered[name] = (var[:], tuple(str(var.getncattr('compress')).split()))
+    return gathered
+
+def expand(data, indices, shape, fill_value = vos.MV):
+    """Function to expand an array whose last dimension is
+    compressed by gathering to an array with the last
+    dimension replaced by 'shape'"""
+    arr = np.full(data.shape[:-1] + (int(np.prod(shape)),), fill_value, dtype=data.dtype)
+    arr[...,indices] = data
+    return arr.reshape(data.shape[:-1] + tuple(shape))
+
+def expand_file(inputFile, outputFile):
+    """Function to write a copy of a netCDF file in which the
+    variables compressed by gathering are expanded to the full
+    grid. Variables are expanded one time step at a time."""
+    f = nc.Dataset(inputFile)
+    f.set_auto_mask(False)
+    gathered = get_gathered_dimensions(f)
+    out = nc.Dataset(outputFile, 'w', format=f.data_model)
+    out.setncatts(dict((k, f.getncattr(k)) for k in f.ncattrs()))
+    for name, dim in f.dimensions.items():
+        if name in gathered:
+            continue
+        out.createDimension(name, None if dim.isunlimited() else len(dim))
+    for name, var in f.variables.items():
+        if name in gathered:
+            continue
+        dims = var.dimensions
+        indices = None
+        if len(dims) > 0 and dims[-1] in gathered:
+            indices, compress_dims = gathered[dims[-1]]
+            dims = dims[:-1] + compress_dims
+        attrs = dict((k, var.getncattr(k)) for k in var.ncattrs())
+        fill_value = attrs.pop('_FillValue', None)
+        if indices is not None and fill_value is None:
+            fill_value = vos.MV
+        filters = var.filters() or {}
+        outvar = out.createVariable(
+            name,
+            var.dtype,
+            dims,
+            zlib = bool(filters.get('zlib', False)),
+            fill_value = fill_value)
+        outvar.setncatts(attrs)
+        if indices is None:
+            outvar[:] = var[:]
+            continue
+        shape = [len(f.dimensions[dim]) for dim in compress_dims]
+        if len(var.dimensions) > 1:
+            for idx in range(var.shape[0]):
+                outvar[idx] = expand(var[idx], indices, shape, fill_value)
+        else:
+            outvar[:] = expand(var[:], indices, shape, fill_value)
+    out.close()
+    f.close()
+
+def main():
+    if len(sys.argv) != 3:
+        sys.stderr.write('Usage: python expand_output.py <input.nc> <output.nc>\n')
+        return 1
+    expand_file(sys.argv[1], sys.argv[2])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
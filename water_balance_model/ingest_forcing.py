@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Script to write the meteorological forcing of a model run to a
+# forcing store (see ForcingStore.py), which is read by later runs
+# instead of the input files. Usage:
+#
+#     python ingest_forcing.py <config.ini> [<store.nc>]
+#
+# If no store filename is given, the store is written to the file
+# named by forcingStore in the [METEO] section. The store covers
+# the period from startTime to endTime.
+
+import os
+import sys
+
+from ModelTime import ModelTime
+from Configuration import Configuration
+from Model import Model
+from Meteo import Meteo
+from ForcingStore import ForcingStoreWriter, get_meteo_key
+import VirtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+usage = 'Usage: python ingest_forcing.py <config.ini> [<store.nc>]'
+
+def main():
+
+    # usage errors are written to stderr, as they are found
+    # before (or regardless of whether) logging is set up
+    if len(sys.argv) not in [2, 3]:
+        sys.stderr.write(usage + '\n')
+        return 1
+    iniFileName = os.path.abspath(sys.argv[1])
+    configuration = Configuration(iniFileName=iniFileName)
+    if len(sys.argv) > 2:
+        filename = os.path.abspath(sys.argv[2])
+    elif 'forcingStore' in configuration.METEO and str(configuration.METEO['forcingStore']) != 'None':
+        filename = str(configuration.METEO['forcingStore'])
+    else:
+        sys.stderr.write('No forcing store specified (forcingStore in [METEO])\n' + usage + '\n')
+        return 1
+
+    currTimeStep = ModelTime()
+    currTimeStep.getStartEndTimeSteps(
+        configuration.globalOptions['startTime'],
+        configuration.globalOptions['endTime'])
+    currTimeStep.update(1)
+    model = Model(configuration, currTimeStep)
+
+    # the forcing is read from the input files and converted
+    # in the same way as in a model run
+    meteo = Meteo(model, use_forcing_store = False)
+    meteo.initial()
+    names = list(meteo.forcing_variables.keys())
+    writer = ForcingStoreWriter(
+        filename,
+        names,
+        get_meteo_key(configuration.METEO),
+        model.landmask,
+        currTimeStep.startTime,
+        currTimeStep.nrOfTimeSteps)
+    logger.info('Writing meteorological forcing of %i days to %s', currTimeStep.nrOfTimeSteps, filename)
+    for timeStep in range(1, currTimeStep.nrOfTimeSteps + 1):
+        currTimeStep.update(timeStep)
+        meteo.dynamic()
+        writer.write(
+            timeStep - 1,
+            dict((name, getattr(meteo, name)[0,0,:]) for name in names))
+    writer.close()
+    meteo.close()
+    vos.filecache.close_all()
+
+if __name__ == '__main__':
+    sys.exit(main())
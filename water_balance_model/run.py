@@ -3,15 +3,18 @@
 
 import os
 import sys
+import signal
 
 from pcraster.framework import DynamicModel
 from pcraster.framework import DynamicFramework
 
 from DeterministicRunner import DeterministicRunner
+import VirtualOS as vos
 from ModelTime import ModelTime
 from hydro_model_builder import disclaimer
 
 from Reporting import Reporting
+from OutputNetCDF import close_output_files
 from WaterBalanceModel import WaterBalanceModel
 from Configuration import Configuration
 import variable_list
@@ -19,6 +22,10 @@ import variable_list
 import logging
 logger = logging.getLogger(__name__)
 
+def terminate(signum, frame):
+    # raise SystemExit so that output files are closed
+    sys.exit('Run terminated by signal ' + str(signum))
+
 def main():
 
     # disclaimer.print_disclaimer()
@@ -47,7 +54,15 @@ def main():
         initial_state)
     dynamic_framework = DynamicFramework(deterministic_runner, currTimeStep.nrOfTimeSteps)
     dynamic_framework.setQuiet(True)
-    dynamic_framework.run()
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        dynamic_framework.run()
+    finally:
+        deterministic_runner.close()
+        close_output_files()
+    vos.filecache.report()
+    vos.fieldcache.report()
+    vos.filecache.close_all()
 
 if __name__ == '__main__':
     disclaimer.print_disclaimer(with_logger = True)